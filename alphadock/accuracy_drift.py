@@ -0,0 +1,171 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import torch
+import logging
+import sys
+import time
+from tqdm import tqdm
+import click
+
+from alphadock import docker
+from alphadock import dataset
+from alphadock import inference
+from alphadock import loss
+from alphadock import utils
+from alphadock import quantization
+
+
+def superimposed_rmsd(crd_a, crd_b):
+    """RMSD between two (N, 3) coordinate sets after optimal superposition"""
+    crd_a = crd_a.double() - crd_a.double().mean(0)
+    crd_b = crd_b.double() - crd_b.double().mean(0)
+    u, s, vt = torch.linalg.svd(crd_a.T @ crd_b)
+    d = torch.sign(torch.det(u @ vt))
+    rot = u @ torch.diag(torch.tensor([1., 1., d.item()], dtype=u.dtype)) @ vt
+    return torch.sqrt(torch.mean(torch.sum(torch.square(crd_a @ rot - crd_b), dim=-1))).item()
+
+
+def compare_predictions(ref_output, output):
+    """Drift of output relative to the reference prediction ref_output"""
+    ref_ca = ref_output['final_all_atom']['atom_pos_tensor'][:, 1].detach().cpu().float()
+    ca = output['final_all_atom']['atom_pos_tensor'][:, 1].detach().cpu().float()
+    mask = torch.ones(1, ca.shape[0], 1)
+    ref_plddt = inference.plddt_from_logits(ref_output['struct_out']['rec_lddt'][0, -1].detach().cpu())
+    plddt = inference.plddt_from_logits(output['struct_out']['rec_lddt'][0, -1].detach().cpu())
+    return {
+        'CA_RMSD': superimposed_rmsd(ca, ref_ca),
+        'CA_LDDT': loss.lddt(ca[None], ca[None], ref_ca[None], ref_ca[None], mask, mask).item(),
+        'Mean_pLDDT_Ref': ref_plddt.mean().item(),
+        'Mean_pLDDT': plddt.mean().item(),
+        'Max_pLDDT_Diff': (plddt - ref_plddt).abs().max().item()
+    }
+
+
+def make_model(config_dict, model_pth, device, quantize=False):
+    model = docker.DockerIteration(config_dict['model'], config_dict)
+    inference.load_model_state(model, model_pth, device)
+    model.modules_to_devices()
+    model.eval()
+    if quantize:
+        model = quantization.quantize_trunk(model)
+    return model
+
+
+def main(
+        model_pth,
+        seed=123456,
+        config_update_json=None,
+        batch_json=None,
+        data_dir='.',
+        a3m_file=None,
+        extra_msa_size=4096,
+        trunk_dtype='bfloat16',
+        quantize=False,
+        out_json=None,
+        gpu=True
+):
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    logging.getLogger('.prody').setLevel('CRITICAL')
+
+    if gpu:
+        assert torch.cuda.is_available(), 'CUDA is not available'
+        device = 'cuda:0'
+    else:
+        device = 'cpu'
+
+    ref_config = inference.make_config(device, extra_msa_size=extra_msa_size, config_update_json=config_update_json)
+    test_config = inference.make_config(device, extra_msa_size=extra_msa_size, config_update_json=config_update_json, trunk_dtype=trunk_dtype)
+    ref_model = make_model(ref_config, model_pth, device)
+    test_model = make_model(test_config, model_pth, device, quantize=quantize)
+
+    if batch_json is None:
+        batch_data = [{
+            'entity_info': {'pdbx_seq_one_letter_code_can': inference.parse_first_sequence_a3m(a3m_file[0]), 'asym_ids': [None]},
+            'cif_file': None,
+            'a3m_files': a3m_file
+        }]
+        data_dir = '.'
+    else:
+        batch_data = utils.read_json(batch_json)
+
+    dset = dataset.DockingDataset(batch_data, ref_config['data'], dataset_dir=data_dir, seed=seed, shuffle=False)
+    loader = torch.utils.data.DataLoader(dset, batch_size=1, shuffle=False)
+    num_recycles = ref_config['model']['recycling_num_iter'] if ref_config['model']['recycling_on'] else 1
+
+    results = []
+    with torch.no_grad():
+        # both models get exactly the same features
+        for inputs in tqdm(loader, desc='Processed'):
+            t0 = time.time()
+            ref_output = inference.predict(ref_model, inputs, num_recycles)
+            t1 = time.time()
+            output = inference.predict(test_model, inputs, num_recycles)
+            t2 = time.time()
+
+            stats = {'ix': inputs['target']['ix'].item(), 'Num_Res': inputs['target']['rec_aatype'].shape[1]}
+            stats.update(compare_predictions(ref_output, output))
+            stats.update({'Time_Ref': t1 - t0, 'Time': t2 - t1})
+            results.append(stats)
+            print(stats); sys.stdout.flush()
+
+    average = {k: sum(x[k] for x in results) / len(results) for k in results[0].keys() if k != 'ix'}
+    print('Average:', average)
+    if out_json is not None:
+        utils.write_json({'trunk_dtype': trunk_dtype, 'quantize': quantize, 'average': average, 'targets': results}, out_json)
+    return results
+
+
+@click.command()
+@click.argument('model_pth')
+@click.option('--seed', default=123456, show_default=True, type=click.INT,
+              help='Seed for RNG. Ensures reproducibility')
+@click.option('--config_update_json',
+              type=click.Path(exists=True, dir_okay=False),
+              help='JSON containing configuration update. Will be merged with default alphafold.config.CONFIG')
+@click.option('--batch_json',
+              type=click.Path(exists=True, dir_okay=False),
+              help='JSON containing a list of proteins to fold (same format as in inference.py)')
+@click.option('--data_dir', default='./', show_default=True,
+              type=click.Path(exists=True, file_okay=False),
+              help='Directory containing files specified in batch_json, paths in batch_json will be prepended')
+@click.option('--a3m_file', multiple=True, help='Protein MSA file. Multiple MSAs will be concatenated')
+@click.option('--extra_msa_size', default=4096, show_default=True, type=click.INT, help='Extra MSA size')
+@click.option('--trunk_dtype', default='bfloat16', show_default=True, type=click.Choice(['float32', 'bfloat16', 'float16']),
+              help='Precision of the input embedder and Evoformer in the tested model')
+@click.option('--quantize', is_flag=True,
+              help='Quantize linear layers of the tested model to int8 (CPU only, requires --trunk_dtype float32)')
+@click.option('--out_json', type=click.Path(dir_okay=False), help='Where to write the per target comparison')
+@click.option('--gpu/--no_gpu', default=True, show_default=True, help='Use GPU (cuda:0) or CPU')
+def cli(**kwargs):
+    """Compare predictions of a reduced precision or quantized model with the float32 one.
+
+    MODEL_PTH - pth file with model parameters
+
+    For every target reports C-alpha RMSD and LDDT of the tested prediction
+    relative to the float32 prediction, change in pLDDT and timings.
+
+    \b
+    > python accuracy_drift.py model.pth --no_gpu --trunk_dtype bfloat16 --a3m_file msa.a3m
+    > python accuracy_drift.py model.pth --no_gpu --trunk_dtype float32 --quantize --batch_json reference_set.json
+    """
+    if not kwargs['a3m_file'] and not kwargs['batch_json']:
+        raise ValueError('Either --a3m_file or --batch_json must be provided')
+    main(**kwargs)
+
+
+if __name__ == '__main__':
+    cli()
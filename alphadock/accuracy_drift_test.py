@@ -0,0 +1,17 @@
+import torch
+
+from alphadock import accuracy_drift
+from alphadock import quat_affine
+
+
+def test_superimposed_rmsd():
+    torch.manual_seed(0)
+    crd = torch.randn(20, 3) * 10
+    quat = torch.randn(4)
+    rot = torch.stack([torch.stack(x) for x in quat_affine.quat_to_rot(quat / quat.norm())])
+    moved = crd @ rot.T + torch.tensor([1., -2., 3.])
+    assert accuracy_drift.superimposed_rmsd(moved, crd) < 1e-4
+
+    shifted = crd.clone()
+    shifted[0] += torch.tensor([0., 0., 2.])
+    assert accuracy_drift.superimposed_rmsd(shifted, crd) > 0.1
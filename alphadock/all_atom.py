@@ -37,6 +37,7 @@ the network to facilitate easier conversion to existing protein datastructures.
 """
 
 from typing import Dict, Optional
+import functools
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -76,6 +77,103 @@ def get_chi_atom_indices():
     return torch.as_tensor(chi_atom_indices)
 
 
+def _make_rigidgroup_tables():
+    """Per-restype lookup tables used by atom37_to_frames."""
+    # Create an array with the atom names.
+    # shape (num_restypes, num_rigidgroups, 3_atoms): (21, 8, 3)
+    restype_rigidgroup_base_atom_names = np.full([21, 8, 3], '', dtype=object)
+
+    # 0: backbone frame
+    restype_rigidgroup_base_atom_names[:, 0, :] = ['C', 'CA', 'N']
+
+    # 3: 'psi-group'
+    restype_rigidgroup_base_atom_names[:, 3, :] = ['CA', 'C', 'O']
+
+    # 4,5,6,7: 'chi1,2,3,4-group'
+    for restype, restype_letter in enumerate(residue_constants.restypes):
+        resname = residue_constants.restype_1to3[restype_letter]
+        for chi_idx in range(4):
+            if residue_constants.chi_angles_mask[restype][chi_idx]:
+                atom_names = residue_constants.chi_angles_atoms[resname][chi_idx]
+                restype_rigidgroup_base_atom_names[restype, chi_idx + 4, :] = atom_names[1:]
+
+    # Create mask for existing rigid groups.
+    restype_rigidgroup_mask = np.zeros([21, 8], dtype=np.float32)
+    restype_rigidgroup_mask[:, 0] = 1
+    restype_rigidgroup_mask[:, 3] = 1
+    restype_rigidgroup_mask[:20, 4:] = residue_constants.chi_angles_mask
+
+    # Translate atom names into atom37 indices.
+    lookuptable = residue_constants.atom_order.copy()
+    lookuptable[''] = 0
+    restype_rigidgroup_base_atom37_idx = np.vectorize(lambda x: lookuptable[x])(restype_rigidgroup_base_atom_names)
+
+    # Adapt backbone frame to old convention (mirror x-axis and z-axis).
+    rots = np.tile(np.eye(3, dtype=np.float32), [8, 1, 1])
+    rots[0, 0, 0] = -1
+    rots[0, 2, 2] = -1
+
+    # The frames for ambiguous rigid groups are just rotated by 180 degree around
+    # the x-axis. The ambiguous group is always the last chi-group.
+    restype_rigidgroup_is_ambiguous = np.zeros([21, 8], dtype=np.float32)
+    restype_rigidgroup_rots = np.tile(np.eye(3, dtype=np.float32), [21, 8, 1, 1])
+
+    for resname, _ in residue_constants.residue_atom_renaming_swaps.items():
+        restype = residue_constants.restype_order[residue_constants.restype_3to1[resname]]
+        chi_idx = int(sum(residue_constants.chi_angles_mask[restype]) - 1)
+        restype_rigidgroup_is_ambiguous[restype, chi_idx + 4] = 1
+        restype_rigidgroup_rots[restype, chi_idx + 4, 1, 1] = -1
+        restype_rigidgroup_rots[restype, chi_idx + 4, 2, 2] = -1
+
+    return {
+        'rigidgroup_base_atom37_idx': restype_rigidgroup_base_atom37_idx.astype(np.int64),  # (21, 8, 3)
+        'rigidgroup_mask': restype_rigidgroup_mask,  # (21, 8)
+        'rigidgroup_backbone_rots': rots,  # (8, 3, 3)
+        'rigidgroup_is_ambiguous': restype_rigidgroup_is_ambiguous,  # (21, 8)
+        'rigidgroup_ambiguity_rots': restype_rigidgroup_rots  # (21, 8, 3, 3)
+    }
+
+
+RIGIDGROUP_TABLES = _make_rigidgroup_tables()
+
+
+def _make_constant_tables():
+    """Numpy sources for the lookup tables returned by constant_table."""
+    chi_angles_mask = list(residue_constants.chi_angles_mask)
+    chi_angles_mask.append([0.0, 0.0, 0.0, 0.0])
+    tables = {
+        'restype_name_to_atom14_ids': np.asarray(residue_constants.restype_name_to_atom14_ids),
+        'restype_name_to_atom37_ids': np.asarray(residue_constants.restype_name_to_atom37_ids),
+        'chi_atom_indices': get_chi_atom_indices().numpy(),
+        'chi_angles_mask': np.asarray(chi_angles_mask, dtype=np.float32),
+        'chi_pi_periodic': np.asarray(residue_constants.chi_pi_periodic, dtype=np.float32),
+        'psi_mirror': np.asarray([1., 1., -1., 1., 1., 1., 1.], dtype=np.float32),
+        'restype_rigid_group_default_frame': residue_constants.restype_rigid_group_default_frame,
+        'restype_atom14_to_rigid_group': residue_constants.restype_atom14_to_rigid_group,
+        'restype_atom14_rigid_group_positions': residue_constants.restype_atom14_rigid_group_positions,
+        'restype_atom14_mask': residue_constants.restype_atom14_mask,
+    }
+    tables.update(RIGIDGROUP_TABLES)
+    return tables
+
+
+_CONSTANT_TABLES = _make_constant_tables()
+
+
+@functools.lru_cache(maxsize=None)
+def _constant_table_cached(name, device, dtype):
+    return torch.as_tensor(_CONSTANT_TABLES[name]).to(device=device, dtype=dtype)
+
+
+def constant_table(name, device, dtype=None):
+    """Returns residue constant lookup table `name` as a tensor.
+
+    Tables are uploaded once per (name, device, dtype) and reused on subsequent
+    calls, so the returned tensor must not be modified in place.
+    """
+    return _constant_table_cached(name, torch.device(device), dtype)
+
+
 def atom14_to_atom37(
         atom14_data: torch.Tensor,  # (N, 14, ...)
         aatype: torch.Tensor,  # (N)
@@ -84,7 +182,7 @@ def atom14_to_atom37(
     assert aatype.ndim == 1
     assert aatype.shape[0] == atom14_data.shape[0]
 
-    residx_atom37_to_atom14 = torch.tensor(residue_constants.restype_name_to_atom14_ids, device=aatype.device, dtype=aatype.dtype)[aatype]
+    residx_atom37_to_atom14 = constant_table('restype_name_to_atom14_ids', aatype.device, aatype.dtype)[aatype]
     atom14_data_flat = atom14_data.reshape(*atom14_data.shape[:2], -1)
     # add 15th field used as placeholder in restype_name_to_atom14_ids
     atom14_data_flat = torch.cat([atom14_data_flat, torch.zeros_like(atom14_data_flat[:, :1])], dim=1)
@@ -100,7 +198,7 @@ def atom37_to_atom14(
     assert aatype.ndim == 1
     assert aatype.shape[0] == atom37_data.shape[0]
 
-    residx_atom14_to_atom37 = torch.tensor(residue_constants.restype_name_to_atom37_ids, device=aatype.device, dtype=aatype.dtype)[aatype]
+    residx_atom14_to_atom37 = constant_table('restype_name_to_atom37_ids', aatype.device, aatype.dtype)[aatype]
     atom37_data_flat = atom37_data.reshape(*atom37_data.shape[:2], -1)
     atom37_data_flat = torch.cat([atom37_data_flat, torch.zeros_like(atom37_data_flat[:, :1])], dim=1)
     out = torch.gather(atom37_data_flat, 1, residx_atom14_to_atom37[..., None].repeat(1, 1, atom37_data_flat.shape[-1]))
@@ -161,38 +259,9 @@ def atom37_to_frames(
     all_atom_positions = torch.reshape(all_atom_positions, [-1, 37, 3])
     all_atom_mask = torch.reshape(all_atom_mask, [-1, 37])
 
-    # Create an array with the atom names.
-    # shape (num_restypes, num_rigidgroups, 3_atoms): (21, 8, 3)
-    restype_rigidgroup_base_atom_names = np.full([21, 8, 3], '', dtype=object)
-
-    # 0: backbone frame
-    restype_rigidgroup_base_atom_names[:, 0, :] = ['C', 'CA', 'N']
-
-    # 3: 'psi-group'
-    restype_rigidgroup_base_atom_names[:, 3, :] = ['CA', 'C', 'O']
-
-    # 4,5,6,7: 'chi1,2,3,4-group'
-    for restype, restype_letter in enumerate(residue_constants.restypes):
-        resname = residue_constants.restype_1to3[restype_letter]
-        for chi_idx in range(4):
-            if residue_constants.chi_angles_mask[restype][chi_idx]:
-                atom_names = residue_constants.chi_angles_atoms[resname][chi_idx]
-                restype_rigidgroup_base_atom_names[restype, chi_idx + 4, :] = atom_names[1:]
-
-    # Create mask for existing rigid groups.
-    restype_rigidgroup_mask = np.zeros([21, 8], dtype=np.float32)
-    restype_rigidgroup_mask[:, 0] = 1
-    restype_rigidgroup_mask[:, 3] = 1
-    restype_rigidgroup_mask[:20, 4:] = residue_constants.chi_angles_mask
-
-    # Translate atom names into atom37 indices.
-    lookuptable = residue_constants.atom_order.copy()
-    lookuptable[''] = 0
-    restype_rigidgroup_base_atom37_idx = np.vectorize(lambda x: lookuptable[x])(restype_rigidgroup_base_atom_names)
-
     # Compute the gather indices for all residues in the chain.
     # shape (N, 8, 3)
-    residx_rigidgroup_base_atom37_idx = torch.tensor(restype_rigidgroup_base_atom37_idx, device=device, dtype=aatype.dtype)[aatype]
+    residx_rigidgroup_base_atom37_idx = constant_table('rigidgroup_base_atom37_idx', device, aatype.dtype)[aatype]
 
     # Gather the base atom positions for each rigid group.
     # (N, 8, 3, 3)
@@ -210,8 +279,7 @@ def atom37_to_frames(
 
     # Compute a mask whether the group exists.
     # (N, 8)
-    restype_rigidgroup_mask = torch.tensor(restype_rigidgroup_mask, device=device, dtype=dtype)
-    group_exists = restype_rigidgroup_mask[aatype]
+    group_exists = constant_table('rigidgroup_mask', device, dtype)[aatype]
 
     # Compute a mask whether ground truth exists for the group
     # (N, 8, 3)
@@ -224,26 +292,14 @@ def atom37_to_frames(
     gt_exists = gt_atoms_exist.min(-1).values * group_exists
 
     # Adapt backbone frame to old convention (mirror x-axis and z-axis).
-    rots = np.tile(np.eye(3, dtype=np.float32), [8, 1, 1])
-    rots[0, 0, 0] = -1
-    rots[0, 2, 2] = -1
-    gt_frames = r3.rigids_mul_rots(gt_frames, r3.rots_from_tensor3x3(torch.tensor(rots, device=device, dtype=dtype)))
+    rots = constant_table('rigidgroup_backbone_rots', device, dtype)
+    gt_frames = r3.rigids_mul_rots(gt_frames, r3.rots_from_tensor3x3(rots))
 
     # The frames for ambiguous rigid groups are just rotated by 180 degree around
     # the x-axis. The ambiguous group is always the last chi-group.
-    restype_rigidgroup_is_ambiguous = np.zeros([21, 8], dtype=np.float32)
-    restype_rigidgroup_rots = np.tile(np.eye(3, dtype=np.float32), [21, 8, 1, 1])
-
-    for resname, _ in residue_constants.residue_atom_renaming_swaps.items():
-        restype = residue_constants.restype_order[residue_constants.restype_3to1[resname]]
-        chi_idx = int(sum(residue_constants.chi_angles_mask[restype]) - 1)
-        restype_rigidgroup_is_ambiguous[restype, chi_idx + 4] = 1
-        restype_rigidgroup_rots[restype, chi_idx + 4, 1, 1] = -1
-        restype_rigidgroup_rots[restype, chi_idx + 4, 2, 2] = -1
-
     # Gather the ambiguity information for each residue.
-    residx_rigidgroup_is_ambiguous = torch.tensor(restype_rigidgroup_is_ambiguous, device=device, dtype=dtype)[aatype]
-    residx_rigidgroup_ambiguity_rot = torch.tensor(restype_rigidgroup_rots, device=device, dtype=dtype)[aatype]
+    residx_rigidgroup_is_ambiguous = constant_table('rigidgroup_is_ambiguous', device, dtype)[aatype]
+    residx_rigidgroup_ambiguity_rot = constant_table('rigidgroup_ambiguity_rots', device, dtype)[aatype]
 
     # Create the alternative ground truth frames.
     alt_gt_frames = r3.rigids_mul_rots(gt_frames, r3.rots_from_tensor3x3(residx_rigidgroup_ambiguity_rot))
@@ -339,16 +395,14 @@ def atom37_to_torsion_angles(
     aatype_flat = aatype.flatten()
     # Collect the atoms for the chi-angles.
     # Compute the table of chi angle indices. Shape: [restypes, chis=4, atoms=4].
-    chi_atom_indices = get_chi_atom_indices().to(device=aatype.device, dtype=aatype.dtype)
+    chi_atom_indices = constant_table('chi_atom_indices', aatype.device, aatype.dtype)
     # Select atoms to compute chis. Shape: [batch, num_res, chis=4, atoms=4].
     atom_indices = chi_atom_indices[aatype_flat].unflatten(0, [num_batch, num_res])
     # Gather atom positions. Shape: [batch, num_res, chis=4, atoms=4, xyz=3].
     chis_atom_pos = torch.gather(all_atom_pos[:, :, None, :, :].repeat(1, 1, 4, 1, 1), 3, atom_indices[..., None].repeat(1, 1, 1, 1, 3))
 
-    # Copy the chi angle mask, add the UNKNOWN residue. Shape: [restypes, 4].
-    chi_angles_mask = list(residue_constants.chi_angles_mask)
-    chi_angles_mask.append([0.0, 0.0, 0.0, 0.0])
-    chi_angles_mask = torch.tensor(chi_angles_mask, dtype=all_atom_pos.dtype, device=all_atom_pos.device)
+    # Chi angle mask with the UNKNOWN residue added. Shape: [restypes, 4].
+    chi_angles_mask = constant_table('chi_angles_mask', all_atom_pos.device, all_atom_pos.dtype)
 
     # Compute the chi angle mask. I.e. which chis angles exist according to the
     # aatype. Shape [batch, num_res, chis=4].
@@ -405,12 +459,10 @@ def atom37_to_torsion_angles(
     torsion_angles_sin_cos /= torch.sqrt(torch.sum(torch.square(torsion_angles_sin_cos), dim=-1, keepdim=True) + 1e-8)
 
     # Mirror psi, because we computed it from the Oxygen-atom.
-    torsion_angles_sin_cos *= torch.tensor(
-        [1., 1., -1., 1., 1., 1., 1.], dtype=all_atom_pos.dtype, device=all_atom_pos.device
-    )[None, None, :, None]
+    torsion_angles_sin_cos *= constant_table('psi_mirror', all_atom_pos.device, all_atom_pos.dtype)[None, None, :, None]
 
     # Create alternative angles for ambiguous atom names.
-    chi_is_ambiguous = torch.tensor(residue_constants.chi_pi_periodic, dtype=all_atom_pos.dtype, device=all_atom_pos.device)
+    chi_is_ambiguous = constant_table('chi_pi_periodic', all_atom_pos.device, all_atom_pos.dtype)
     chi_is_ambiguous = chi_is_ambiguous[aatype_flat].unflatten(0, [num_batch, num_res])
     mirror_torsion_angles = torch.cat([
         torch.ones([num_batch, num_res, 3], dtype=all_atom_pos.dtype, device=all_atom_pos.device),
@@ -463,7 +515,7 @@ def torsion_angles_to_frames(
 
     # Gather the default frames for all rigid groups.
     # r3.Rigids with shape (N, 8)
-    m = torch.tensor(residue_constants.restype_rigid_group_default_frame, device=aatype.device)[aatype]
+    m = constant_table('restype_rigid_group_default_frame', aatype.device)[aatype]
     default_frames = r3.rigids_from_tensor4x4(m)
 
     # Create the rotation matrices according to the given angles (each frame is
@@ -534,7 +586,7 @@ def frames_and_literature_positions_to_atom14_pos(
     """
 
     # Pick the appropriate transform for every atom.
-    residx_to_group_idx = torch.tensor(residue_constants.restype_atom14_to_rigid_group, device=aatype.device)[aatype]
+    residx_to_group_idx = constant_table('restype_atom14_to_rigid_group', aatype.device)[aatype]
     group_mask = F.one_hot(residx_to_group_idx, num_classes=8)  # shape (N, 14, 8)
     #print(torch.stack(all_frames_to_global.rot, dim=-1).unflatten(-1, (3,3)))
 
@@ -546,14 +598,14 @@ def frames_and_literature_positions_to_atom14_pos(
     # Gather the literature atom positions for each residue.
     # r3.Vecs with shape (N, 14)
     # restype_atom14_rigid_group_positions (N, 14, 3)
-    lit_positions = r3.vecs_from_tensor(torch.tensor(residue_constants.restype_atom14_rigid_group_positions, device=aatype.device)[aatype])
+    lit_positions = r3.vecs_from_tensor(constant_table('restype_atom14_rigid_group_positions', aatype.device)[aatype])
 
     # Transform each atom from its local frame to the global frame.
     # r3.Vecs with shape (N, 14)
     pred_positions = r3.rigids_mul_vecs(map_atoms_to_global, lit_positions)
 
     # Mask out non-existing atoms.
-    mask = torch.tensor(residue_constants.restype_atom14_mask, device=aatype.device)[aatype]
+    mask = constant_table('restype_atom14_mask', aatype.device)[aatype]
     pred_positions = r3.apply_tree_vecs(lambda x: x * mask, pred_positions)
 
     return pred_positions
@@ -606,12 +658,35 @@ def atom14_to_cbeta_coords(
     assert len(atom14_positions.shape) == 3 and list(atom14_positions.shape[-2:]) == [14, 3], atom14_positions.shape
 
     gly_index = residue_constants.restype_order['G']
-    cbeta_index = [4 if x != gly_index else 1 for x in aatype]
-    cbeta_coords = atom14_positions[range(len(cbeta_index)), cbeta_index]
-    cbeta_mask = atom14_mask[range(len(cbeta_index)), cbeta_index]
+    cbeta_index = torch.where(aatype == gly_index, 1, 4)
+    res_index = torch.arange(aatype.shape[0], device=aatype.device)
+    cbeta_coords = atom14_positions[res_index, cbeta_index]
+    cbeta_mask = atom14_mask[res_index, cbeta_index]
     return cbeta_coords, cbeta_mask
 
 
+def backbone_affine_to_cbeta_coords(
+        affine,  # (N, 7) QuatAffine in tensor format
+        atom14_mask,   # (N, 14)
+        aatype    # (N)
+):
+    """Same as atom14_to_cbeta_coords on the output of backbone_affine_and_torsions_to_all_atom,
+    but places only C-beta (C-alpha for glycine), which lies in the backbone rigid group,
+    so the torsion frames are not needed."""
+    assert len(aatype.shape) == 1, aatype.shape
+    affine = quat_affine.QuatAffine(affine[:, :4], [x.squeeze(-1) for x in torch.chunk(affine[:, 4:], 3, dim=-1)])
+    backb_to_global = r3.rigids_from_quataffine(affine)
+
+    gly_index = residue_constants.restype_order['G']
+    cbeta_index = torch.where(aatype == gly_index, 1, 4)
+    lit_positions = constant_table('restype_atom14_rigid_group_positions', aatype.device)[aatype, cbeta_index]
+    exists = constant_table('restype_atom14_mask', aatype.device)[aatype, cbeta_index]
+
+    cbeta_coords = r3.vecs_to_tensor(r3.rigids_mul_vecs(backb_to_global, r3.vecs_from_tensor(lit_positions))) * exists[:, None]
+    res_index = torch.arange(aatype.shape[0], device=aatype.device)
+    return cbeta_coords, atom14_mask[res_index, cbeta_index]
+
+
 def find_optimal_renaming(
         atom14_gt_positions: torch.Tensor,  # (N, 14, 3)
         atom14_alt_gt_positions: torch.Tensor,  # (N, 14, 3)
@@ -871,7 +946,57 @@ def format_pdb_line(serial, name, resname, chain, resnum, x, y, z, element, heta
     return line
 
 
-def atom14_to_pdb_stream(stream, aatypes, atom14_coords, atom14_mask=None, bfactors=None, chain='A', serial_start=1, resnum_start=1):
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def _make_atom14_name_tables():
+    """Atom names and elements in atom14 order for each restype, shape (21, 14)."""
+    names = np.array([residue_constants.restype_name_to_atom14_names[x] for x in residue_constants.resnames], dtype=object)
+    elements = np.vectorize(lambda x: x[:1])(names).astype(object)
+    return names, elements
+
+
+ATOM14_NAMES, ATOM14_ELEMENTS = _make_atom14_name_tables()
+
+_PDB_ATOM_LINE = 'ATOM  %5d %-4s %3s %1s%4d    % 8.3f% 8.3f% 8.3f      %6s          %2s\n'
+_CIF_ATOM_LINE = 'ATOM %d %s %s . %s %s 1 %d ? %.3f %.3f %.3f 1.00 %s %d %s 1\n'
+_CIF_ATOM_SITE_HEADER = (
+    'loop_\n'
+    '_atom_site.group_PDB\n'
+    '_atom_site.id\n'
+    '_atom_site.type_symbol\n'
+    '_atom_site.label_atom_id\n'
+    '_atom_site.label_alt_id\n'
+    '_atom_site.label_comp_id\n'
+    '_atom_site.label_asym_id\n'
+    '_atom_site.label_entity_id\n'
+    '_atom_site.label_seq_id\n'
+    '_atom_site.pdbx_PDB_ins_code\n'
+    '_atom_site.Cartn_x\n'
+    '_atom_site.Cartn_y\n'
+    '_atom_site.Cartn_z\n'
+    '_atom_site.occupancy\n'
+    '_atom_site.B_iso_or_equiv\n'
+    '_atom_site.auth_seq_id\n'
+    '_atom_site.auth_asym_id\n'
+    '_atom_site.pdbx_PDB_model_num\n'
+)
+
+
+def atom14_to_atom_table(aatypes, atom14_coords, atom14_mask=None, bfactors=None, serial_start=1, resnum_start=1):
+    """Flattens atom14 representation into per-atom columns for writing coordinate files.
+
+    Accepts torch tensors or numpy arrays. Residues with unknown aatype and atoms
+    absent from the residue or masked out by atom14_mask are dropped.
+
+    Returns:
+      Dict of numpy arrays of length num_atoms with keys 'serial', 'name',
+      'element', 'resname', 'resnum', 'coords' (num_atoms, 3) and 'bfactor'
+      (None if bfactors are not provided).
+    """
     assert len(aatypes.shape) == 1, aatypes.shape
     assert len(atom14_coords.shape) == 3, atom14_coords.shape
     assert atom14_coords.shape[0] == aatypes.shape[0], (atom14_coords.shape, aatypes.shape)
@@ -883,24 +1008,53 @@ def atom14_to_pdb_stream(stream, aatypes, atom14_coords, atom14_mask=None, bfact
         assert len(bfactors.shape) == 1, bfactors.shape
         assert bfactors.shape[0] == aatypes.shape[0], (bfactors.shape[0], aatypes.shape[0])
 
-    serial = serial_start
-    for resi, aatype in enumerate(aatypes):
-        if aatype >= len(residue_constants.restypes):
-            continue
-        aa1 = residue_constants.restypes[aatype]
-        resname = residue_constants.restype_1to3[aa1]
-        for ix, name in enumerate(residue_constants.restype_name_to_atom14_names[resname]):
-            if name == '':
-                continue
-            if atom14_mask is not None and atom14_mask[resi, ix] < 1.0:
-                continue
-            x, y, z = atom14_coords[resi, ix]
-            element = name[0]
-            bfactor = None if bfactors is None else bfactors[resi]
-            pdb_line = format_pdb_line(serial, name, resname, chain, resi+resnum_start, x, y, z, element, bfactor=bfactor)
-            stream.write(pdb_line + '\n')
-            serial += 1
-    return serial
+    aatypes = _to_numpy(aatypes).astype(np.int64)
+    known = aatypes < len(residue_constants.restypes)
+    aatypes_clipped = np.where(known, aatypes, residue_constants.unk_restype_index)
+
+    mask = (ATOM14_NAMES[aatypes_clipped] != '') & known[:, None]
+    if atom14_mask is not None:
+        mask &= _to_numpy(atom14_mask) >= 1.0
+    resi, ix = np.nonzero(mask)
+
+    return {
+        'serial': np.arange(serial_start, serial_start + len(resi)),
+        'name': ATOM14_NAMES[aatypes_clipped[resi], ix],
+        'element': ATOM14_ELEMENTS[aatypes_clipped[resi], ix],
+        'resname': np.array(residue_constants.resnames, dtype=object)[aatypes_clipped[resi]],
+        'resnum': resi + resnum_start,
+        'coords': _to_numpy(atom14_coords)[resi, ix].astype(np.float64),
+        'bfactor': None if bfactors is None else _to_numpy(bfactors).astype(np.float64)[resi]
+    }
+
+
+def atom14_to_pdb_stream(stream, aatypes, atom14_coords, atom14_mask=None, bfactors=None, chain='A', serial_start=1, resnum_start=1):
+    table = atom14_to_atom_table(aatypes, atom14_coords, atom14_mask, bfactors, serial_start, resnum_start)
+    num_atoms = len(table['serial'])
+    names = [x if len(x) == 4 else ' ' + x for x in table['name'].tolist()]
+    bfactors = [''] * num_atoms if table['bfactor'] is None else [f'{x: 6.2f}' for x in table['bfactor'].tolist()]
+    x, y, z = table['coords'].T.tolist()
+    rows = zip(table['serial'].tolist(), names, table['resname'].tolist(), [chain] * num_atoms,
+               table['resnum'].tolist(), x, y, z, bfactors, table['element'].tolist())
+    stream.write(''.join([_PDB_ATOM_LINE % row for row in rows]))
+    return serial_start + num_atoms
+
+
+def atom14_to_cif_stream(stream, aatypes, atom14_coords, atom14_mask=None, bfactors=None, chain='A', serial_start=1, resnum_start=1):
+    """Same as atom14_to_pdb_stream, but writes an mmCIF _atom_site loop.
+
+    The data block header (data_xxx) is left to the caller, so several
+    structures can be written into one file as separate data blocks.
+    """
+    table = atom14_to_atom_table(aatypes, atom14_coords, atom14_mask, bfactors, serial_start, resnum_start)
+    num_atoms = len(table['serial'])
+    bfactors = ['?'] * num_atoms if table['bfactor'] is None else [f'{x:.2f}' for x in table['bfactor'].tolist()]
+    resnums = table['resnum'].tolist()
+    x, y, z = table['coords'].T.tolist()
+    rows = zip(table['serial'].tolist(), table['element'].tolist(), table['name'].tolist(), table['resname'].tolist(),
+               [chain] * num_atoms, resnums, x, y, z, bfactors, resnums, [chain] * num_atoms)
+    stream.write(_CIF_ATOM_SITE_HEADER + ''.join([_CIF_ATOM_LINE % row for row in rows]) + '#\n')
+    return serial_start + num_atoms
 
 
 def ligand_to_pdb_stream(stream, atom_types, coords, resname='LIG', resnum=1, chain='A', serial_start=1):
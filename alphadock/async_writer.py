@@ -0,0 +1,100 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+
+class AsyncWriter:
+    """Runs output writing functions (pred_to_pdb, utils.write_json, ...) in
+    background threads, so the main loop can proceed to the next sample.
+
+    At most max_pending jobs are queued, submit() blocks when the queue is full.
+    Exceptions raised by jobs are re-raised by flush() and close(). When used as
+    a context manager and the block raises, they are printed instead, so that they
+    don't replace the exception of the block.
+    """
+
+    def __init__(self, num_workers=1, max_pending=8):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='AsyncWriter')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda x: self.slots.release())
+        with self.lock:
+            self.futures = [x for x in self.futures if not x.done() or x.exception() is not None]
+            self.futures.append(future)
+        return future
+
+    def flush(self):
+        with self.lock:
+            futures, self.futures = self.futures, []
+        errors = [x.exception() for x in futures if x.exception() is not None]
+        if len(errors) > 0:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except Exception:
+            traceback.print_exc()
+
+
+def _to_cpu(x):
+    return x.detach().to('cpu', non_blocking=True)
+
+
+def pred_inputs_to_cpu(input_dict, out_dict):
+    """Copies to CPU only the tensors used by pred_to_pdb / pred_to_cif.
+
+    Returns (input_dict, out_dict) with the same layout as the originals, which
+    can be safely passed to a background writer while the model keeps running.
+    """
+    input_cpu = {'target': {'rec_aatype': _to_cpu(input_dict['target']['rec_aatype'])}}
+    if 'ground_truth' in input_dict:
+        input_cpu['ground_truth'] = {k: _to_cpu(input_dict['ground_truth'][k]) for k in ['gt_aatype', 'gt_atom14_coords', 'gt_atom14_has_coords']}
+
+    out_cpu = {
+        'final_all_atom': {'atom_pos_tensor': _to_cpu(out_dict['final_all_atom']['atom_pos_tensor'])},
+        # keep only the last structure module iteration
+        'struct_out': {'rec_lddt': _to_cpu(out_dict['struct_out']['rec_lddt'][:, -1:])}
+    }
+
+    # non-blocking copies have to complete before the tensors are handed over
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return input_cpu, out_cpu
@@ -0,0 +1,65 @@
+import time
+import threading
+import pytest
+import torch
+
+from alphadock import async_writer
+
+
+def test_async_writer_flush():
+    results = []
+
+    def job(i):
+        time.sleep(0.01)
+        results.append(i)
+
+    with async_writer.AsyncWriter(num_workers=1, max_pending=2) as writer:
+        for i in range(5):
+            writer.submit(job, i)
+        writer.flush()
+        assert results == list(range(5))
+
+
+def test_async_writer_bounded_queue():
+    release = threading.Event()
+    writer = async_writer.AsyncWriter(num_workers=1, max_pending=1)
+    writer.submit(release.wait)
+
+    blocked = threading.Thread(target=writer.submit, args=(lambda: None,))
+    blocked.start()
+    blocked.join(0.1)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join(1.0)
+    assert not blocked.is_alive()
+    writer.close()
+
+
+def test_async_writer_reraises():
+    def job():
+        raise ValueError('failed')
+
+    writer = async_writer.AsyncWriter()
+    writer.submit(job)
+    with pytest.raises(ValueError):
+        writer.close()
+
+    # the error of the block is not replaced by the job error
+    with pytest.raises(KeyError):
+        with async_writer.AsyncWriter() as writer:
+            writer.submit(job)
+            raise KeyError('block')
+
+
+def test_pred_inputs_to_cpu():
+    num_res = 5
+    inputs = {'target': {'rec_aatype': torch.zeros(1, num_res, dtype=torch.long), 'rec_1d': torch.zeros(1, num_res, 22)}}
+    output = {
+        'final_all_atom': {'atom_pos_tensor': torch.ones(num_res, 14, 3, requires_grad=True)},
+        'struct_out': {'rec_lddt': torch.rand(1, 8, num_res, 50)}
+    }
+    inputs_cpu, output_cpu = async_writer.pred_inputs_to_cpu(inputs, output)
+    assert list(inputs_cpu['target'].keys()) == ['rec_aatype']
+    assert not output_cpu['final_all_atom']['atom_pos_tensor'].requires_grad
+    assert torch.equal(output_cpu['struct_out']['rec_lddt'][0, -1], output['struct_out']['rec_lddt'][0, -1])
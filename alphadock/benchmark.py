@@ -0,0 +1,380 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sys
+import time
+import logging
+import platform
+import subprocess
+import tempfile
+import numpy as np
+import torch
+import click
+from copy import deepcopy
+from path import Path
+
+from alphadock import config
+from alphadock import dataset
+from alphadock import docker
+from alphadock import modules
+from alphadock import structure
+from alphadock import features_summit
+from alphadock import all_atom
+from alphadock import violations
+from alphadock import residue_constants
+from alphadock import r3
+from alphadock import profiling
+from alphadock import memory
+from alphadock import utils
+
+
+NUM_RES = [64, 128, 256, 512]
+
+EVOFORMER_SUBMODULES = [
+    'RowAttentionWithPairBias', 'MSAColumnAttention', 'MSATransition', 'OuterProductMean',
+    'TriangleMultiplicationOutgoing', 'TriangleMultiplicationIngoing',
+    'TriangleAttentionStartingNode', 'TriangleAttentionEndingNode', 'PairTransition'
+]
+
+
+def make_config(device, config_update_json=None):
+    """Default config with all modules on device and without cropping and MSA block deletion,
+    so that the features have exactly the requested number of residues and MSA depth"""
+    config_dict = utils.merge_dicts(deepcopy(config.config), {
+        'data': {'crop_size': None, 'use_cache': False, 'msa_block_del_num': 0},
+        'model': {
+            'Evoformer': {'device': device},
+            'InputEmbedder': {'device': device, 'ExtraMsaStack': {'device': device}},
+            'StructureModule': {'device': device}
+        }
+    })
+    if config_update_json:
+        config_dict = utils.merge_dicts(config_dict, utils.read_json(config_update_json))
+    return config_dict
+
+
+def synthetic_sequence(num_res, rng):
+    return ''.join(rng.choice(residue_constants.restypes, num_res))
+
+
+def write_synthetic_a3m(a3m_file, sequence, depth, rng, mutation_rate=0.3, gap_rate=0.1, insertion_rate=0.02):
+    """A3M with the query and depth - 1 random homologs with substitutions, gaps and insertions"""
+    restypes = np.array(residue_constants.restypes)
+    lines = ['>query', sequence]
+    query = np.array(list(sequence))
+    for i in range(1, depth):
+        seq = np.where(rng.random(len(query)) < mutation_rate, rng.choice(restypes, len(query)), query)
+        seq = np.where(rng.random(len(query)) < gap_rate, '-', seq)
+        insertions = [''.join(rng.choice(restypes, rng.integers(1, 4))).lower() if x else '' for x in rng.random(len(query)) < insertion_rate]
+        lines += [f'>hit{i}', ''.join(a + b for a, b in zip(seq, insertions))]
+    Path(a3m_file).write_text('\n'.join(lines) + '\n')
+
+
+def write_synthetic_cif(cif_file, sequence, seed=0):
+    """mmCIF with a single chain A, with the categories read by features_summit.cif_parse.
+    Residues are placed 3.8 A apart along a line with random orientations, the geometry is meaningless."""
+    rng = torch.Generator().manual_seed(seed)
+    num_res = len(sequence)
+    aatype = torch.tensor([residue_constants.restype_order[x] for x in sequence])
+    quat = torch.randn(num_res, 4, generator=rng)
+    trans = torch.zeros(num_res, 3)
+    trans[:, 0] = torch.arange(num_res) * 3.8
+    affine = torch.cat([quat / quat.norm(dim=-1, keepdim=True), trans], dim=-1)
+    torsions = torch.tensor([0., 1.]).repeat(num_res, 7)
+    atom14 = all_atom.backbone_affine_and_torsions_to_all_atom(affine, torsions, aatype)['atom_pos_tensor']
+
+    names = [residue_constants.restype_1to3[x] for x in sequence]
+    with open(cif_file, 'w') as f:
+        f.write('data_synthetic\n#\n')
+        f.write('loop_\n_entity_poly.entity_id\n_entity_poly.type\n_entity_poly.pdbx_seq_one_letter_code_can\n_entity_poly.pdbx_strand_id\n')
+        f.write(f'1 polypeptide(L) {sequence} A\n#\n')
+        f.write('loop_\n_entity_poly_seq.entity_id\n_entity_poly_seq.num\n_entity_poly_seq.mon_id\n_entity_poly_seq.hetero\n')
+        f.write(''.join(f'1 {i + 1} {x} n\n' for i, x in enumerate(names)) + '#\n')
+        f.write('loop_\n' + ''.join(f'_pdbx_poly_seq_scheme.{x}\n' for x in [
+            'asym_id', 'entity_id', 'seq_id', 'mon_id', 'ndb_seq_num', 'pdb_seq_num', 'auth_seq_num',
+            'pdb_mon_id', 'auth_mon_id', 'pdb_strand_id', 'pdb_ins_code', 'hetero']))
+        f.write(''.join(f'A 1 {i + 1} {x} {i + 1} {i + 1} {i + 1} {x} {x} A . n\n' for i, x in enumerate(names)) + '#\n')
+        all_atom.atom14_to_cif_stream(f, aatype, atom14, bfactors=torch.zeros(num_res), chain='A')
+
+
+def make_sample(data_dir, num_res, config_dict, msa_depth=None, seed=0):
+    """Writes synthetic A3M and CIF files to data_dir and featurizes them with DockingDataset.
+    msa_depth defaults to the number of MSA clusters plus extra sequences in the config.
+    Returns (a3m_file, cif_file, batch of size one)."""
+    rng = np.random.default_rng(seed)
+    if msa_depth is None:
+        msa_depth = config_dict['data']['msa_max_clusters'] + config_dict['data']['msa_max_extra']
+    sequence = synthetic_sequence(num_res, rng)
+    a3m_file, cif_file = Path(data_dir) / f'synthetic_{num_res}.a3m', Path(data_dir) / f'synthetic_{num_res}.cif'
+    write_synthetic_a3m(a3m_file, sequence, msa_depth, rng)
+    write_synthetic_cif(cif_file, sequence, seed=seed)
+    item = {'entity_info': {'pdbx_seq_one_letter_code_can': sequence, 'asym_ids': ['A']}, 'cif_file': cif_file.basename(), 'a3m_files': [a3m_file.basename()]}
+    dset = dataset.DockingDataset([item], config_dict['data'], dataset_dir=data_dir, seed=seed, shuffle=False)
+    return a3m_file, cif_file, torch.utils.data.default_collate([dset[0]])
+
+
+def to_device(batch, device):
+    return {k: {k1: v1.to(device) for k1, v1 in v.items()} for k, v in batch.items()}
+
+
+def featurize_benchmarks(sample, config_dict, device):
+    a3m_file, cif_file, _ = sample
+    data_config = config_dict['data']
+    rng = np.random.default_rng(0)
+    yield 'msa_featurize', lambda: features_summit.msa_featurize(
+        [a3m_file], rng, data_config['msa_max_clusters'], data_config['msa_max_extra'], use_cache=False,
+        num_block_del=data_config['msa_block_del_num'], block_del_size=data_config['msa_block_del_size'],
+        random_replace_fraction=data_config['msa_random_replace_fraction'], uniform_prob=data_config['msa_uniform_prob'],
+        profile_prob=data_config['msa_profile_prob'], same_prob=data_config['msa_same_prob']
+    )
+    yield 'cif_featurize', lambda: features_summit.cif_featurize(cif_file, 'A', use_cache=False)
+
+
+def evoformer_benchmarks(sample, config_dict, device):
+    """Forward pass of each submodule of one EvoformerIteration"""
+    batch = sample[2]
+    num_res, num_seq = batch['target']['rec_aatype'].shape[1], batch['msa']['main'].shape[1]
+    model_config = config_dict['model']
+    dtype = getattr(torch, model_config['trunk_dtype'])
+    block = modules.EvoformerIteration(model_config['Evoformer']['EvoformerIteration'], config_dict)
+    block.to(device=device, dtype=dtype).eval()
+    r1d = torch.randn(1, num_seq, num_res, model_config['rep1d_feat'], device=device, dtype=dtype)
+    pair = torch.randn(1, num_res, num_res, model_config['rep2d_feat'], device=device, dtype=dtype)
+
+    for name in EVOFORMER_SUBMODULES:
+        module = getattr(block, name)
+        args = (r1d, pair) if name == 'RowAttentionWithPairBias' else (r1d,) if name in ['MSAColumnAttention', 'MSATransition', 'OuterProductMean'] else (pair,)
+        yield f'evoformer.{name}', lambda module=module, args=args: no_grad(module, *args)
+    yield 'evoformer.EvoformerIteration', lambda: no_grad(block, r1d, pair)
+
+
+def structure_module_benchmarks(sample, config_dict, device):
+    num_res = sample[2]['target']['rec_aatype'].shape[1]
+    model_config = config_dict['model']
+    module = structure.StructureModule(model_config['StructureModule'], config_dict).to(device).eval()
+    inputs = {
+        'r1d': torch.randn(1, num_res, model_config['single_rep_feat'], device=device),
+        'pair': torch.randn(1, num_res, num_res, model_config['rep2d_feat'], device=device)
+    }
+    yield 'structure_module', lambda: no_grad(module, inputs)
+
+
+def loss_benchmarks(sample, config_dict, device):
+    """FAPE and structural violations of the ground truth with noise added as prediction"""
+    batch = to_device(sample[2], device)
+    gt = batch['ground_truth']
+    loss_config = config_dict['loss']
+    pred_coords = gt['gt_atom14_coords'][0] + torch.randn(gt['gt_atom14_coords'][0].shape, generator=torch.Generator().manual_seed(0)).to(device)
+
+    bb_frames = r3.rigids_from_tensor_flat12(gt['gt_rigidgroups_gt_frames'][0, :, 0])
+    bb_mask = gt['gt_rigidgroups_gt_exists'][0, :, 0]
+    yield 'fape.backbone', lambda: all_atom.frame_aligned_point_error(
+        bb_frames, bb_frames, bb_mask, bb_frames.trans, bb_frames.trans, bb_mask,
+        loss_config['fape_loss_unit_distance'], loss_config['fape_clamp_distance']
+    )
+
+    frames = r3.rigids_from_tensor_flat12(gt['gt_rigidgroups_gt_frames'][0].reshape(-1, 12))
+    frames_mask = gt['gt_rigidgroups_gt_exists'][0].flatten()
+    coords_mask = gt['gt_atom14_has_coords'][0].flatten()
+    yield 'fape.all_atom', lambda: all_atom.frame_aligned_point_error(
+        frames, frames, frames_mask,
+        r3.vecs_from_tensor(pred_coords.reshape(-1, 3)), r3.vecs_from_tensor(gt['gt_atom14_coords'][0].reshape(-1, 3)), coords_mask,
+        loss_config['fape_loss_unit_distance'], loss_config['fape_clamp_distance']
+    )
+    yield 'violations', lambda: violations.find_structural_violations(batch, pred_coords, config_dict)
+
+
+def docker_benchmarks(sample, config_dict, device):
+    """One recycling iteration of the full model, forward only as in inference
+    and forward with loss and backward as in training"""
+    batch = sample[2]
+    inference_config = utils.merge_dicts(config_dict, {'loss': {'compute_loss': False}, 'model': {'msa_bert_block': False}})
+    model = docker.DockerIteration(inference_config['model'], inference_config)
+    model.modules_to_devices()
+    model.eval()
+    yield 'docker.forward', lambda: no_grad(model, batch)
+    del model
+
+    train_config = utils.merge_dicts(config_dict, {'loss': {'compute_loss': True}, 'model': {'msa_bert_block': True}})
+    model = docker.DockerIteration(train_config['model'], train_config)
+    model.modules_to_devices()
+    model.train()
+
+    def forward_backward():
+        model.zero_grad(set_to_none=True)
+        model(batch)['loss']['loss_total'].backward()
+
+    yield 'docker.forward_backward', forward_backward
+
+
+def no_grad(fn, *args):
+    with torch.no_grad():
+        return fn(*args)
+
+
+BENCHMARKS = {
+    'featurize': featurize_benchmarks,
+    'evoformer': evoformer_benchmarks,
+    'structure_module': structure_module_benchmarks,
+    'loss': loss_benchmarks,
+    'docker': docker_benchmarks,
+}
+
+
+def measure(fn, memory, repeats=3, warmup=1):
+    """Wall time (seconds) of repeats calls of fn after warmup calls, and the peak memory
+    (bytes) during all calls, absolute and relative to the memory before the call.
+    Warmup calls are included in the memory stats, as on CPU the memory freed by
+    the first call usually stays resident and later calls don't increase RSS."""
+    times, peaks, increases = [], [], []
+    for i in range(warmup + repeats):
+        memory.synchronize()
+        memory.reset_peak()
+        start_memory = memory.current()
+        start = time.perf_counter()
+        fn()
+        memory.synchronize()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+        peaks.append(memory.peak())
+        increases.append(peaks[-1] - start_memory)
+    return {
+        'time': float(np.median(times)),
+        'time_min': min(times),
+        'time_max': max(times),
+        'repeats': repeats,
+        'peak_memory': max(peaks),
+        'peak_increase': max(increases)
+    }
+
+
+def environment(device):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).dirname(), capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'device': device,
+        'num_threads': torch.get_num_threads()
+    }
+
+
+def compare(results, baseline):
+    """Adds time_ratio (time / baseline time) to the results which are also in baseline"""
+    baseline_times = {(x['benchmark'], x['num_res']): x['time'] for x in baseline['results']}
+    for x in results:
+        key = (x['benchmark'], x['num_res'])
+        if key in baseline_times:
+            x['time_ratio'] = x['time'] / baseline_times[key]
+    return results
+
+
+def main(
+        num_res=NUM_RES,
+        benchmark=tuple(BENCHMARKS),
+        config_update_json=None,
+        msa_depth=None,
+        repeats=3,
+        warmup=1,
+        num_threads=None,
+        seed=123456,
+        out_json=None,
+        baseline_json=None,
+        gpu=False
+):
+    torch.manual_seed(seed)
+    logging.getLogger('.prody').setLevel('CRITICAL')
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    if gpu:
+        assert torch.cuda.is_available(), 'CUDA is not available'
+        device = 'cuda:0'
+    else:
+        device = 'cpu'
+    device_memory = profiling.CudaMemory(torch.device(device)) if gpu else profiling.HostMemory()
+    config_dict = make_config(device, config_update_json)
+
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for size in num_res:
+            sample = make_sample(Path(data_dir), size, config_dict, msa_depth=msa_depth, seed=seed)
+            for group in benchmark:
+                for name, fn in BENCHMARKS[group](sample, config_dict, device):
+                    stats = {'benchmark': name, 'num_res': size}
+                    stats.update(measure(fn, device_memory, repeats=repeats, warmup=warmup))
+                    estimate = ''
+                    if name == 'docker.forward':
+                        # the batch is on the CPU, so on GPU the features are copied to the device
+                        # inside the measured call and count towards the peak increase
+                        sizes = profiling.sample_sizes(sample[2])
+                        peak = memory.inference_peak_memory(sizes['num_res'], sizes['main_msa_depth'], sizes['extra_msa_depth'], config_dict)
+                        stats['estimated_peak_increase'] = peak['peak'] - (0 if gpu else peak['features'])
+                        estimate = f' (estimated {stats["estimated_peak_increase"] / 1024 ** 2:.1f} MB)'
+                    results.append(stats)
+                    print(f'{name:45} {size:5d} {stats["time"]:10.4f} s {stats["peak_increase"] / 1024 ** 2:10.1f} MB{estimate}'); sys.stdout.flush()
+            if gpu:
+                torch.cuda.empty_cache()
+
+    if baseline_json is not None:
+        compare(results, utils.read_json(baseline_json))
+        for x in results:
+            if 'time_ratio' in x:
+                print(f'{x["benchmark"]:45} {x["num_res"]:5d} {x["time_ratio"]:6.2f}x baseline')
+
+    out = {'environment': environment(device), 'config': config_dict, 'msa_depth': msa_depth, 'results': results}
+    if out_json is not None:
+        utils.write_json(out, out_json)
+    return out
+
+
+@click.command()
+@click.option('--num_res', multiple=True, default=NUM_RES, show_default=True, type=click.INT,
+              help='Number of residues of the synthetic targets')
+@click.option('--benchmark', multiple=True, default=list(BENCHMARKS), show_default=True, type=click.Choice(list(BENCHMARKS)),
+              help='Benchmark groups to run')
+@click.option('--config_update_json', type=click.Path(exists=True, dir_okay=False),
+              help='JSON containing configuration update. Will be merged with default alphafold.config.CONFIG')
+@click.option('--msa_depth', type=click.INT,
+              help='Number of sequences in the synthetic MSAs, default is msa_max_clusters + msa_max_extra')
+@click.option('--repeats', default=3, show_default=True, type=click.INT, help='Number of timed calls')
+@click.option('--warmup', default=1, show_default=True, type=click.INT, help='Number of calls before timing')
+@click.option('--num_threads', type=click.INT, help='Number of torch threads, torch default if not set')
+@click.option('--seed', default=123456, show_default=True, type=click.INT, help='Seed for synthetic inputs and random weights')
+@click.option('--out_json', type=click.Path(dir_okay=False), help='Write environment, config and results to this file')
+@click.option('--baseline_json', type=click.Path(exists=True, dir_okay=False),
+              help='Output of a previous run, times are reported relative to it')
+@click.option('--gpu/--no_gpu', default=False, show_default=True, help='Run on cuda:0 instead of CPU')
+def cli(**kwargs):
+    """Time and measure peak memory of featurization, Evoformer submodules, structure module,
+    losses and the full model on synthetic targets with random weights
+
+    Memory is process RSS on CPU (see profiling.HostMemory) and allocated memory on GPU.
+
+    \b
+    > python benchmark.py --num_res 64 --num_res 128 --out_json v1.json
+    > python benchmark.py --num_res 64 --num_res 128 --out_json v2.json --baseline_json v1.json
+    """
+    main(**kwargs)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,20 @@
+from alphadock import benchmark
+from alphadock import utils
+
+
+def test_benchmark(tmp_path):
+    config_dict = benchmark.make_config('cpu')
+    config_dict['data'].update({'msa_max_clusters': 4, 'msa_max_extra': 8})
+    a3m_file, cif_file, batch = benchmark.make_sample(tmp_path, 12, config_dict)
+    assert batch['target']['rec_aatype'].shape == (1, 12)
+    assert batch['msa']['main'].shape[:3] == (1, 4, 12) and batch['msa']['extra'].shape[:3] == (1, 8, 12)
+    assert batch['ground_truth']['gt_atom14_has_coords'][0, :, :4].sum() == 12 * 4
+
+    utils.write_json({'data': {'msa_max_clusters': 4, 'msa_max_extra': 8}}, tmp_path / 'config.json')
+    out = benchmark.main(num_res=[12], benchmark=['featurize', 'loss'], config_update_json=tmp_path / 'config.json',
+                         repeats=2, out_json=tmp_path / 'out.json')
+    assert [x['benchmark'] for x in out['results']] == ['msa_featurize', 'cif_featurize', 'fape.backbone', 'fape.all_atom', 'violations']
+    assert all(x['repeats'] == 2 and x['time_min'] <= x['time'] <= x['time_max'] for x in out['results'])
+
+    results = benchmark.compare(out['results'], utils.read_json(tmp_path / 'out.json'))
+    assert all(x['time_ratio'] == 1 for x in results)
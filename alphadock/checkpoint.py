@@ -0,0 +1,144 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import math
+import click
+import torch
+from path import Path
+
+from alphadock import async_writer
+
+
+# training checkpoints are named epoch_<epoch>_loss_<loss>.pth at the end of an epoch
+# and epoch_<epoch>_step_<global step>.pth in the middle of one
+CHECKPOINT_GLOB = 'epoch_*.pth'
+
+
+def cpu_snapshot(obj):
+    """Copy of a nested state dict with all tensors copied to CPU"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(x) for x in obj)
+    return obj
+
+
+def save_atomic(obj, path):
+    """torch.save to a temporary file which is then renamed, so path is either complete or absent"""
+    tmp = str(path) + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+def load(pth_file):
+    """torch.load with memory-mapped tensors, so only the tensors which are used
+    (e.g. model weights but not optimizer state) are read from disk, and only when they are copied.
+    Files in the legacy (non-zip) format are loaded entirely."""
+    try:
+        return torch.load(pth_file, map_location='cpu', mmap=True)
+    except RuntimeError:
+        return torch.load(pth_file, map_location='cpu')
+
+
+def load_model_state(model, pth_file, drop_keys=()):
+    """Copies model weights from pth_file (training checkpoint or exported weights)
+    directly from the memory-mapped file into the model parameters"""
+    state_dict = load(pth_file)['model_state_dict']
+    for key in drop_keys:
+        state_dict.pop(key, None)
+    model.load_state_dict(state_dict)
+
+
+def export_weights(pth_file, out_file):
+    """Saves only the model weights of a training checkpoint"""
+    save_atomic({'model_state_dict': load(pth_file)['model_state_dict']}, out_file)
+
+
+def checkpoint_order(path):
+    fields = Path(path).basename().stripext().split('_')
+    if fields[2] == 'step':
+        return int(fields[1]), int(fields[3])
+    return int(fields[1]), math.inf
+
+
+def is_mid_epoch(path):
+    return checkpoint_order(path)[1] != math.inf
+
+
+def list_checkpoints(dir):
+    """Training checkpoints in dir from the oldest to the latest"""
+    return sorted(Path(dir).glob(CHECKPOINT_GLOB), key=checkpoint_order)
+
+
+def remove_old_checkpoints(dir, keep_last=None):
+    """Removes all mid-epoch checkpoints except the latest checkpoint
+    and all but keep_last end of epoch checkpoints (if keep_last is not None)"""
+    pths = list_checkpoints(dir)
+    old = [x for x in pths[:-1] if is_mid_epoch(x)]
+    if keep_last is not None:
+        epoch_ends = [x for x in pths if not is_mid_epoch(x)]
+        old += epoch_ends[:max(len(epoch_ends) - keep_last, 0)]
+    for x in old:
+        x.remove_p()
+
+
+class CheckpointWriter:
+    """Saves training checkpoints to out_dir in a background thread.
+
+    save() copies the state to CPU and returns, so the training can proceed while
+    the file is written. At most one checkpoint is written at a time,
+    errors are re-raised by close() (see AsyncWriter).
+    """
+
+    def __init__(self, out_dir, keep_last=None):
+        self.out_dir = Path(out_dir)
+        self.keep_last = keep_last
+        self.writer = async_writer.AsyncWriter(num_workers=1, max_pending=1)
+
+    def _save(self, state, file_name):
+        save_atomic(state, self.out_dir / file_name)
+        remove_old_checkpoints(self.out_dir, self.keep_last)
+
+    def save(self, state, file_name):
+        return self.writer.submit(self._save, cpu_snapshot(state), file_name)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.writer.__exit__(exc_type, exc_val, exc_tb)
+
+
+@click.command()
+@click.argument('pth_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('out_file', type=click.Path(dir_okay=False))
+def cli(pth_file, out_file):
+    """Export model weights from a training checkpoint, without optimizer and scheduler state
+
+    \b
+    > python checkpoint.py epoch_10_loss_1.234.pth weights.pth
+    > python inference.py weights.pth --a3m_file msa.a3m
+    """
+    export_weights(pth_file, out_file)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,55 @@
+import torch
+from path import Path
+
+from alphadock import checkpoint
+
+
+def test_remove_old_checkpoints(tmp_path):
+    names = ['epoch_10_loss_nan.pth', 'epoch_3_step_0000025.pth', 'epoch_2_loss_0.400.pth', 'epoch_11_step_0000100.pth',
+             'epoch_1_loss_0.500.pth', 'epoch_3_step_0000020.pth', 'epoch_2_step_0000010.pth']
+    for name in names:
+        (Path(tmp_path) / name).touch()
+    # epochs are compared as numbers, mid-epoch checkpoints come before the end of their epoch
+    assert [x.basename() for x in checkpoint.list_checkpoints(tmp_path)] == [
+        'epoch_1_loss_0.500.pth',
+        'epoch_2_step_0000010.pth',
+        'epoch_2_loss_0.400.pth',
+        'epoch_3_step_0000020.pth',
+        'epoch_3_step_0000025.pth',
+        'epoch_10_loss_nan.pth',
+        'epoch_11_step_0000100.pth'
+    ]
+
+    checkpoint.remove_old_checkpoints(tmp_path, keep_last=2)
+    assert [x.basename() for x in checkpoint.list_checkpoints(tmp_path)] == ['epoch_2_loss_0.400.pth', 'epoch_10_loss_nan.pth', 'epoch_11_step_0000100.pth']
+
+
+def test_checkpoint_writer(tmp_path):
+    state = {'model_state_dict': {'w': torch.ones(3)}, 'loss': {'Loss_Total': [1.0]}}
+    writer = checkpoint.CheckpointWriter(tmp_path, keep_last=1)
+    writer.save(state, 'epoch_1_loss_1.000.pth')
+    # the snapshot is taken by save(), later changes are not saved
+    state['model_state_dict']['w'].zero_()
+    state['loss']['Loss_Total'].append(2.0)
+    writer.save(state, 'epoch_2_loss_0.000.pth')
+    writer.close()
+
+    assert [x.basename() for x in Path(tmp_path).listdir()] == ['epoch_2_loss_0.000.pth']
+    saved = torch.load(Path(tmp_path) / 'epoch_2_loss_0.000.pth')
+    assert torch.equal(saved['model_state_dict']['w'], torch.zeros(3))
+    assert saved['loss']['Loss_Total'] == [1.0, 2.0]
+
+
+def test_export_and_load_weights(tmp_path):
+    model = torch.nn.Linear(3, 2)
+    optimizer = torch.optim.Adam(model.parameters())
+    model(torch.ones(3)).sum().backward()
+    optimizer.step()
+    torch.save({'model_state_dict': model.state_dict(), 'optimizer_state_dict': optimizer.state_dict()}, tmp_path / 'epoch_1_loss_0.000.pth')
+
+    checkpoint.export_weights(tmp_path / 'epoch_1_loss_0.000.pth', tmp_path / 'weights.pth')
+    assert list(torch.load(tmp_path / 'weights.pth').keys()) == ['model_state_dict']
+
+    loaded = torch.nn.Linear(3, 2)
+    checkpoint.load_model_state(loaded, tmp_path / 'weights.pth')
+    assert torch.equal(loaded.weight, model.weight) and torch.equal(loaded.bias, model.bias)
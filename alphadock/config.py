@@ -82,12 +82,19 @@ config = {
         'single_rep_feat': 384,
         'rep1d_extra_feat': 64,
         'msa_bert_block': True,
+        'chunk_size': None,  # evaluate attention / transitions in chunks to reduce peak memory
+        'trunk_dtype': 'float32',  # dtype of InputEmbedder and Evoformer: float32, bfloat16 (inference only), float16 (GPU inference only)
+        'attention_backend': 'einsum',  # einsum, sdpa, chunked or auto (sdpa if available, otherwise chunked), see modules.attention
+        'attention_key_chunk_size': 512,  # key chunk size for the chunked backend
+        'checkpoint_memory_budget': None,  # GB of trunk activations for checkpoint policy 'auto'
+        'nan_hooks': False,  # raise GeneratedNans as soon as an Evoformer submodule outputs nans (slow, syncs with the device)
 
         'Evoformer': {
             'num_iter': 48,
             'device': 'cuda:0',
             'EvoformerIteration': {
-                'checkpoint': True,
+                'checkpoint': True,  # True, False or one of modules.CHECKPOINT_POLICIES, or 'auto'
+                'checkpoint_every': 1,  # checkpoint only every k-th block
                 'RowAttentionWithPairBias': {
                     'attention_num_c': 32,
                     'num_heads': 8,
@@ -139,6 +146,7 @@ config = {
                 'device': 'cuda:0',
                 'ExtraMsaStackIteration': {
                     'checkpoint': True,
+                    'checkpoint_every': 1,
                     'RowAttentionWithPairBias': {
                         'attention_num_c': 8,
                         'num_heads': 8,
@@ -0,0 +1,231 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import contextlib
+import itertools
+import torch
+
+
+BACKENDS = ['none', 'horovod', 'torch']
+
+
+class SingleProcess:
+    """Multi-process training backend interface, this one is a no-op for a single process.
+
+    Gradients are averaged explicitly by synchronize(optimizer) after the backward
+    pass, the optimizer step must then be done inside skip_synchronize(optimizer).
+    """
+    rank = 0
+    local_rank = 0
+    size = 1
+
+    def broadcast_object(self, obj, root_rank=0):
+        return obj
+
+    def allgather_object(self, obj):
+        return [obj]
+
+    def broadcast_parameters(self, state_dict, root_rank=0):
+        pass
+
+    def broadcast_optimizer_state(self, optimizer, root_rank=0):
+        pass
+
+    def distributed_optimizer(self, optimizer, model, fp16_compression=False):
+        return optimizer
+
+    def synchronize(self, optimizer):
+        pass
+
+    def skip_synchronize(self, optimizer):
+        return contextlib.nullcontext()
+
+    def sampler(self, dset, start=0):
+        """Sampler giving each process its share of dset, None for a single process.
+        If start > 0, each process skips its first start samples (to resume an epoch)."""
+        if self.size == 1:
+            sampler = None if start == 0 else torch.utils.data.SequentialSampler(dset)
+        else:
+            sampler = torch.utils.data.distributed.DistributedSampler(dset, num_replicas=self.size, rank=self.rank, shuffle=False)
+        if start > 0:
+            sampler = ResumedSampler(sampler, start)
+        return sampler
+
+
+class ResumedSampler(torch.utils.data.Sampler):
+    """Skips the first start indices of sampler"""
+
+    def __init__(self, sampler, start):
+        self.sampler = sampler
+        self.start = start
+
+    def __iter__(self):
+        return itertools.islice(iter(self.sampler), self.start, None)
+
+    def __len__(self):
+        return max(len(self.sampler) - self.start, 0)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+
+class Horovod(SingleProcess):
+    """Horovod backend. Gradients are averaged over flat buckets of bucket_numel elements
+    in synchronize() rather than by hvd.DistributedOptimizer, whose backward hooks start
+    averaging while the gradients of the last accumulated sample can still be dropped."""
+
+    def __init__(self, bucket_numel=2 ** 24):
+        import horovod.torch as hvd
+        hvd.init()
+        self.hvd = hvd
+        self.rank = hvd.rank()
+        self.local_rank = hvd.local_rank()
+        self.size = hvd.size()
+        self.bucket_numel = bucket_numel
+        self.fp16_compression = False
+
+    def broadcast_object(self, obj, root_rank=0):
+        return self.hvd.broadcast_object(obj, root_rank=root_rank)
+
+    def allgather_object(self, obj):
+        return self.hvd.allgather_object(obj)
+
+    def broadcast_parameters(self, state_dict, root_rank=0):
+        self.hvd.broadcast_parameters(state_dict, root_rank=root_rank)
+
+    def broadcast_optimizer_state(self, optimizer, root_rank=0):
+        self.hvd.broadcast_optimizer_state(optimizer, root_rank=root_rank)
+
+    def distributed_optimizer(self, optimizer, model, fp16_compression=False):
+        self.fp16_compression = fp16_compression
+        return optimizer
+
+    def synchronize(self, optimizer):
+        """Averages gradients of all optimized parameters across processes.
+        Missing gradients (e.g. after an exception in this process) are treated as zeros."""
+        handles = []
+        for i, grads in enumerate(_grad_buckets(optimizer, self.bucket_numel)):
+            flat = _flatten(grads, self.fp16_compression)
+            handles.append((grads, flat, self.hvd.allreduce_async_(flat, op=self.hvd.Average, name=f'grad_bucket.{i}')))
+        for grads, flat, handle in handles:
+            self.hvd.synchronize(handle)
+            _unflatten(flat, grads)
+
+
+def _grad_buckets(optimizer, bucket_numel):
+    """Gradients of the optimized parameters split into lists of the same dtype
+    and at most bucket_numel elements (unless a single gradient is larger), missing ones are zeroed"""
+    params = [p for group in optimizer.param_groups for p in group['params'] if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    buckets = []
+    numel = 0
+    for p in params:
+        if len(buckets) == 0 or buckets[-1][0].dtype != p.grad.dtype or numel + p.grad.numel() > bucket_numel:
+            buckets.append([])
+            numel = 0
+        buckets[-1].append(p.grad)
+        numel += p.grad.numel()
+    return buckets
+
+
+def _flatten(grads, fp16_compression):
+    flat = torch.cat([x.reshape(-1) for x in grads])
+    return flat.half() if fp16_compression else flat
+
+
+def _unflatten(flat, grads):
+    flat = flat.to(grads[0].dtype)
+    offset = 0
+    for x in grads:
+        x.copy_(flat[offset:offset + x.numel()].view_as(x))
+        offset += x.numel()
+
+
+def _map_tensors(obj, fn):
+    if isinstance(obj, torch.Tensor):
+        return fn(obj)
+    if isinstance(obj, dict):
+        return {k: _map_tensors(v, fn) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_map_tensors(x, fn) for x in obj)
+    return obj
+
+
+class TorchDistributed(SingleProcess):
+    """torch.distributed backend, NCCL on GPU and gloo on CPU.
+
+    Process group is initialized from environment variables
+    (MASTER_ADDR, MASTER_PORT, RANK, WORLD_SIZE, LOCAL_RANK) set by torchrun.
+    Gradients are summed with all_reduce over flat buckets of bucket_numel elements.
+    """
+
+    def __init__(self, gpu=True, bucket_numel=2 ** 24):
+        import torch.distributed as dist
+        self.dist = dist
+        self.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        if gpu:
+            torch.cuda.set_device(self.local_rank)
+        dist.init_process_group('nccl' if gpu else 'gloo')
+        self.rank = dist.get_rank()
+        self.size = dist.get_world_size()
+        self.bucket_numel = bucket_numel
+        self.fp16_compression = False
+
+    def broadcast_object(self, obj, root_rank=0):
+        # tensors are moved to cpu, otherwise they are unpickled on the device of the root rank
+        buf = [_map_tensors(obj, lambda x: x.cpu()) if self.rank == root_rank else None]
+        self.dist.broadcast_object_list(buf, src=root_rank)
+        return buf[0]
+
+    def allgather_object(self, obj):
+        out = [None] * self.size
+        self.dist.all_gather_object(out, _map_tensors(obj, lambda x: x.cpu()))
+        return out
+
+    def broadcast_parameters(self, state_dict, root_rank=0):
+        for value in state_dict.values():
+            self.dist.broadcast(value, src=root_rank)
+
+    def broadcast_optimizer_state(self, optimizer, root_rank=0):
+        state = self.broadcast_object(optimizer.state_dict(), root_rank=root_rank)
+        if self.rank != root_rank:
+            optimizer.load_state_dict(state)
+
+    def distributed_optimizer(self, optimizer, model, fp16_compression=False):
+        # gradients are only averaged when synchronize is called, so accumulation needs no bookkeeping
+        self.fp16_compression = fp16_compression
+        return optimizer
+
+    def synchronize(self, optimizer):
+        """Averages gradients of all optimized parameters across processes.
+        Missing gradients (e.g. after an exception in this process) are treated as zeros."""
+        for grads in _grad_buckets(optimizer, self.bucket_numel):
+            flat = _flatten(grads, self.fp16_compression)
+            self.dist.all_reduce(flat)
+            _unflatten(flat.to(grads[0].dtype) / self.size, grads)
+
+
+def make_backend(name, gpu=True):
+    if name == 'horovod':
+        return Horovod()
+    if name == 'torch':
+        return TorchDistributed(gpu=gpu)
+    assert name == 'none', f'Unknown distributed backend {name}, expected one of {BACKENDS}'
+    return SingleProcess()
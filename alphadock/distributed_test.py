@@ -0,0 +1,56 @@
+import os
+import socket
+import torch
+import torch.multiprocessing as mp
+
+from alphadock import distributed
+
+
+def _worker(rank, size, port, results):
+    os.environ.update({'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port), 'RANK': str(rank), 'WORLD_SIZE': str(size), 'LOCAL_RANK': str(rank)})
+    backend = distributed.TorchDistributed(gpu=False, bucket_numel=5)
+    torch.manual_seed(rank)
+    model = torch.nn.Sequential(torch.nn.Linear(3, 2), torch.nn.Linear(2, 1))
+    optimizer = torch.optim.Adam(model.parameters())
+    backend.broadcast_parameters(model.state_dict())
+    model(torch.full((1, 3), float(rank + 1))).sum().backward()
+    model[1].bias.grad = None  # missing gradient counts as zero
+    local_grads = [p.grad.clone() if p.grad is not None else torch.zeros_like(p) for p in model.parameters()]
+    backend.synchronize(optimizer)
+    results[rank] = {
+        'params': [p.detach().clone() for p in model.parameters()],
+        'local_grads': local_grads,
+        'grads': [p.grad.clone() for p in model.parameters()],
+        'gathered': backend.allgather_object({'rank': rank}),
+        'broadcast': backend.broadcast_object(torch.tensor([rank]), root_rank=1)
+    }
+    backend.dist.destroy_process_group()
+
+
+def test_torch_distributed():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    results = mp.Manager().dict()
+    mp.spawn(_worker, args=(2, port, results), nprocs=2)
+
+    a, b = results[0], results[1]
+    assert all(torch.equal(x, y) for x, y in zip(a['params'], b['params']))
+    for ga, gb, la, lb in zip(a['grads'], b['grads'], a['local_grads'], b['local_grads']):
+        assert torch.equal(ga, gb)
+        assert torch.allclose(ga, (la + lb) / 2)
+    assert a['gathered'] == [{'rank': 0}, {'rank': 1}]
+    assert a['broadcast'].item() == 1 and b['broadcast'].item() == 1
+
+
+def test_resumed_sampler():
+    dset = list(range(10))
+    assert distributed.SingleProcess().sampler(dset) is None
+    assert list(distributed.SingleProcess().sampler(dset, start=7)) == [7, 8, 9]
+
+    backend = distributed.SingleProcess()
+    backend.rank, backend.size = 1, 3
+    full = list(backend.sampler(dset))
+    resumed = backend.sampler(dset, start=2)
+    resumed.set_epoch(1)
+    assert list(resumed) == full[2:] and len(resumed) == len(full) - 2
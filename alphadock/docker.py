@@ -15,15 +15,15 @@
 
 import torch
 from torch import nn
-from torch.utils.checkpoint import checkpoint
 import sys
-from copy import copy
 
 from alphadock import modules
 from alphadock import structure
 from alphadock import all_atom
 from alphadock import loss
 from alphadock import utils
+from alphadock import memory
+from alphadock import profiling
 
 
 class DockerIteration(nn.Module):
@@ -39,6 +39,13 @@ class DockerIteration(nn.Module):
 
         self.config = config
         self.global_config = global_config
+        self.set_checkpoint_policy()
+
+        # input embedder and evoformer can run in reduced precision,
+        # structure module geometry always runs in float32
+        self.trunk_dtype = getattr(torch, config['trunk_dtype'])
+        self.InputEmbedder.to(self.trunk_dtype)
+        self.Evoformer.to(self.trunk_dtype)
 
         def nan_hook(self, input, output):
             if any([torch.any(torch.isnan(x)) for x in output]):
@@ -50,9 +57,27 @@ class DockerIteration(nn.Module):
                 sys.stdout.flush()
                 raise utils.GeneratedNans(f'Module {self.man_name} generated nans')
 
-        for name, module in self.Evoformer.named_modules():
-            module.man_name = name
-            module.register_forward_hook(nan_hook)
+        # every hook call synchronizes with the device, so they are off by default
+        if config['nan_hooks']:
+            for name, module in self.Evoformer.named_modules():
+                module.man_name = name
+                module.register_forward_hook(nan_hook)
+
+    def set_checkpoint_policy(self):
+        """Sets activation checkpointing of Evoformer and extra MSA stack blocks from the config.
+        Policy 'auto' is chosen from model.checkpoint_memory_budget (GB) and the crop size."""
+        evo_config = self.config['Evoformer']['EvoformerIteration']
+        extra_config = self.config['InputEmbedder']['ExtraMsaStack']['ExtraMsaStackIteration']
+        auto = None
+        for blocks, config in [(self.Evoformer, evo_config), (self.InputEmbedder.ExtraMsaStack.layers, extra_config)]:
+            policy, every = config['checkpoint'], config['checkpoint_every']
+            if policy == 'auto':
+                if auto is None:
+                    assert self.config['checkpoint_memory_budget'] is not None, 'checkpoint_memory_budget is required for auto checkpointing'
+                    auto = memory.choose_checkpoint_policy(self.global_config, self.config['checkpoint_memory_budget'] * 1024 ** 3)
+                    print('Selected checkpointing policy', auto)
+                policy, every = auto
+            modules.set_checkpoint_policy(blocks, policy, every)
 
     def modules_to_devices(self):
         self.InputEmbedder.modules_to_devices()
@@ -62,40 +87,66 @@ class DockerIteration(nn.Module):
         if self.config['msa_bert_block']:
             self.MSA_BERT.to(self.config['Evoformer']['device'])
 
-    def forward(self, input, recycling=None):
-        x = self.InputEmbedder(input, recycling=recycling)
+    def prepare_inputs(self, input):
+        """Moves input features to the devices and computes the recycling invariant
+        part of the embedding. The result can be passed to forward() as context
+        for all recycling iterations of the sample."""
+        with profiling.section('InputEmbedder.embed_invariant'):
+            embedded = self.InputEmbedder.embed_invariant(input)
+        return {
+            'embedded': embedded,
+            'input': {k: {k1: v1.to(self.config['StructureModule']['device']) for k1, v1 in v.items()} for k, v in input.items()}
+        }
+
+    def forward(self, input, recycling=None, intermediate=False, context=None):
+        """If intermediate is True, the output of this recycling iteration is only used
+        as recycling input for the next one. In this case only out_dict['recycling_input']
+        is returned and structure module heads, all-atom coordinates and loss are skipped.
+
+        context is the output of prepare_inputs(input), if not provided it is computed here."""
+        if context is None:
+            context = self.prepare_inputs(input)
+
+        x = self.InputEmbedder(input, recycling=recycling, embedded=context['embedded'])
 
         x['r1d'], x['pair'] = x['r1d'].to(self.config['Evoformer']['device']), x['pair'].to(self.config['Evoformer']['device'])
 
         for evo_i, evo_iter in enumerate(self.Evoformer):
-            if self.config['Evoformer']['EvoformerIteration']['checkpoint']:
-                x['r1d'], x['pair'] = checkpoint(evo_iter, x['r1d'], x['pair'])
-            else:
-                x['r1d'], x['pair'] = evo_iter(x['r1d'], x['pair'])
+            x['r1d'], x['pair'] = evo_iter(x['r1d'], x['pair'])
 
         pair = x['pair']
-        rec_single = self.EvoformerExtractSingle(x['r1d'][:, 0])
+        rec_single = self.EvoformerExtractSingle(x['r1d'][:, 0].float())
 
         msa_bert = None
-        if self.config['msa_bert_block'] and 'main_mask' in input['msa']:
-            msa_bert = self.MSA_BERT(x['r1d'])
+        if self.config['msa_bert_block'] and 'main_mask' in input['msa'] and not intermediate:
+            msa_bert = self.MSA_BERT(x['r1d'].float())
 
-        input = {k: {k1: v1.to(self.config['StructureModule']['device']) for k1, v1 in v.items()} for k, v in input.items()}
+        input = context['input']
         struct_out = self.StructureModule({
             'r1d': rec_single.to(self.config['StructureModule']['device']),
-            'pair': pair.to(self.config['StructureModule']['device'])
-        })
+            'pair': pair.to(self.config['StructureModule']['device']).float()
+        }, compute_heads=not intermediate)
 
         # rescale to angstroms
         struct_out['rec_T'][..., -3:] = struct_out['rec_T'][..., -3:] * self.global_config['model']['position_scale']
 
+        if intermediate:
+            with profiling.section('all_atom'):
+                cbeta_coords, cbeta_mask = all_atom.backbone_affine_to_cbeta_coords(
+                    struct_out['rec_T'][0][-1],
+                    input['target']['rec_atom14_atom_exists'][0],
+                    input['target']['rec_aatype'][0]
+                )
+            return {'recycling_input': self._make_recycling_input(x, pair, cbeta_coords, cbeta_mask)}
+
         # compute all atom representation
         assert struct_out['rec_T'].shape[0] == 1
-        final_all_atom = all_atom.backbone_affine_and_torsions_to_all_atom(
-            struct_out['rec_T'][0][-1].clone(),
-            struct_out['rec_torsions'][0][-1],
-            input['target']['rec_aatype'][0]
-        )
+        with profiling.section('all_atom'):
+            final_all_atom = all_atom.backbone_affine_and_torsions_to_all_atom(
+                struct_out['rec_T'][0][-1].clone(),
+                struct_out['rec_torsions'][0][-1],
+                input['target']['rec_aatype'][0]
+            )
 
         out_dict = {}
         out_dict['struct_out'] = struct_out
@@ -103,23 +154,29 @@ class DockerIteration(nn.Module):
 
         # compute loss
         if self.global_config['loss']['compute_loss']:
-            out_dict['loss'] = loss.total_loss(input, struct_out, final_all_atom, self.global_config, msa_bert=msa_bert)
+            with profiling.section('loss'):
+                out_dict['loss'] = loss.total_loss(input, struct_out, final_all_atom, self.global_config, msa_bert=msa_bert)
 
         # make recycling input
-        cbeta_coords, cbeta_mask = all_atom.atom14_to_cbeta_coords(
-            final_all_atom['atom_pos_tensor'],
-            input['target']['rec_atom14_atom_exists'][0],
-            input['target']['rec_aatype'][0]
-        )
-        out_dict['recycling_input'] = {
+        with profiling.section('all_atom'):
+            cbeta_coords, cbeta_mask = all_atom.atom14_to_cbeta_coords(
+                final_all_atom['atom_pos_tensor'],
+                input['target']['rec_atom14_atom_exists'][0],
+                input['target']['rec_aatype'][0]
+            )
+        out_dict['recycling_input'] = self._make_recycling_input(x, pair, cbeta_coords, cbeta_mask)
+
+        return out_dict
+
+    @staticmethod
+    def _make_recycling_input(x, pair, cbeta_coords, cbeta_mask):
+        return {
             'rec_1d_prev': x['r1d'][:, 0],
             'rep_2d_prev': pair,
             'rec_cbeta_prev': cbeta_coords[None],
             'rec_mask_prev': cbeta_mask[None]
         }
 
-        return out_dict
-
 
 if __name__ == '__main__':
     pass
@@ -25,12 +25,20 @@ from tqdm import tqdm
 import traceback
 import socket
 import click
+import contextlib
 
 from alphadock import docker
+from alphadock import modules
 from alphadock import config
 from alphadock import dataset
 from alphadock import all_atom
 from alphadock import utils
+from alphadock import async_writer
+from alphadock import scheduler
+from alphadock import quantization
+from alphadock import checkpoint
+from alphadock import profiling
+from alphadock import memory
 
 import torchvision
 from torch.optim.lr_scheduler import ReduceLROnPlateau
@@ -42,30 +50,71 @@ HOROVOD_RANK = 0
 hvd = None
 
 
+def pred_to_pdb_stream(stream, name, input_dict, out_dict):
+    stream.write(f'HEADER {name}.pred\n')
+    all_atom.atom14_to_pdb_stream(
+        stream,
+        input_dict['target']['rec_aatype'][0].cpu(),
+        out_dict['final_all_atom']['atom_pos_tensor'].detach().cpu(),
+        bfactors=out_dict['struct_out']['rec_lddt'][0, -1].detach().cpu().argmax(dim=-1) + 50,
+        chain='A',
+        serial_start=1,
+        resnum_start=1
+    )
+    if 'ground_truth' in input_dict:
+        stream.write(f'HEADER {name}.crys\n')
+        all_atom.atom14_to_pdb_stream(
+            stream,
+            input_dict['ground_truth']['gt_aatype'][0].cpu(),
+            input_dict['ground_truth']['gt_atom14_coords'][0].detach().cpu(),
+            atom14_mask=input_dict['ground_truth']['gt_atom14_has_coords'][0].detach().cpu(),
+            chain='A',
+            serial_start=1,
+            resnum_start=1
+        )
+
+
 def pred_to_pdb(out_pdb, input_dict, out_dict):
     out_pdb = Path(out_pdb)
     with open(out_pdb, 'w') as f:
-        f.write(f'HEADER {out_pdb.basename().stripext()}.pred\n')
-        all_atom.atom14_to_pdb_stream(
-            f,
-            input_dict['target']['rec_aatype'][0].cpu(),
-            out_dict['final_all_atom']['atom_pos_tensor'].detach().cpu(),
-            bfactors=out_dict['struct_out']['rec_lddt'][0, -1].detach().cpu().argmax(dim=-1) + 50,
+        pred_to_pdb_stream(f, out_pdb.basename().stripext(), input_dict, out_dict)
+
+
+def pred_to_cif_stream(stream, name, input_dict, out_dict):
+    stream.write(f'data_{name}.pred\n#\n')
+    all_atom.atom14_to_cif_stream(
+        stream,
+        input_dict['target']['rec_aatype'][0].cpu(),
+        out_dict['final_all_atom']['atom_pos_tensor'].detach().cpu(),
+        bfactors=out_dict['struct_out']['rec_lddt'][0, -1].detach().cpu().argmax(dim=-1) + 50,
+        chain='A',
+        serial_start=1,
+        resnum_start=1
+    )
+    if 'ground_truth' in input_dict:
+        stream.write(f'data_{name}.crys\n#\n')
+        all_atom.atom14_to_cif_stream(
+            stream,
+            input_dict['ground_truth']['gt_aatype'][0].cpu(),
+            input_dict['ground_truth']['gt_atom14_coords'][0].detach().cpu(),
+            atom14_mask=input_dict['ground_truth']['gt_atom14_has_coords'][0].detach().cpu(),
             chain='A',
             serial_start=1,
             resnum_start=1
         )
-        if 'ground_truth' in input_dict:
-            f.write(f'HEADER {out_pdb.basename().stripext()}.crys\n')
-            all_atom.atom14_to_pdb_stream(
-                f,
-                input_dict['ground_truth']['gt_aatype'][0].cpu(),
-                input_dict['ground_truth']['gt_atom14_coords'][0].detach().cpu(),
-                atom14_mask=input_dict['ground_truth']['gt_atom14_has_coords'][0].detach().cpu(),
-                chain='A',
-                serial_start=1,
-                resnum_start=1
-            )
+
+
+def pred_to_cif(out_cif, input_dict, out_dict):
+    out_cif = Path(out_cif)
+    with open(out_cif, 'w') as f:
+        pred_to_cif_stream(f, out_cif.basename().stripext(), input_dict, out_dict)
+
+
+def plddt_from_logits(lddt_logits):
+    """Expected per-residue LDDT (0-100) from PredictLDDT logits (..., num_bins)."""
+    num_bins = lddt_logits.shape[-1]
+    bin_centers = (torch.arange(num_bins, device=lddt_logits.device, dtype=torch.float32) + 0.5) / num_bins
+    return torch.sum(torch.softmax(lddt_logits.float(), dim=-1) * bin_centers, dim=-1) * 100
 
 
 def add_loss_to_stats(stats, output):
@@ -101,30 +150,83 @@ def add_loss_to_stats(stats, output):
     return stats
 
 
-def report_step(input, output, global_stats, out_dir):
-    stats = {}
+def report_step(input, output, out_dir, out_format='pdb', writer=None, stats=None):
+    stats = {} if stats is None else stats
     if 'loss' in output:
         add_loss_to_stats(stats, output)
+    if 'num_recycles' in output:
+        stats['Num_Recycles'] = output['num_recycles']
 
     sample_idx = input["target"]["ix"].item()
-    pred_to_pdb(Path(out_dir).mkdir_p() / f'prediction_{sample_idx:06d}.pdb', input, output)
+    pred_fn = pred_to_cif if out_format == 'cif' else pred_to_pdb
+    pred_path = Path(out_dir).mkdir_p() / f'prediction_{sample_idx:06d}.{out_format}'
+    if writer is not None:
+        writer.submit(pred_fn, pred_path, *async_writer.pred_inputs_to_cpu(input, output))
+    else:
+        pred_fn(pred_path, input, output)
 
-    if 'loss' in output:
-        utils.write_json(stats, Path(out_dir).mkdir_p() / f'{sample_idx:06d}.json')
+    if len(stats) > 0:
+        if writer is not None:
+            writer.submit(utils.write_json, stats.copy(), Path(out_dir).mkdir_p() / f'{sample_idx:06d}.json')
+        else:
+            utils.write_json(stats, Path(out_dir).mkdir_p() / f'{sample_idx:06d}.json')
 
-    if HOROVOD:
-        all_stats = hvd.allgather_object(stats)
+    return stats
+
+
+def mean_plddt(output):
+    return plddt_from_logits(output['struct_out']['rec_lddt'][0, -1]).mean().item()
+
+
+def predict_ensemble(models, inputs, num_recycles, out_dir, out_format='pdb', writer=None, **kwargs):
+    """Runs every model of the ensemble {name: model} on the same features.
+
+    Writes prediction of each model as prediction_<idx>_<name>, the one with the
+    highest mean pLDDT also as prediction_<idx> together with its stats (see report_step),
+    and the ranking as ranking_<idx>.json. Returns stats of the top ranked model."""
+    sample_idx = inputs['target']['ix'].item()
+    pred_fn = pred_to_cif if out_format == 'cif' else pred_to_pdb
+    # features are moved to the device once for all models
+    device = next(iter(models.values())).config['StructureModule']['device']
+    inputs = {k: {k1: v1.to(device) for k1, v1 in v.items()} for k, v in inputs.items()}
+
+    plddts = {}
+    best = None
+    for name, model in models.items():
+        output = predict_with_oom_retry(model, inputs, num_recycles, **kwargs)
+        plddts[name] = mean_plddt(output)
+        pred_path = Path(out_dir).mkdir_p() / f'prediction_{sample_idx:06d}_{name}.{out_format}'
+        if writer is not None:
+            writer.submit(pred_fn, pred_path, *async_writer.pred_inputs_to_cpu(inputs, output))
+        else:
+            pred_fn(pred_path, inputs, output)
+        # only the best output so far is kept
+        if best is None or plddts[name] > plddts[best[0]]:
+            best = name, output
+
+    ranking = {'plddts': plddts, 'order': sorted(plddts, key=lambda x: -plddts[x])}
+    if writer is not None:
+        writer.submit(utils.write_json, ranking, Path(out_dir) / f'ranking_{sample_idx:06d}.json')
     else:
-        all_stats = [stats]
+        utils.write_json(ranking, Path(out_dir) / f'ranking_{sample_idx:06d}.json')
+    return report_step(inputs, best[1], out_dir, out_format=out_format, writer=writer, stats={'Mean_pLDDT': plddts[best[0]]})
 
-    if HOROVOD_RANK == 0:
-        for idx, case_stats in enumerate(all_stats):
-            for key, val in case_stats.items():
-                if key not in global_stats:
-                    global_stats[key] = []
-                global_stats[key].append(val)
 
-    return all_stats
+def gather_stats(local_stats):
+    # ranks may process different number of targets, so the stats
+    # are gathered once at the end instead of after every step
+    if HOROVOD:
+        all_stats = sum(hvd.allgather_object(local_stats), [])
+    else:
+        all_stats = local_stats
+
+    global_stats = {}
+    for case_stats in all_stats:
+        for key, val in case_stats.items():
+            if key not in global_stats:
+                global_stats[key] = []
+            global_stats[key].append(val)
+    return global_stats
 
 
 def parse_fasta(fasta):
@@ -159,6 +261,103 @@ def print_input_shapes(inputs):
     sys.stdout.flush()
 
 
+def make_config(device, extra_msa_size=4096, config_update_json=None, trunk_dtype='float32'):
+    # remove checkpointing to get rid of the grad is none warning
+    config_dict = deepcopy(config.config)
+    config_dict = utils.merge_dicts(config_dict, {
+        'data': {
+            'crop_size': None,
+            'msa_max_extra': extra_msa_size,
+            'use_cache': False,
+            'msa_block_del_num': 0,
+            'msa_keep_true_msa': False
+        },
+        'loss': {
+            'compute_loss': False
+        },
+        'model': {
+            'msa_bert_block': False,
+            'trunk_dtype': trunk_dtype,
+            'Evoformer': {'device': device, 'EvoformerIteration': {'checkpoint': False}},
+            'InputEmbedder': {'device': device, 'ExtraMsaStack': {'device': device, 'ExtraMsaStackIteration': {'checkpoint': False}}},
+            'StructureModule': {'device': device}
+        }
+    })
+
+    if config_update_json:
+        config_dict = utils.merge_dicts(config_dict, utils.read_json(config_update_json))
+    return config_dict
+
+
+def load_model_state(model, model_pth, device):
+    print('Loading saved model from', model_pth)
+    # MSA BERT head is not used in inference
+    checkpoint.load_model_state(model, model_pth, drop_keys=['MSA_BERT.weight', 'MSA_BERT.bias'])
+
+
+def recycling_change(prev_recycling, recycling):
+    """RMS change (Angstroms) of the C-beta distance matrix between two recycling inputs"""
+    mask = prev_recycling['rec_mask_prev'][0] * recycling['rec_mask_prev'][0]
+    mask_2d = mask[:, None] * mask[None, :]
+    prev_dmat = torch.cdist(prev_recycling['rec_cbeta_prev'][0], prev_recycling['rec_cbeta_prev'][0])
+    dmat = torch.cdist(recycling['rec_cbeta_prev'][0], recycling['rec_cbeta_prev'][0])
+    return torch.sqrt(torch.sum(torch.square(dmat - prev_dmat) * mask_2d) / (torch.sum(mask_2d) + 1e-6)).item()
+
+
+def predict(model, inputs, num_recycles, recycling_tol=None):
+    """Runs up to num_recycles recycling iterations. If recycling_tol is set, stops
+    as soon as the C-beta distance matrix changes by less than recycling_tol
+    between two successive iterations. output['num_recycles'] is the number of
+    iterations used."""
+    output = None
+    context = model.prepare_inputs(inputs)
+    for recycle_iter in range(num_recycles):
+        prev_output = output
+        # with early exit any iteration can turn out to be the last one
+        intermediate = recycling_tol is None and recycle_iter < num_recycles - 1
+        output = model(
+            inputs,
+            recycling=prev_output['recycling_input'] if prev_output is not None else None,
+            intermediate=intermediate,
+            context=context
+        )
+        output['num_recycles'] = recycle_iter + 1
+        if recycling_tol is not None and prev_output is not None:
+            output['recycling_change'] = recycling_change(prev_output['recycling_input'], output['recycling_input'])
+            if output['recycling_change'] < recycling_tol:
+                break
+    return output
+
+
+def predict_with_oom_retry(model, inputs, num_recycles, chunk_sizes=(), recycling_tol=None, memory_budget=None):
+    """Runs predict() and if it runs out of memory, retries with
+    progressively smaller chunk sizes (see modules.set_chunk_size).
+
+    If memory_budget (bytes, without model parameters) is set, the first attempt uses
+    the largest chunk size which fits into it according to memory.choose_chunk_size."""
+    default_chunk_size = model.global_config['model']['chunk_size']
+    first_chunk_size = default_chunk_size
+    if memory_budget is not None:
+        sizes = profiling.sample_sizes(inputs)
+        first_chunk_size, peak = memory.choose_chunk_size(
+            model.global_config, memory_budget, sizes['num_res'], sizes.get('main_msa_depth', 1), sizes.get('extra_msa_depth', 0))
+        print(HOROVOD_RANK, ':', f'Using chunk size {first_chunk_size}, estimated peak memory {peak / 1024 ** 3:.2f} GB'); sys.stdout.flush()
+    attempts = [first_chunk_size] + [x for x in chunk_sizes if first_chunk_size is None or x < first_chunk_size]
+    try:
+        for attempt, chunk_size in enumerate(attempts):
+            modules.set_chunk_size(model, chunk_size)
+            try:
+                return predict(model, inputs, num_recycles, recycling_tol=recycling_tol)
+            except RuntimeError as e:
+                if not scheduler.is_oom_error(e) or attempt == len(attempts) - 1:
+                    raise
+            # memory held by the failed attempt is released only after leaving the except block
+            print(HOROVOD_RANK, ':', 'Out of memory, retrying with chunk size', attempts[attempt + 1]); sys.stdout.flush()
+            torch.cuda.empty_cache()
+    finally:
+        modules.set_chunk_size(model, default_chunk_size)
+
+
 def main(
         model_pth,
         seed=123456,
@@ -170,6 +369,14 @@ def main(
         cif_file=None,
         cif_asym_id=None,
         out_dir='.',
+        out_format='pdb',
+        async_write=False,
+        oom_retry_chunk_size=(128, 32, 8),
+        memory_budget=None,
+        recycling_tol=None,
+        trunk_dtype='float32',
+        quantize=False,
+        profile_dir=None,
         horovod=False,
         gpu=True,
 ):
@@ -193,49 +400,29 @@ def main(
     else:
         device = 'cpu'
 
-    # remove checkpointing to get rid of the grad is none warning
-    config_dict = deepcopy(config.config)
-    config_dict = utils.merge_dicts(config_dict, {
-        'data': {
-            'crop_size': None,
-            'msa_max_extra': extra_msa_size,
-            'use_cache': False,
-            'msa_block_del_num': 0,
-            'msa_keep_true_msa': False
-        },
-        'loss': {
-            'compute_loss': False
-        },
-        'model': {
-            'msa_bert_block': False,
-            'Evoformer': {'device': device, 'EvoformerIteration': {'checkpoint': False}},
-            'InputEmbedder': {'device': device, 'ExtraMsaStack': {'device': device, 'ExtraMsaStackIteration': {'checkpoint': False}}},
-            'StructureModule': {'device': device}
-        }
-    })
-
-    if config_update_json:
-        config_dict = utils.merge_dicts(config_dict, utils.read_json(config_update_json))
-
-    model = docker.DockerIteration(config_dict['model'], config_dict)
-
-    if HOROVOD_RANK == 0:
-        print('Num params:', sum(p.numel() for p in model.parameters() if p.requires_grad))
-        print('Num param sets:', len([p for p in model.parameters() if p.requires_grad]))
-        #for x in range(torch.cuda.device_count()):
-        #    print('cuda:' + str(x), ':', torch.cuda.memory_stats(x)['allocated_bytes.all.peak'] / 1024**2)
-        sys.stdout.flush()
+    config_dict = make_config(device, extra_msa_size=extra_msa_size, config_update_json=config_update_json, trunk_dtype=trunk_dtype)
+
+    # several parameter sets are run as an ensemble, see predict_ensemble
+    model_pths = [model_pth] if isinstance(model_pth, str) else list(model_pth)
+    models = {}
+    for pth in model_pths:
+        name = Path(pth).basename().stripext()
+        assert name not in models, f'Model names must be unique, {name} is used twice'
+        model = docker.DockerIteration(config_dict['model'], config_dict)
+        models[name] = model
+
+        if HOROVOD_RANK == 0 and len(models) == 1:
+            print('Num params:', sum(p.numel() for p in model.parameters() if p.requires_grad))
+            print('Num param sets:', len([p for p in model.parameters() if p.requires_grad]))
+            #for x in range(torch.cuda.device_count()):
+            #    print('cuda:' + str(x), ':', torch.cuda.memory_stats(x)['allocated_bytes.all.peak'] / 1024**2)
+            sys.stdout.flush()
 
-    if HOROVOD_RANK == 0:
-        print('Loading saved model from', model_pth)
-        pth = torch.load(model_pth, map_location=device)
-        if 'MSA_BERT.weight' in pth['model_state_dict']:
-            del pth['model_state_dict']['MSA_BERT.weight']
-            del pth['model_state_dict']['MSA_BERT.bias']
-        model.load_state_dict(pth['model_state_dict'])
+        if HOROVOD_RANK == 0:
+            load_model_state(model, pth, device)
 
-    if HOROVOD:
-        hvd.broadcast_parameters(model.state_dict(), root_rank=0)
+        if HOROVOD:
+            hvd.broadcast_parameters(model.state_dict(), root_rank=0)
 
     if batch_json is None:
         assert a3m_file
@@ -252,6 +439,25 @@ def main(
     else:
         batch_data = utils.read_json(batch_json)
 
+    activation_budget = None
+    if memory_budget is not None:
+        # all models of the ensemble are kept on the device
+        activation_budget = memory_budget * 1024 ** 3 - sum(memory.parameter_bytes(x) for x in models.values())
+        # extra MSA size is set once for the longest target and the deepest MSA,
+        # chunk size is chosen for every target
+        max_num_res = max(len(x['entity_info']['pdbx_seq_one_letter_code_can']) for x in batch_data)
+        max_msa_depth = max(sum(scheduler.count_a3m_sequences(Path(data_dir) / f) for f in x['a3m_files']) for x in batch_data)
+        num_clusters = min(max_msa_depth, config_dict['data']['msa_max_clusters'])
+        num_extra = min(max_msa_depth - num_clusters, config_dict['data']['msa_max_extra'])
+        chunk_size, num_extra, peak = memory.choose_memory_settings(config_dict, activation_budget, max_num_res, num_clusters, num_extra)
+        if HOROVOD_RANK == 0:
+            print(f'Longest target ({max_num_res} residues): extra MSA size {num_extra}, chunk size {chunk_size}, '
+                  f'estimated peak memory {peak / 1024 ** 3:.2f} GB without parameters')
+            if peak > activation_budget:
+                print('Estimated peak memory exceeds the budget even with the smallest chunk size')
+            sys.stdout.flush()
+        config_dict['data']['msa_max_extra'] = min(num_extra, config_dict['data']['msa_max_extra'])
+
     dset = dataset.DockingDataset(
         batch_data,
         config_dict['data'],
@@ -262,28 +468,54 @@ def main(
 
     kwargs = {'num_workers': 0, 'pin_memory': True, 'batch_size': 1, 'shuffle': False}
     if HOROVOD:
-        sampler = torch.utils.data.distributed.DistributedSampler(dset, num_replicas=hvd.size(), rank=HOROVOD_RANK, shuffle=False)
-        loader = torch.utils.data.DataLoader(dset, sampler=sampler, **kwargs)
-        sampler.set_epoch(0)
+        # balance the estimated work between ranks instead of splitting the targets evenly
+        costs = [scheduler.estimate_item_cost(x, config_dict['data'], data_dir) for x in batch_data]
+        schedule = scheduler.lpt_schedule(costs, hvd.size())
+        if HOROVOD_RANK == 0:
+            print('Estimated load per rank:', [sum(costs[x] for x in rank_jobs) for rank_jobs in schedule]); sys.stdout.flush()
+        loader = torch.utils.data.DataLoader(dset, sampler=schedule[HOROVOD_RANK], **kwargs)
     else:
         loader = torch.utils.data.DataLoader(dset, **kwargs)
 
-    global_stats = {}
+    local_stats = []
     num_recycles = config_dict['model']['recycling_num_iter'] if config_dict['model']['recycling_on'] else 1
 
-    model.modules_to_devices()
-    model.eval()
-    with torch.no_grad():
+    writer = async_writer.AsyncWriter() if async_write else None
+
+    for name, model in models.items():
+        model.modules_to_devices()
+        model.eval()
+        if quantize:
+            models[name] = quantization.quantize_trunk(model)
+
+    profiler = None
+    if profile_dir is not None:
+        profiler = profiling.Profiler(device)
+        for name, model in models.items():
+            profiler.attach(model, prefix=name if len(models) > 1 else '')
+
+    # queued outputs are written even if the loop fails, writer errors are then printed instead of raised
+    with torch.no_grad(), (profiler or contextlib.nullcontext()), (writer or contextlib.nullcontext()):
         for inputs in (tqdm(loader, desc='Processed') if HOROVOD_RANK == 0 else loader):
             print_input_shapes(inputs)
 
-            for recycle_iter in range(num_recycles):
-                output = model(inputs, recycling=output['recycling_input'] if recycle_iter > 0 else None)
-
-            report_step(inputs, output, global_stats, out_dir)
+            with profiling.sample(f'{inputs["target"]["ix"].item():06d}', **profiling.sample_sizes(inputs)):
+                if len(models) > 1:
+                    local_stats.append(predict_ensemble(models, inputs, num_recycles, out_dir, out_format=out_format, writer=writer,
+                                                        chunk_sizes=oom_retry_chunk_size, recycling_tol=recycling_tol,
+                                                        memory_budget=activation_budget))
+                else:
+                    model, = models.values()
+                    output = predict_with_oom_retry(model, inputs, num_recycles, chunk_sizes=oom_retry_chunk_size, recycling_tol=recycling_tol,
+                                                    memory_budget=activation_budget)
+                    local_stats.append(report_step(inputs, output, out_dir, out_format=out_format, writer=writer))
             sys.stdout.flush()
             torch.cuda.empty_cache()
 
+    if profiler is not None:
+        profiler.save(profile_dir, prefix=f'profile_rank{HOROVOD_RANK}' if HOROVOD else 'profile')
+
+    global_stats = gather_stats(local_stats)
     if HOROVOD_RANK == 0:
         for key in global_stats.keys():
             vals = [x for x in global_stats[key] if not math.isnan(x)]
@@ -294,7 +526,7 @@ def main(
 
 
 @click.command()
-@click.argument('model_pth')
+@click.argument('model_pth', nargs=-1, required=True)
 @click.option('--seed', default=123456, show_default=True, type=click.INT,
               help='Seed for RNG. Ensures reproducibility')
 @click.option('--config_update_json',
@@ -315,13 +547,32 @@ def main(
 @click.option('--out_dir', default='./', show_default=True,
               type=click.Path(exists=True, file_okay=False, writable=True),
               help='Directory where to put predicted models')
+@click.option('--out_format', default='pdb', show_default=True, type=click.Choice(['pdb', 'cif']),
+              help='Format of the predicted models')
+@click.option('--async_write', is_flag=True, help='Write predicted models in a background thread')
+@click.option('--recycling_tol', type=click.FLOAT,
+              help='Stop recycling when the C-beta distance matrix changes by less than this value (RMS, Angstroms). '
+                   'Number of recycling iterations from the config is the upper limit')
+@click.option('--trunk_dtype', default='float32', show_default=True, type=click.Choice(['float32', 'bfloat16', 'float16']),
+              help='Precision of the input embedder and Evoformer, structure module always runs in float32. '
+                   'bfloat16 works on CPU and GPU, float16 on GPU only')
+@click.option('--quantize', is_flag=True,
+              help='Dynamic int8 quantization of Evoformer and extra MSA stack linear layers (CPU only)')
+@click.option('--oom_retry_chunk_size', multiple=True, default=[128, 32, 8], show_default=True, type=click.INT,
+              help='Chunk sizes to retry with if a target runs out of memory')
+@click.option('--memory_budget', type=click.FLOAT,
+              help='Device memory (GB) available to the model. Extra MSA size is reduced and chunk size is chosen for every target, '
+                   'so that the estimated peak memory (see memory.inference_peak_memory) fits into it')
+@click.option('--profile_dir', type=click.Path(file_okay=False),
+              help='Record wall time and peak memory of the model submodules for every target, '
+                   'and write them to profile.json and profile_trace.json (chrome://tracing) in this directory')
 @click.option('--horovod', is_flag=True, help='Use Horovod for multi-GPU batch calculation')
 @click.option('--gpu/--no_gpu', default=True, show_default=True,
               help='Use GPU or CPU. If GPU the device will be cuda:0 or cuda:<<local_rank>> when using Horovod')
 def cli(**kwargs):
     """Predict structures for a single protein or a batch using MSAs in a3m format.
 
-    MODEL_PTH - pth file with model parameters
+    MODEL_PTH - pth file with model parameters, several files are run as an ensemble
 
     Inference can be run in two modes: single protein or batch. To predict a single
     protein provide one or several MSAs for it using --a3m_file.
@@ -351,6 +602,17 @@ def cli(**kwargs):
     \b
     > horovodrun -np 4 python inference.py model.pth --horovod --batch_json proteins.json
 
+    The targets are distributed between the ranks to balance the estimated
+    cost (sequence length and MSA depth), the longest targets run first.
+
+    With several MODEL_PTH files (e.g. AF2 model_1 .. model_5) features of each
+    target are computed once and all models are run on them one after another.
+    Predictions are ranked by mean pLDDT, the top ranked one is written as
+    prediction_<idx>, all of them as prediction_<idx>_<model name>:
+
+    \b
+    > python inference.py params_model_?.pth --a3m_file msa.a3m
+
     """
 
     if not kwargs['a3m_file'] and not kwargs['batch_json']:
@@ -362,4 +624,5 @@ def cli(**kwargs):
     main(**kwargs)
 
 
-cli()
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,261 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import torch
+import logging
+import sys
+import json
+import time
+import queue
+import threading
+import tempfile
+import traceback
+import urllib.request
+from io import StringIO
+from path import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import click
+
+from alphadock import docker
+from alphadock import dataset
+from alphadock import inference
+from alphadock import quantization
+
+
+OUT_FORMATS = ('pdb', 'cif')
+
+
+def featurize_job(job, config_dict, seed=123456):
+    """Makes model inputs for a job dict {'a3m': [a3m_text, ...], 'sequence': str (optional)}"""
+    a3m_texts = job['a3m']
+    if isinstance(a3m_texts, str):
+        a3m_texts = [a3m_texts]
+    assert len(a3m_texts) > 0, 'No MSAs provided'
+
+    with tempfile.TemporaryDirectory(prefix='alphadock-') as tmp_dir:
+        a3m_files = []
+        for i, a3m in enumerate(a3m_texts):
+            a3m_file = Path(tmp_dir) / f'{i}.a3m'
+            a3m_file.write_text(a3m)
+            a3m_files.append(a3m_file.basename())
+
+        sequence = job.get('sequence') or inference.parse_first_sequence_a3m(Path(tmp_dir) / a3m_files[0])
+        dset = dataset.DockingDataset(
+            [{
+                'entity_info': {'pdbx_seq_one_letter_code_can': sequence, 'asym_ids': [None]},
+                'cif_file': None,
+                'a3m_files': a3m_files
+            }],
+            config_dict['data'],
+            dataset_dir=tmp_dir,
+            seed=seed,
+            shuffle=False
+        )
+        return next(iter(torch.utils.data.DataLoader(dset, batch_size=1, shuffle=False)))
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        self._send_json(200, {'status': 'ok', 'queued': self.server.jobs.qsize()})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            out_format = job.get('out_format', 'pdb')
+            assert out_format in OUT_FORMATS, f'Unknown out_format {out_format!r}, expected one of {OUT_FORMATS}'
+            t0 = time.time()
+            inputs = featurize_job(job, self.server.config_dict, self.server.seed)
+            time_featurize = time.time() - t0
+        except Exception as e:
+            traceback.print_exc(); sys.stderr.flush()
+            self._send_json(400, {'error': repr(e)})
+            return
+
+        result = self.server.submit(inputs, out_format)
+        if 'error' in result:
+            self._send_json(500, result)
+        else:
+            result['time_featurize'] = time_featurize
+            self._send_json(200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """HTTP server keeping the model resident between requests.
+
+    Requests are featurized in the handler threads and queued for a single model
+    thread, so featurization of queued jobs overlaps with model execution.
+
+    POST /predict  {"a3m": [a3m_text, ...], "sequence": str (optional), "out_format": "pdb" / "cif"}
+        returns {"pdb" / "cif": str, "plddt": [...], "mean_plddt": float, ...}
+    GET /health
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, model, config_dict, seed=123456, max_queue=16, recycling_tol=None):
+        super().__init__(address, _RequestHandler)
+        self.model = model
+        self.config_dict = config_dict
+        self.seed = seed
+        self.recycling_tol = recycling_tol
+        self.num_recycles = config_dict['model']['recycling_num_iter'] if config_dict['model']['recycling_on'] else 1
+        self.jobs = queue.Queue(max_queue)
+        self.worker = threading.Thread(target=self._model_loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, inputs, out_format='pdb'):
+        job = {'inputs': inputs, 'out_format': out_format, 'done': threading.Event()}
+        self.jobs.put(job)
+        job['done'].wait()
+        return job['result']
+
+    def _run_job(self, inputs, out_format):
+        t0 = time.time()
+        with torch.no_grad():
+            output = inference.predict_with_oom_retry(self.model, inputs, self.num_recycles, chunk_sizes=(128, 32, 8), recycling_tol=self.recycling_tol)
+        plddt = inference.plddt_from_logits(output['struct_out']['rec_lddt'][0, -1]).cpu()
+
+        stream = StringIO()
+        if out_format == 'cif':
+            inference.pred_to_cif_stream(stream, 'prediction', inputs, output)
+        else:
+            inference.pred_to_pdb_stream(stream, 'prediction', inputs, output)
+
+        return {
+            out_format: stream.getvalue(),
+            'plddt': plddt.tolist(),
+            'mean_plddt': plddt.mean().item(),
+            'num_recycles': output['num_recycles'],
+            'time_predict': time.time() - t0
+        }
+
+    def _model_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                job['result'] = self._run_job(job['inputs'], job['out_format'])
+            except Exception as e:
+                traceback.print_exc(); sys.stderr.flush()
+                job['result'] = {'error': repr(e)}
+            finally:
+                job['done'].set()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+    def server_close(self):
+        self.jobs.put(None)
+        self.worker.join()
+        super().server_close()
+
+
+def request_prediction(url, a3m_files, sequence=None, out_format='pdb', timeout=None):
+    """Client for InferenceServer. Sends MSAs from a3m_files and returns the response dict."""
+    job = {'a3m': [Path(x).read_text() for x in a3m_files], 'out_format': out_format}
+    if sequence is not None:
+        job['sequence'] = sequence
+    request = urllib.request.Request(
+        url.rstrip('/') + '/predict',
+        data=json.dumps(job).encode(),
+        headers={'Content-Type': 'application/json'}
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def make_server(model_pth, host='127.0.0.1', port=8000, config_update_json=None, extra_msa_size=4096, gpu=True, seed=123456, max_queue=16, recycling_tol=None, trunk_dtype='float32', quantize=False):
+    if gpu:
+        assert torch.cuda.is_available(), 'CUDA is not available'
+        device = 'cuda:0'
+    else:
+        device = 'cpu'
+
+    config_dict = inference.make_config(device, extra_msa_size=extra_msa_size, config_update_json=config_update_json, trunk_dtype=trunk_dtype)
+    model = docker.DockerIteration(config_dict['model'], config_dict)
+    inference.load_model_state(model, model_pth, device)
+    model.modules_to_devices()
+    model.eval()
+    if quantize:
+        model = quantization.quantize_trunk(model)
+    return InferenceServer((host, port), model, config_dict, seed=seed, max_queue=max_queue, recycling_tol=recycling_tol)
+
+
+@click.command()
+@click.argument('model_pth')
+@click.option('--host', default='127.0.0.1', show_default=True, help='Address to bind')
+@click.option('--port', default=8000, show_default=True, type=click.INT, help='Port to bind')
+@click.option('--seed', default=123456, show_default=True, type=click.INT,
+              help='Seed for RNG used in MSA featurization. Ensures reproducibility')
+@click.option('--config_update_json',
+              type=click.Path(exists=True, dir_okay=False),
+              help='JSON containing configuration update. Will be merged with default alphafold.config.CONFIG')
+@click.option('--extra_msa_size', default=4096, show_default=True, type=click.INT, help='Extra MSA size')
+@click.option('--max_queue', default=16, show_default=True, type=click.INT,
+              help='Maximum number of featurized jobs waiting for the model')
+@click.option('--recycling_tol', type=click.FLOAT,
+              help='Stop recycling when the C-beta distance matrix changes by less than this value (RMS, Angstroms)')
+@click.option('--trunk_dtype', default='float32', show_default=True, type=click.Choice(['float32', 'bfloat16', 'float16']),
+              help='Precision of the input embedder and Evoformer (float16 is GPU only)')
+@click.option('--quantize', is_flag=True,
+              help='Dynamic int8 quantization of Evoformer and extra MSA stack linear layers (CPU only)')
+@click.option('--gpu/--no_gpu', default=True, show_default=True, help='Use GPU (cuda:0) or CPU')
+def cli(**kwargs):
+    """Serve structure predictions over HTTP keeping the model loaded.
+
+    MODEL_PTH - pth file with model parameters
+
+    \b
+    > python inference_server.py model.pth --port 8000
+
+    Jobs are posted as JSON to /predict:
+
+    \b
+    > curl -d '{"a3m": [">seq\\nMKV..."]}' http://127.0.0.1:8000/predict
+
+    or using alphadock.inference_server.request_prediction(url, a3m_files).
+    """
+    torch.set_num_threads(1)
+    logging.getLogger('.prody').setLevel('CRITICAL')
+
+    server = make_server(**kwargs)
+    print('Serving on', server.server_address); sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    cli()
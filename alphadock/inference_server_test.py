@@ -0,0 +1,56 @@
+import threading
+import urllib.request
+import urllib.error
+import json
+import pytest
+import torch
+
+from alphadock import docker
+from alphadock import utils
+from alphadock import inference_server
+
+
+def test_inference_server(tmp_path):
+    config_update = {
+        'data': {'msa_max_clusters': 8},
+        'model': {
+            'recycling_num_iter': 2,
+            'Evoformer': {'num_iter': 1},
+            'InputEmbedder': {'ExtraMsaStack': {'num_iter': 1}},
+            'StructureModule': {'num_iter': 1}
+        }
+    }
+    utils.write_json(config_update, tmp_path / 'config.json')
+    config_dict = inference_server.inference.make_config('cpu', extra_msa_size=8, config_update_json=tmp_path / 'config.json')
+    torch.save({'model_state_dict': docker.DockerIteration(config_dict['model'], config_dict).state_dict()}, tmp_path / 'model.pth')
+
+    sequence = 'MKVLAAGIDE'
+    (tmp_path / 'test.a3m').write_text(f'>query\n{sequence}\n>hit1\nMKVLAAG-DE\n>hit2\nMRVLsAAGIDQ\n')
+
+    server = inference_server.make_server(
+        tmp_path / 'model.pth', port=0, gpu=False, extra_msa_size=8, config_update_json=tmp_path / 'config.json'
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = 'http://%s:%d' % server.server_address
+        with urllib.request.urlopen(url + '/health') as response:
+            assert json.loads(response.read())['status'] == 'ok'
+
+        result = inference_server.request_prediction(url, [tmp_path / 'test.a3m'])
+        assert len(result['plddt']) == len(sequence)
+        assert 0 <= result['mean_plddt'] <= 100
+        assert result['num_recycles'] == 2
+        atom_lines = [x for x in result['pdb'].split('\n') if x.startswith('ATOM')]
+        assert len(set(x[22:26] for x in atom_lines)) == len(sequence)
+
+        result = inference_server.request_prediction(url, [tmp_path / 'test.a3m'], out_format='cif')
+        assert result['cif'].startswith('data_prediction.pred')
+
+        with pytest.raises(urllib.error.HTTPError) as e:
+            inference_server.request_prediction(url, [tmp_path / 'test.a3m'], out_format='xyz')
+        assert e.value.code == 400
+        assert 'out_format' in json.loads(e.value.read())['error']
+    finally:
+        server.shutdown()
+        server.server_close()
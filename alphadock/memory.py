@@ -0,0 +1,410 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Analytical estimates of activation memory and compute of the trunk blocks.
+# Counts are in tensor elements and multiply-adds, they are approximate
+# (only the large intermediates are counted) and meant for relative comparisons.
+
+import math
+
+from alphadock import modules
+
+
+def _attention_stats(num_rows, num_keys, in_c, num_heads, attn_c, pair_c=0):
+    """Gated self-attention over num_keys positions for num_rows independent rows.
+    If pair_c > 0, the attention has a bias projected from a (num_keys, num_keys, pair_c) tensor."""
+    hc = num_heads * attn_c
+    tokens = num_rows * num_keys
+    logits = num_rows * num_heads * num_keys ** 2
+    return {
+        # layer norm, q/k/v/gate, logits and weights, gated output
+        'activations': tokens * (in_c + 4 * hc + 2 * hc) + 2 * logits + (num_keys ** 2 * (pair_c + num_heads) if pair_c else 0),
+        'inputs': tokens * in_c + num_keys ** 2 * pair_c,
+        'flops': tokens * in_c * 5 * hc + 2 * logits * attn_c + num_keys ** 2 * pair_c * num_heads
+    }
+
+
+def _global_attention_stats(num_rows, num_cols, in_c, num_heads, attn_c):
+    tokens = num_rows * num_cols
+    hc = num_heads * attn_c
+    return {
+        'activations': tokens * (in_c + 2 * attn_c + 2 * hc) + num_cols * num_rows * num_heads,
+        'inputs': tokens * in_c,
+        'flops': tokens * in_c * (hc + 2 * attn_c) + tokens * hc * in_c + 2 * tokens * hc
+    }
+
+
+def _transition_stats(tokens, in_c, n):
+    return {
+        'activations': tokens * (in_c + 2 * n * in_c),
+        'inputs': tokens * in_c,
+        'flops': tokens * 2 * n * in_c ** 2
+    }
+
+
+def _outer_product_mean_stats(num_seq, num_res, in_c, mid_c, pair_c):
+    return {
+        'activations': num_seq * num_res * (in_c + 2 * mid_c) + num_res ** 2 * (mid_c ** 2 + pair_c),
+        'inputs': num_seq * num_res * in_c,
+        'flops': num_seq * num_res * in_c * 2 * mid_c + num_res ** 2 * (num_seq * mid_c ** 2 + mid_c ** 2 * pair_c)
+    }
+
+
+def _triangle_multiplication_stats(num_res, pair_c, mid_c):
+    n2 = num_res ** 2
+    return {
+        # layer norm, fused projection and gates, edges, product, its layer norm, output
+        'activations': n2 * (pair_c + 2 * (4 * mid_c + pair_c) + 2 * mid_c + 2 * mid_c + pair_c),
+        'inputs': n2 * pair_c,
+        'flops': n2 * pair_c * (4 * mid_c + pair_c) + num_res ** 3 * mid_c + n2 * mid_c * pair_c
+    }
+
+
+def evoformer_block_stats(num_res, num_seq, config, global_config, extra=False):
+    """Per submodule estimates for one EvoformerIteration (or ExtraMsaStackIteration if extra is True).
+
+    Returns {submodule name: {'activations', 'inputs', 'flops'}}, where activations are the
+    elements stored for backward, inputs are the elements stored if the submodule is checkpointed.
+    """
+    model = global_config['model']
+    msa_c = model['rep1d_extra_feat'] if extra else model['rep1d_feat']
+    pair_c = model['rep2d_feat']
+    stats = {}
+
+    c = config['RowAttentionWithPairBias']
+    stats['RowAttentionWithPairBias'] = _attention_stats(num_seq, num_res, msa_c, c['num_heads'], c['attention_num_c'], pair_c)
+    if extra:
+        c = config['MSAColumnGlobalAttention']
+        stats['MSAColumnGlobalAttention'] = _global_attention_stats(num_seq, num_res, msa_c, c['num_heads'], c['attention_num_c'])
+    else:
+        c = config['MSAColumnAttention']
+        stats['MSAColumnAttention'] = _attention_stats(num_res, num_seq, msa_c, c['num_heads'], c['attention_num_c'])
+    stats['MSATransition'] = _transition_stats(num_seq * num_res, msa_c, config['MSATransition']['n'])
+    stats['OuterProductMean'] = _outer_product_mean_stats(num_seq, num_res, msa_c, config['OuterProductMean']['mid_c'], pair_c)
+
+    for name in ['TriangleMultiplicationOutgoing', 'TriangleMultiplicationIngoing']:
+        stats[name] = _triangle_multiplication_stats(num_res, pair_c, config[name]['mid_c'])
+    for name in ['TriangleAttentionStartingNode', 'TriangleAttentionEndingNode']:
+        c = config[name]
+        stats[name] = _attention_stats(num_res, num_res, pair_c, c['num_heads'], c['attention_num_c'])
+    stats['PairTransition'] = _transition_stats(num_res ** 2, pair_c, config['PairTransition']['n'])
+    return stats
+
+
+def block_policy_cost(stats, num_res, num_seq, msa_c, pair_c, policy):
+    """(stored activation elements, recomputed flops) of one block under checkpointing policy"""
+    if policy == 'none':
+        return sum(x['activations'] for x in stats.values()), 0
+    if policy == 'block':
+        return num_seq * num_res * msa_c + num_res ** 2 * pair_c, sum(x['flops'] for x in stats.values())
+
+    if policy == 'attention':
+        checkpointed = [k for k in stats if k in modules.ATTENTION_MODULES]
+    elif policy == 'pair_stack':
+        checkpointed = [k for k in stats if k in modules.PAIR_STACK_MODULES]
+    else:
+        raise ValueError(f'Unknown checkpoint policy {policy}')
+
+    activations = sum(v['activations'] for k, v in stats.items() if k not in checkpointed)
+    if policy == 'attention':
+        activations += sum(stats[k]['inputs'] for k in checkpointed)
+    else:
+        activations += num_res ** 2 * pair_c
+    return activations, sum(stats[k]['flops'] for k in checkpointed)
+
+
+def stack_policy_cost(num_res, num_seq, config, global_config, num_blocks, policy, every, extra=False):
+    """(stored activation elements, recomputed flops) of a stack of blocks,
+    where every k-th block is checkpointed with the policy and the rest are not"""
+    stats = evoformer_block_stats(num_res, num_seq, config, global_config, extra=extra)
+    msa_c = global_config['model']['rep1d_extra_feat'] if extra else global_config['model']['rep1d_feat']
+    pair_c = global_config['model']['rep2d_feat']
+    num_checkpointed = len(range(0, num_blocks, every))
+    ckpt_mem, ckpt_flops = block_policy_cost(stats, num_res, num_seq, msa_c, pair_c, policy)
+    full_mem, _ = block_policy_cost(stats, num_res, num_seq, msa_c, pair_c, 'none')
+    return num_checkpointed * ckpt_mem + (num_blocks - num_checkpointed) * full_mem, num_checkpointed * ckpt_flops
+
+
+def choose_checkpoint_policy(global_config, memory_budget, num_res=None, bytes_per_element=4, max_every=8):
+    """Cheapest (in recomputation) checkpointing policy for Evoformer and extra MSA stack
+    whose stored activations fit into memory_budget bytes.
+
+    Returns (policy, every), falls back to ('block', 1) if nothing fits.
+    num_res defaults to the crop size.
+    """
+    data = global_config['data']
+    model = global_config['model']
+    if num_res is None:
+        num_res = data['crop_size']
+    assert num_res is not None, 'Crop size or num_res is required to choose checkpointing policy'
+
+    evo_config = model['Evoformer']['EvoformerIteration']
+    extra_config = model['InputEmbedder']['ExtraMsaStack']['ExtraMsaStackIteration']
+    candidates = [('none', 1)] + [(policy, every) for policy in modules.CHECKPOINT_POLICIES[1:] for every in range(1, max_every + 1)]
+
+    fitting = []
+    for policy, every in candidates:
+        evo_mem, evo_flops = stack_policy_cost(num_res, data['msa_max_clusters'], evo_config, global_config, model['Evoformer']['num_iter'], policy, every)
+        extra_mem, extra_flops = stack_policy_cost(num_res, data['msa_max_extra'], extra_config, global_config, model['InputEmbedder']['ExtraMsaStack']['num_iter'], policy, every, extra=True)
+        if (evo_mem + extra_mem) * bytes_per_element <= memory_budget:
+            fitting.append((evo_flops + extra_flops, policy, every))
+
+    if not fitting:
+        return 'block', 1
+    return min(fitting)[1:]
+
+
+# Peak memory of inference and training. Unlike the estimates above these are
+# in bytes and count everything alive at the peak: the representations held by the
+# caller, the per block copies and the transient tensors of the largest submodule.
+# Parameters are not included, see parameter_bytes.
+
+DTYPE_BYTES = {'float32': 4, 'bfloat16': 2, 'float16': 2}
+
+# tried by choose_chunk_size from the fastest (None, no chunking) to the slowest
+CHUNK_SIZES = (None, 256, 128, 64, 32, 16, 8, 4, 1)
+
+
+def parameter_bytes(model):
+    return sum(x.numel() * x.element_size() for x in list(model.parameters()) + list(model.buffers()))
+
+
+def _num_rows(num_rows, chunk_size):
+    return num_rows if chunk_size is None else min(num_rows, chunk_size)
+
+
+def _attention_peak(num_rows, num_keys, in_c, num_heads, attn_c, bias_elements, chunk_size, model, b):
+    """Gated self-attention (modules.attention) of num_rows rows evaluated in chunks of rows.
+    bias_elements are the pair tensors (pair input, its layer norm and the bias itself) alive
+    during the whole call."""
+    rows = _num_rows(num_rows, chunk_size)
+    hc = num_heads * attn_c
+    msa = num_rows * num_keys * in_c
+    # input, its layer norm and output, chunk outputs are concatenated
+    peak = b * (bias_elements + 2 * msa + (2 * msa if rows < num_rows else msa))
+    # fused q/k/v/gate, scaled q, attention output and the gated one
+    peak += b * rows * num_keys * 7 * hc
+    if model['attention_backend'] == 'chunked':
+        # float32 q/k/v and logits, exp and their product for one key chunk
+        keys = min(num_keys, model['attention_key_chunk_size'])
+        peak += 4 * rows * (3 * num_keys * hc + 3 * num_heads * num_keys * keys)
+    else:
+        # logits and softmax computed in float32, lower precision logits have float32 temporaries too
+        peak += rows * num_heads * num_keys ** 2 * (8 if b == 4 else b + 8)
+    return peak
+
+
+def _global_attention_peak(num_seq, num_res, in_c, num_heads, attn_c, chunk_size, b):
+    rows = _num_rows(num_seq, chunk_size)
+    hc = num_heads * attn_c
+    msa = num_seq * num_res * in_c
+    # input, layer norm, k and v, output; gate and gated values per chunk of sequences
+    peak = b * (2 * msa + 2 * num_seq * num_res * attn_c + (2 * msa if rows < num_seq else msa))
+    return peak + b * rows * num_res * 2 * hc
+
+
+def _transition_peak(num_rows, row_len, in_c, n, chunk_size, b):
+    rows = _num_rows(num_rows, chunk_size)
+    tokens = num_rows * row_len
+    hidden = rows * row_len * (n + 1) * in_c
+    if rows < num_rows:
+        # outputs of the previous chunks, all of them and their concatenation at the end
+        hidden = max(tokens * in_c + hidden, 2 * tokens * in_c)
+    # input, layer norm or output and hidden layer
+    return b * (tokens * in_c + hidden)
+
+
+def _outer_product_mean_peak(num_seq, num_res, in_c, mid_c, pair_c, chunk_size, b):
+    rows = _num_rows(num_res, chunk_size)
+    # input, layer norm, left and right projections and their copies made by einsum
+    peak = b * (2 * num_seq * num_res * in_c + 4 * num_seq * num_res * mid_c)
+    # outer product of a chunk of residues, its flattened copy and projection
+    peak += b * rows * num_res * (2 * mid_c ** 2 + pair_c)
+    # concatenated chunks, final output
+    return peak + b * (2 * num_res ** 2 * pair_c if rows < num_res else num_res ** 2 * pair_c)
+
+
+def _triangle_multiplication_peak(num_res, pair_c, mid_c, b):
+    # input, layer norm, fused projection, gates, gated edges, product and output projection
+    return b * num_res ** 2 * (6 * pair_c + 8 * mid_c)
+
+
+def evoformer_block_peaks(num_res, num_seq, config, global_config, chunk_size=None, extra=False):
+    """Peak bytes of each submodule of one EvoformerIteration (or ExtraMsaStackIteration if extra is True)
+    in inference, including the copy of the input it's called with. Chunking (see modules.chunk_apply)
+    reduces the attention logits, transitions and outer product to chunk_size rows."""
+    model = global_config['model']
+    b = DTYPE_BYTES[model['trunk_dtype']]
+    msa_c = model['rep1d_extra_feat'] if extra else model['rep1d_feat']
+    pair_c = model['rep2d_feat']
+    n2 = num_res ** 2
+    peaks = {}
+
+    c = config['RowAttentionWithPairBias']
+    peaks['RowAttentionWithPairBias'] = _attention_peak(
+        num_seq, num_res, msa_c, c['num_heads'], c['attention_num_c'], n2 * (2 * pair_c + c['num_heads']), chunk_size, model, b)
+    if extra:
+        c = config['MSAColumnGlobalAttention']
+        peaks['MSAColumnGlobalAttention'] = _global_attention_peak(num_seq, num_res, msa_c, c['num_heads'], c['attention_num_c'], chunk_size, b)
+    else:
+        c = config['MSAColumnAttention']
+        peaks['MSAColumnAttention'] = _attention_peak(num_res, num_seq, msa_c, c['num_heads'], c['attention_num_c'], 0, chunk_size, model, b)
+    peaks['MSATransition'] = _transition_peak(num_seq, num_res, msa_c, config['MSATransition']['n'], chunk_size, b)
+    peaks['OuterProductMean'] = _outer_product_mean_peak(num_seq, num_res, msa_c, config['OuterProductMean']['mid_c'], pair_c, chunk_size, b)
+
+    for name in ['TriangleMultiplicationOutgoing', 'TriangleMultiplicationIngoing']:
+        peaks[name] = _triangle_multiplication_peak(num_res, pair_c, config[name]['mid_c'], b)
+    for name in ['TriangleAttentionStartingNode', 'TriangleAttentionEndingNode']:
+        c = config[name]
+        peaks[name] = _attention_peak(num_res, num_res, pair_c, c['num_heads'], c['attention_num_c'], n2 * c['num_heads'], chunk_size, model, b)
+    peaks['PairTransition'] = _transition_peak(num_res, num_res, pair_c, config['PairTransition']['n'], chunk_size, b)
+    return peaks
+
+
+def _stack_peak(num_res, num_seq, config, global_config, chunk_size, extra):
+    """Peak bytes inside one block of a stack: the block inputs, their copies made by
+    the block (one more pair copy in the pair stack) and the largest submodule"""
+    model = global_config['model']
+    b = DTYPE_BYTES[model['trunk_dtype']]
+    msa = num_seq * num_res * (model['rep1d_extra_feat'] if extra else model['rep1d_feat'])
+    pair = num_res ** 2 * model['rep2d_feat']
+    peaks = evoformer_block_peaks(num_res, num_seq, config, global_config, chunk_size=chunk_size, extra=extra)
+    msa_peak = max(v for k, v in peaks.items() if k not in modules.PAIR_STACK_MODULES)
+    pair_peak = max(v for k, v in peaks.items() if k in modules.PAIR_STACK_MODULES) + b * pair
+    return 2 * b * (msa + pair) + max(msa_peak, pair_peak)
+
+
+def _structure_module_peak(num_res, global_config):
+    """Pair representation normalized by the structure module and the larger of
+    invariant point attention (logits, point distances, pair projection) and distogram head, float32"""
+    model = global_config['model']
+    config = model['StructureModule']
+    ipa = config['StructureModuleIteration']['InvariantPointAttention']
+    n2 = num_res ** 2
+    ipa_peak = n2 * ipa['num_head'] * (5 * ipa['num_point_qk'] + 6)
+    distogram_peak = n2 * (model['rep2d_feat'] + config['PredictDistogram']['rec_num_bins'])
+    return 4 * n2 * model['rep2d_feat'] + 4 * max(ipa_peak, distogram_peak)
+
+
+def inference_peak_memory(num_res, num_clusters, num_extra, global_config, chunk_size=None):
+    """Estimated peak memory (bytes) of DockerIteration in inference for a target of num_res
+    residues with num_clusters main and num_extra extra MSA sequences.
+
+    Returns {'features', 'extra_msa_stack', 'evoformer', 'structure_module', 'peak'}, where
+    features are the input features copied to the device, stage values are the peaks of the stages
+    on top of them and peak is the total. Model parameters are not included, see parameter_bytes.
+    """
+    data = global_config['data']
+    model = global_config['model']
+    b = DTYPE_BYTES[model['trunk_dtype']]
+    n2 = num_res ** 2
+    msa = num_clusters * num_res * model['rep1d_feat']
+    pair = n2 * model['rep2d_feat']
+    extra = num_extra * num_res * model['rep1d_extra_feat']
+
+    # float32 features and the extra MSA features in the trunk dtype
+    extra_feat = num_extra * num_res * data['msa_extra_feat']
+    features = 4 * (num_clusters * num_res * data['msa_clus_feat'] + extra_feat + n2 * (2 * data['relpos_max'] + 1)) + b * extra_feat
+    # embedding reused by the recycling iterations and the recycled pair representation
+    context = b * (msa + pair) + 4 * pair
+
+    stages = {}
+    # embedding copies, layer norm of the recycled pair representation, projected extra MSA
+    stages['extra_msa_stack'] = context + b * (msa + 2 * pair + extra) + _stack_peak(
+        num_res, num_extra, model['InputEmbedder']['ExtraMsaStack']['ExtraMsaStackIteration'], global_config, chunk_size, True)
+    stages['evoformer'] = context + b * (msa + pair) + _stack_peak(
+        num_res, num_clusters, model['Evoformer']['EvoformerIteration'], global_config, chunk_size, False)
+    # Evoformer output, its float32 copy if the trunk runs in lower precision
+    stages['structure_module'] = context + b * (msa + pair) + (4 * pair if b != 4 else 0) + _structure_module_peak(num_res, global_config)
+    return {'features': features, **stages, 'peak': features + max(stages.values())}
+
+
+def _checkpoint_policies(global_config):
+    """(policy, every) of Evoformer and extra MSA stack blocks as set by DockerIteration.set_checkpoint_policy"""
+    model = global_config['model']
+    out = []
+    for config in [model['Evoformer']['EvoformerIteration'], model['InputEmbedder']['ExtraMsaStack']['ExtraMsaStackIteration']]:
+        policy, every = config['checkpoint'], config['checkpoint_every']
+        if policy == 'auto':
+            policy, every = choose_checkpoint_policy(global_config, model['checkpoint_memory_budget'] * 1024 ** 3)
+        elif policy is True or policy is False or policy is None:
+            policy = 'block' if policy else 'none'
+        out.append((policy, every))
+    return out
+
+
+def training_peak_memory(num_res, num_clusters, num_extra, global_config, chunk_size=None):
+    """Estimated peak memory (bytes) of a DockerIteration training step: activations stored
+    by the trunk stacks under their checkpointing policies (see stack_policy_cost) and by the
+    structure module, plus backward of the largest block, which is recomputed if checkpointed.
+
+    Returns {'features', 'activations', 'backward', 'peak'}. Parameters, gradients and
+    optimizer state are not included, with Adam they take 4 * parameter_bytes(model),
+    plus parameter_bytes(model) with gradient accumulation, where the gradients of
+    a sample are kept apart from the accumulated ones until they are checked for nans.
+    """
+    model = global_config['model']
+    b = DTYPE_BYTES[model['trunk_dtype']]
+    evo_config = model['Evoformer']['EvoformerIteration']
+    extra_config = model['InputEmbedder']['ExtraMsaStack']['ExtraMsaStackIteration']
+    (evo_policy, evo_every), (extra_policy, extra_every) = _checkpoint_policies(global_config)
+    features = inference_peak_memory(num_res, num_clusters, num_extra, global_config, chunk_size)['features']
+
+    evo_mem, _ = stack_policy_cost(num_res, num_clusters, evo_config, global_config, model['Evoformer']['num_iter'], evo_policy, evo_every)
+    extra_mem, _ = stack_policy_cost(num_res, num_extra, extra_config, global_config, model['InputEmbedder']['ExtraMsaStack']['num_iter'],
+                                     extra_policy, extra_every, extra=True)
+    ipa = model['StructureModule']['StructureModuleIteration']['InvariantPointAttention']
+    structure_mem = 4 * model['StructureModule']['num_iter'] * num_res ** 2 * ipa['num_head'] * (5 * ipa['num_point_qk'] + 6)
+    activations = b * (evo_mem + extra_mem) + structure_mem + _structure_module_peak(num_res, global_config)
+
+    backward = 0
+    for num_seq, config, extra in [(num_clusters, evo_config, False), (num_extra, extra_config, True)]:
+        block_mem, _ = block_policy_cost(
+            evoformer_block_stats(num_res, num_seq, config, global_config, extra=extra), num_res, num_seq,
+            model['rep1d_extra_feat'] if extra else model['rep1d_feat'], model['rep2d_feat'], 'none')
+        # activations of the block and gradients of the largest submodule
+        backward = max(backward, b * block_mem + 2 * _stack_peak(num_res, num_seq, config, global_config, chunk_size, extra))
+    return {'features': features, 'activations': activations, 'backward': backward, 'peak': features + activations + backward}
+
+
+def choose_chunk_size(global_config, memory_budget, num_res, num_clusters, num_extra, training=False, chunk_sizes=CHUNK_SIZES):
+    """Largest of chunk_sizes (None, no chunking, is the largest) for which the estimated peak memory
+    fits into memory_budget bytes. Returns (chunk_size, peak), the smallest chunk size if nothing fits."""
+    estimate = training_peak_memory if training else inference_peak_memory
+    chunk_sizes = sorted(chunk_sizes, key=lambda x: -math.inf if x is None else -x)
+    for chunk_size in chunk_sizes:
+        peak = estimate(num_res, num_clusters, num_extra, global_config, chunk_size=chunk_size)['peak']
+        if peak <= memory_budget:
+            break
+    return chunk_size, peak
+
+
+def choose_memory_settings(global_config, memory_budget, num_res, num_clusters=None, num_extra=None,
+                           training=False, chunk_sizes=CHUNK_SIZES, min_extra=128):
+    """Chunk size and extra MSA depth for which the estimated peak memory fits into memory_budget bytes.
+
+    Chunking only slows the model down, while fewer extra MSA sequences change the prediction,
+    so the extra MSA depth (default msa_max_extra) is halved, down to min_extra, only if nothing
+    fits even with the smallest chunk size. Returns (chunk_size, num_extra, peak), the peak is over
+    the budget if nothing fits at all.
+    """
+    data = global_config['data']
+    num_clusters = data['msa_max_clusters'] if num_clusters is None else num_clusters
+    num_extra = data['msa_max_extra'] if num_extra is None else num_extra
+    while True:
+        chunk_size, peak = choose_chunk_size(global_config, memory_budget, num_res, num_clusters, num_extra, training, chunk_sizes)
+        if peak <= memory_budget or num_extra <= min_extra:
+            return chunk_size, num_extra, peak
+        num_extra = max(num_extra // 2, min_extra)
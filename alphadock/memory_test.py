@@ -0,0 +1,53 @@
+import torch
+
+from alphadock import benchmark
+from alphadock import config
+from alphadock import docker
+from alphadock import memory
+from alphadock import modules
+from alphadock import profiling
+from alphadock import utils
+
+
+def test_choose_checkpoint_policy():
+    cfg = config.config
+    evo_config = cfg['model']['Evoformer']['EvoformerIteration']
+    costs = [memory.stack_policy_cost(128, 128, evo_config, cfg, 48, policy, 1) for policy in modules.CHECKPOINT_POLICIES]
+    assert costs[0][0] == max(x[0] for x in costs) and costs[0][1] == 0
+    assert costs[-1][0] == min(x[0] for x in costs) and costs[-1][1] == max(x[1] for x in costs)
+
+    assert memory.choose_checkpoint_policy(cfg, 1024 ** 4, num_res=128) == ('none', 1)
+    assert memory.choose_checkpoint_policy(cfg, 1, num_res=128) == ('block', 1)
+    assert memory.choose_checkpoint_policy(cfg, 40 * 1024 ** 3, num_res=128)[0] in ['attention', 'pair_stack']
+
+
+def test_inference_peak_memory(tmp_path):
+    cfg = utils.merge_dicts(benchmark.make_config('cpu'), {
+        'data': {'msa_max_clusters': 16, 'msa_max_extra': 64},
+        'loss': {'compute_loss': False},
+        'model': {'msa_bert_block': False, 'Evoformer': {'num_iter': 1}, 'InputEmbedder': {'ExtraMsaStack': {'num_iter': 1}}, 'StructureModule': {'num_iter': 1}}
+    })
+    batch = benchmark.make_sample(tmp_path, 48, cfg)[2]
+    model = docker.DockerIteration(cfg['model'], cfg)
+    model.eval()
+
+    estimates = []
+    for chunk_size in [None, 8]:
+        modules.set_chunk_size(model, chunk_size)
+        with torch.no_grad(), profiling.TensorMemory() as tracker:
+            model(batch)
+        # features are created outside of the tracker
+        estimate = memory.inference_peak_memory(48, 16, 64, cfg, chunk_size=chunk_size)
+        estimates.append(estimate['peak'] - estimate['features'])
+        assert tracker.peak() <= estimates[-1] <= 1.3 * tracker.peak()
+    assert estimates[1] < estimates[0]
+
+
+def test_choose_memory_settings():
+    cfg = config.config
+    assert memory.choose_memory_settings(cfg, 1024 ** 4, 256)[:2] == (None, 1024)
+    peak = memory.inference_peak_memory(256, 128, 1024, cfg)['peak']
+    chunk_size, num_extra, fitted_peak = memory.choose_memory_settings(cfg, peak - 1, 256)
+    assert chunk_size is not None and num_extra == 1024 and fitted_peak < peak
+    assert memory.choose_memory_settings(cfg, 1, 256)[1:] == (128, memory.inference_peak_memory(256, 128, 128, cfg, chunk_size=1)['peak'])
+    assert memory.training_peak_memory(256, 128, 1024, cfg)['peak'] > memory.training_peak_memory(256, 128, 1024, cfg, chunk_size=32)['peak']
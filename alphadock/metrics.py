@@ -0,0 +1,87 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import torch
+
+from alphadock import distributed
+
+
+def stats_to_host(stats_list):
+    """Replaces scalar tensors in a list of stats dicts with floats,
+    using a single device to host copy per device"""
+    by_device = {}
+    for stats in stats_list:
+        for v in stats.values():
+            if torch.is_tensor(v):
+                by_device.setdefault(v.device, []).append(v)
+
+    values = {}
+    for tensors in by_device.values():
+        host = torch.stack([x.detach().float().reshape([]) for x in tensors]).cpu().tolist()
+        values.update(zip(map(id, tensors), host))
+    return [{k: values[id(v)] if torch.is_tensor(v) else v for k, v in stats.items()} for stats in stats_list]
+
+
+class StepMetrics:
+    """Collects per step stats, which can be device tensors, and copies them to
+    host every sync_every steps, so that the training loop doesn't wait for the
+    device on every .item().
+
+    add() and sync() return the synced stats of all processes as a list of
+    (step, rank, stats) sorted by step and rank, both must be called the same
+    number of times by all processes.
+    """
+
+    def __init__(self, dist=None, sync_every=1):
+        self.dist = dist if dist is not None else distributed.SingleProcess()
+        self.sync_every = sync_every
+        self.pending = []
+
+    def add(self, step, stats):
+        self.pending.append((step, stats))
+        if len(self.pending) >= self.sync_every:
+            return self.sync()
+        return []
+
+    def sync(self):
+        pending, self.pending = self.pending, []
+        local = list(zip([step for step, _ in pending], stats_to_host([stats for _, stats in pending])))
+        gathered = self.dist.allgather_object(local)
+        return sorted([(step, rank, stats) for rank, x in enumerate(gathered) for step, stats in x], key=lambda x: x[:2])
+
+
+def nonfinite_grads(grads, nan_only=False):
+    """0-d bool tensor, True if any of the gradients contains nans (or infs, unless nan_only).
+
+    Uses one fused norm over all gradients and doesn't synchronize with the host.
+    """
+    flags = []
+    by_device = {}
+    for x in grads:
+        by_device.setdefault(x.device, []).append(x)
+    for device_grads in by_device.values():
+        # nans propagate through the sum of norms, infs can't cancel out as norms are positive
+        total = torch.stack(torch._foreach_norm(device_grads)).float().sum()
+        flags.append(total.isnan() if nan_only else ~total.isfinite())
+    if len(flags) == 0:
+        return torch.tensor(False)
+    return torch.stack([x.to(flags[0].device) for x in flags]).any()
+
+
+def zero_grads_where(grads, flag):
+    """Zeroes the gradients if the 0-d bool tensor flag is True, without synchronizing with the host"""
+    for x in grads:
+        x.masked_fill_(flag.to(x.device), 0)
+
@@ -0,0 +1,35 @@
+import math
+import torch
+
+from alphadock import metrics
+
+
+def test_step_metrics_sync_every():
+    step_metrics = metrics.StepMetrics(sync_every=3)
+    synced = []
+    for step in range(4):
+        synced += step_metrics.add(step, {'Loss': torch.tensor(step * 0.5), 'Generated_NaN': 0})
+        assert len(synced) == (3 if step >= 2 else 0)
+    synced += step_metrics.sync()
+    assert [x[:2] for x in synced] == [(step, 0) for step in range(4)]
+    assert [x[2] for x in synced] == [{'Loss': step * 0.5, 'Generated_NaN': 0} for step in range(4)]
+    assert all(isinstance(x[2]['Loss'], float) for x in synced)
+
+
+def test_nonfinite_grads():
+    grads = [torch.ones(3), torch.ones(2, 2)]
+    assert not metrics.nonfinite_grads(grads)
+
+    grads[1][0, 1] = math.inf
+    assert metrics.nonfinite_grads(grads)
+    assert not metrics.nonfinite_grads(grads, nan_only=True)
+
+    grads[0][2] = math.nan
+    assert metrics.nonfinite_grads(grads, nan_only=True)
+    metrics.zero_grads_where(grads, metrics.nonfinite_grads(grads))
+    assert all(torch.all(x == 0) for x in grads)
+
+    grads = [torch.ones(3)]
+    metrics.zero_grads_where(grads, metrics.nonfinite_grads(grads))
+    assert torch.all(grads[0] == 1)
+
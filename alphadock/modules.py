@@ -18,10 +18,162 @@ from torch import nn
 import torch.nn.functional as F
 from torch.utils.checkpoint import checkpoint
 import math
+from functools import partial
 
 from alphadock import utils
 
 
+def chunk_apply(fn, x, chunk_size, dim=1):
+    """Applies fn to slices of x along dim and concatenates the results.
+    Trades speed for peak memory when the slices are independent."""
+    if chunk_size is None or x.shape[dim] <= chunk_size:
+        return fn(x)
+    return torch.cat([fn(c) for c in torch.split(x, chunk_size, dim=dim)], dim=dim)
+
+
+def softmax(x, dim=-1):
+    """Softmax computed in float32, result has the dtype of x"""
+    return torch.softmax(x, dim=dim, dtype=torch.float32).to(x.dtype)
+
+
+ATTENTION_BACKENDS = ['einsum', 'sdpa', 'chunked', 'auto']
+
+
+def attention(q, k, v, bias=None, backend='einsum', key_chunk_size=512):
+    """Multi-head attention softmax(q k^T / sqrt(c) + bias) v.
+
+    q, k, v have shape (..., L, heads, c), bias must be broadcastable
+    to (..., heads, L_q, L_k). Returns (..., L_q, heads, c).
+
+    Backends:
+        einsum - explicit logits and softmax
+        sdpa - torch.nn.functional.scaled_dot_product_attention with additive bias
+        chunked - online softmax over chunks of keys, full logits are never stored
+        auto - sdpa if available, otherwise chunked
+    """
+    if backend == 'auto':
+        backend = 'sdpa' if hasattr(F, 'scaled_dot_product_attention') else 'chunked'
+
+    if backend == 'einsum':
+        factor = 1 / math.sqrt(q.shape[-1])
+        aff = torch.einsum('...ihc,...jhc->...hij', q*factor, k)
+        if bias is not None:
+            aff = aff + bias
+        weights = softmax(aff, dim=-1)
+        return torch.einsum('...hqk,...khc->...qhc', weights, v)
+
+    q, k, v = [x.transpose(-2, -3) for x in (q, k, v)]
+    if backend == 'sdpa':
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=None if bias is None else bias.to(q.dtype))
+    elif backend == 'chunked':
+        out = _chunked_attention(q, k, v, bias, key_chunk_size)
+    else:
+        raise ValueError(f'Unknown attention backend {backend}, expected one of {ATTENTION_BACKENDS}')
+    return out.transpose(-2, -3)
+
+
+def _chunked_attention(q, k, v, bias, key_chunk_size):
+    """Online softmax (running max and normalizer) over key chunks, q, k, v are (..., heads, L, c).
+    Computed in float32, the largest transient is (..., heads, L_q, key_chunk_size)."""
+    dtype = q.dtype
+    q = q.float() * (1 / math.sqrt(q.shape[-1]))
+    k, v = k.float(), v.float()
+    max_logit = q.new_full((*q.shape[:-1], 1), -math.inf)
+    normalizer = q.new_zeros((*q.shape[:-1], 1))
+    out = q.new_zeros((*q.shape[:-1], v.shape[-1]))
+    for start in range(0, k.shape[-2], key_chunk_size):
+        end = start + key_chunk_size
+        logits = torch.matmul(q, k[..., start:end, :].transpose(-1, -2))
+        if bias is not None:
+            logits = logits + bias[..., start:end].float()
+        new_max = torch.maximum(max_logit, logits.amax(dim=-1, keepdim=True))
+        weights = torch.exp(logits - new_max)
+        correction = torch.exp(max_logit - new_max)
+        normalizer = normalizer * correction + weights.sum(dim=-1, keepdim=True)
+        out = out * correction + torch.matmul(weights, v[..., start:end, :])
+        max_logit = new_max
+    return (out / normalizer).to(dtype)
+
+
+class LayerNorm(nn.LayerNorm):
+    """LayerNorm computed in float32, so that it's safe with bfloat16 / float16 inputs"""
+
+    def forward(self, x):
+        return F.layer_norm(x.float(), self.normalized_shape, self.weight.float(), self.bias.float(), self.eps).to(x.dtype)
+
+
+def set_chunk_size(model, chunk_size):
+    """Sets chunk size for all submodules supporting chunked evaluation (None disables chunking)"""
+    for module in model.modules():
+        if hasattr(module, 'chunk_size'):
+            module.chunk_size = chunk_size
+
+
+# activation checkpointing policies of trunk blocks:
+#   none - nothing is recomputed
+#   attention - attention submodules store only their inputs
+#   pair_stack - triangle updates, triangle attention and pair transition store only the pair input
+#   block - the whole block stores only its inputs
+CHECKPOINT_POLICIES = ['none', 'attention', 'pair_stack', 'block']
+
+ATTENTION_MODULES = [
+    'RowAttentionWithPairBias', 'MSAColumnAttention', 'MSAColumnGlobalAttention',
+    'TriangleAttentionStartingNode', 'TriangleAttentionEndingNode'
+]
+
+PAIR_STACK_MODULES = [
+    'TriangleMultiplicationOutgoing', 'TriangleMultiplicationIngoing',
+    'TriangleAttentionStartingNode', 'TriangleAttentionEndingNode', 'PairTransition'
+]
+
+
+def maybe_checkpoint(fn, *args, enabled=True):
+    """Runs fn with activation checkpointing if enabled and gradients are being computed"""
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(fn, *args)
+    return fn(*args)
+
+
+def set_checkpoint_policy(blocks, policy, every=1):
+    """Sets checkpointing policy for every k-th of the blocks, the rest are not checkpointed.
+    Policy True and False are the same as 'block' and 'none'."""
+    if policy is True or policy is False or policy is None:
+        policy = 'block' if policy else 'none'
+    assert policy in CHECKPOINT_POLICIES, f'Unknown checkpoint policy {policy}, expected one of {CHECKPOINT_POLICIES}'
+    for i, block in enumerate(blocks):
+        block.checkpoint_policy = policy if i % every == 0 else 'none'
+
+
+def make_qkvg(in_num_c, attn_num_c, num_heads):
+    """Single projection producing q, k, v and gate. AF2 has no bias for q, k and v,
+    so the projection has no bias and the gate bias is a separate parameter (see make_gate_bias)."""
+    return nn.Linear(in_num_c, 4 * attn_num_c * num_heads, bias=False)
+
+
+def make_gate_bias(in_num_c, attn_num_c, num_heads):
+    """Gate bias initialized like the bias of nn.Linear(in_num_c, attn_num_c * num_heads)"""
+    bound = 1 / math.sqrt(in_num_c)
+    return nn.Parameter(torch.empty(attn_num_c * num_heads).uniform_(-bound, bound))
+
+
+def split_qkvg(qkvg, gate_bias, x, num_heads, attn_num_c):
+    """Returns q, k, v, gate (before sigmoid) each of shape (*x.shape[:-1], num_heads, attn_num_c)"""
+    q, k, v, gate = qkvg(x).view(*x.shape[:-1], 4, num_heads, attn_num_c).unbind(-3)
+    return q, k, v, gate + gate_bias.view(num_heads, attn_num_c)
+
+
+def fuse_qkvg_state_dict(state_dict, prefix, *args):
+    """Load_state_dict pre-hook converting older checkpoints: separate q, k, v and gate
+    projections are fused into the qkvg projection and the gate bias becomes gate_bias.
+    Checkpoints with a bias over the whole fused projection keep only its gate part."""
+    names = [prefix + x + '.weight' for x in ['q', 'k', 'v', 'gate']]
+    if names[0] in state_dict:
+        state_dict[prefix + 'qkvg.weight'] = torch.cat([state_dict.pop(x) for x in names])
+        state_dict[prefix + 'gate_bias'] = state_dict.pop(prefix + 'gate.bias')
+    if prefix + 'qkvg.bias' in state_dict:
+        state_dict[prefix + 'gate_bias'] = state_dict.pop(prefix + 'qkvg.bias').chunk(4)[3]
+
+
 class RowAttentionWithPairBias(nn.Module):
     def __init__(self, config, global_config):
         super().__init__()
@@ -31,17 +183,18 @@ class RowAttentionWithPairBias(nn.Module):
         in_num_c = global_config['model']['rep1d_extra_feat'] if config['msa_extra_stack'] else global_config['model']['rep1d_feat']
         pair_rep_num_c = global_config['model']['rep2d_feat']
 
-        self.norm = nn.LayerNorm(in_num_c)
-        self.norm_2d = nn.LayerNorm(pair_rep_num_c)
-        # self.qkv = nn.Linear(in_num_c, 3 * attn_num_c * num_heads, bias=False)
-        self.q = nn.Linear(in_num_c, attn_num_c*num_heads, bias=False)
-        self.k = nn.Linear(in_num_c, attn_num_c*num_heads, bias=False)
-        self.v = nn.Linear(in_num_c, attn_num_c*num_heads, bias=False)
+        self.norm = LayerNorm(in_num_c)
+        self.norm_2d = LayerNorm(pair_rep_num_c)
+        self.qkvg = make_qkvg(in_num_c, attn_num_c, num_heads)
+        self.gate_bias = make_gate_bias(in_num_c, attn_num_c, num_heads)
         self.x2d_project = nn.Linear(pair_rep_num_c, num_heads, bias=False)
         self.final = nn.Linear(attn_num_c * num_heads, in_num_c)
-        self.gate = nn.Linear(in_num_c, attn_num_c * num_heads)
         self.attn_num_c = attn_num_c
         self.num_heads = num_heads
+        self.chunk_size = global_config['model']['chunk_size']
+        self.attention_backend = global_config['model']['attention_backend']
+        self.attention_key_chunk_size = global_config['model']['attention_key_chunk_size']
+        self._register_load_state_dict_pre_hook(fuse_qkvg_state_dict)
 
     def forward(self, x1d, x2d):
         x1d = self.norm(x1d)
@@ -49,16 +202,13 @@ class RowAttentionWithPairBias(nn.Module):
         bias = self.x2d_project(x2d)
         # bias = self.x2d_project(x2d).view(*x2d.shape[:-1], self.num_heads)
         bias = bias.permute(0, 3, 1, 2)
-        # q, k, v = torch.chunk(self.qkv(x1d).view(*x1d.shape[:-1], self.attn_num_c, 3 * self.num_heads), 3, dim=-1)
-        q = self.q(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c)
-        k = self.k(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c)
-        v = self.v(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c)
-        factor = 1 / math.sqrt(self.attn_num_c)
-        aff = torch.einsum('bmihc,bmjhc->bmhij', q*factor, k)
-        weights = torch.softmax(aff + bias, dim=-1)
-        gate = torch.sigmoid(self.gate(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c))
-        
-        out_1d = torch.einsum('bmhqk,bmkhc->bmqhc', weights, v) * gate
+        return chunk_apply(lambda x: self._attention(x, bias), x1d, self.chunk_size)
+
+    def _attention(self, x1d, bias):
+        q, k, v, gate = split_qkvg(self.qkvg, self.gate_bias, x1d, self.num_heads, self.attn_num_c)
+        # bias is shared by all MSA rows
+        out_1d = attention(q, k, v, bias[:, None], self.attention_backend, self.attention_key_chunk_size)
+        out_1d = out_1d * torch.sigmoid(gate)
         out_1d = self.final(out_1d.flatten(start_dim=-2))
         return out_1d
 
@@ -71,31 +221,30 @@ class MSAColumnAttention(nn.Module):
         num_heads = config['num_heads']
         in_num_c = global_config['model']['rep1d_feat']
 
-        self.norm = nn.LayerNorm(in_num_c)
-        self.q = nn.Linear(in_num_c, attn_num_c*num_heads, bias=False)
-        self.k = nn.Linear(in_num_c, attn_num_c*num_heads, bias=False)
-        self.v = nn.Linear(in_num_c, attn_num_c*num_heads, bias=False)
-        #self.qkv = nn.Linear(in_num_c, attn_num_c * num_heads * 3, bias=False)
+        self.norm = LayerNorm(in_num_c)
+        self.qkvg = make_qkvg(in_num_c, attn_num_c, num_heads)
+        self.gate_bias = make_gate_bias(in_num_c, attn_num_c, num_heads)
         self.final = nn.Linear(attn_num_c * num_heads, in_num_c)
-        self.gate = nn.Linear(in_num_c, attn_num_c * num_heads)
 
         self.attn_num_c = attn_num_c
         self.num_heads = num_heads
+        self.chunk_size = global_config['model']['chunk_size']
+        self.attention_backend = global_config['model']['attention_backend']
+        self.attention_key_chunk_size = global_config['model']['attention_key_chunk_size']
+        self._register_load_state_dict_pre_hook(fuse_qkvg_state_dict)
 
     def forward(self, x1d):
         x1d = x1d.transpose(-2,-3)
         x1d = self.norm(x1d)
-        gate = torch.sigmoid(self.gate(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c))
-        q = self.q(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c)
-        k = self.k(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c)
-        v = self.v(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c)
-        factor = 1 / math.sqrt(self.attn_num_c)
-        aff = torch.einsum('bmihc,bmjhc->bmhij', q*factor, k)
-        weights = torch.softmax(aff, dim=-1)
-        out_1d = torch.einsum('bmhqk,bmkhc->bmqhc', weights, v) * gate
-        out_1d = self.final(out_1d.flatten(start_dim=-2))
+        out_1d = chunk_apply(self._attention, x1d, self.chunk_size)
         out_1d = out_1d.transpose(-2,-3)
+        return out_1d
 
+    def _attention(self, x1d):
+        q, k, v, gate = split_qkvg(self.qkvg, self.gate_bias, x1d, self.num_heads, self.attn_num_c)
+        out_1d = attention(q, k, v, None, self.attention_backend, self.attention_key_chunk_size)
+        out_1d = out_1d * torch.sigmoid(gate)
+        out_1d = self.final(out_1d.flatten(start_dim=-2))
         return out_1d
 
 
@@ -105,12 +254,13 @@ class MSAColumnGlobalAttention(nn.Module):
         self.attn_num_c = config['attention_num_c']
         self.num_heads = config['num_heads']
 
-        self.norm = nn.LayerNorm(global_config['model']['rep1d_extra_feat'])
+        self.norm = LayerNorm(global_config['model']['rep1d_extra_feat'])
         self.q = nn.Linear(global_config['model']['rep1d_extra_feat'], self.attn_num_c*self.num_heads, bias=False)
         self.k = nn.Linear(global_config['model']['rep1d_extra_feat'], self.attn_num_c, bias=False)
         self.v = nn.Linear(global_config['model']['rep1d_extra_feat'], self.attn_num_c, bias=False)
         self.gate = nn.Linear(global_config['model']['rep1d_extra_feat'], self.attn_num_c * self.num_heads)
         self.final = nn.Linear(self.attn_num_c * self.num_heads, global_config['model']['rep1d_extra_feat'])
+        self.chunk_size = global_config['model']['chunk_size']
 
     def forward(self, x1d):
         x1d = x1d.transpose(-2,-3)
@@ -122,22 +272,31 @@ class MSAColumnGlobalAttention(nn.Module):
         v = self.v(x1d)
         #q, k, v = torch.split(self.kqv(x1d).view(*x1d.shape[:-1], self.attn_num_c, self.num_heads + 2), [self.num_heads, 1, 1], dim=-1)
         #q = torch.mean(q, dim=1)
-        gate =  torch.sigmoid(self.gate(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c))
-        w = torch.softmax(torch.einsum('bihc,bikc->bihk', q, k), dim=-1)
+        w = softmax(torch.einsum('bihc,bikc->bihk', q, k), dim=-1)
         out_1d = torch.einsum('bmhk,bmkc->bmhc', w, v)
-        out_1d = out_1d.unsqueeze(-3) * gate
-        out = self.final(out_1d.view(*out_1d.shape[:-2], self.attn_num_c * self.num_heads))
+        # gating and output projection are done in chunks of MSA rows,
+        # the per column attention result is shared by all of them
+        out = chunk_apply(lambda x: self._gate_and_project(x, out_1d), x1d, self.chunk_size, dim=2)
         return out.transpose(-2,-3)
 
+    def _gate_and_project(self, x1d, out_1d):
+        gate = torch.sigmoid(self.gate(x1d).view(*x1d.shape[:-1], self.num_heads, self.attn_num_c))
+        out_1d = out_1d.unsqueeze(-3) * gate
+        return self.final(out_1d.view(*out_1d.shape[:-2], self.attn_num_c * self.num_heads))
+
 
 class Transition(nn.Module):
-    def __init__(self, num_c, n):
+    def __init__(self, num_c, n, global_config):
         super().__init__()
-        self.norm = nn.LayerNorm(num_c)
+        self.norm = LayerNorm(num_c)
         self.l1 = nn.Linear(num_c, num_c * n)
         self.l2 = nn.Linear(num_c * n, num_c)
+        self.chunk_size = global_config['model']['chunk_size']
 
     def forward(self, x1d):
+        return chunk_apply(self._transition, x1d, self.chunk_size)
+
+    def _transition(self, x1d):
         x = self.norm(x1d)
         x = self.l1(x).relu_()
         x = self.l2(x)
@@ -150,51 +309,74 @@ class OuterProductMean(nn.Module):
         in_c = global_config['model']['rep1d_extra_feat'] if config['msa_extra_stack'] else global_config['model']['rep1d_feat']
         out_c = global_config['model']['rep2d_feat']
         mid_c = config['mid_c']
-        self.norm = nn.LayerNorm(in_c)
+        self.norm = LayerNorm(in_c)
         #self.proj = nn.Linear(in_c, mid_c * 2)
         self.proj_left = nn.Linear(in_c, mid_c)
         self.proj_right = nn.Linear(in_c, mid_c)
         self.final = nn.Linear(mid_c * mid_c, out_c)
         self.mid_c = mid_c
         self.out_c = out_c
+        self.chunk_size = global_config['model']['chunk_size']
 
     def forward(self, x1d):
         x1d = self.norm(x1d)
         i = self.proj_left(x1d)
         j = self.proj_right(x1d)
         #i, j = [x[..., -1] for x in torch.chunk(self.proj(x1d).view(*x1d.shape[:-1], self.mid_c, 2), 2, dim=-1)]
-        x2d = torch.einsum('bmix,bmjy->bjixy', i, j) #/ x1d.shape[1]
-        out = self.final(x2d.flatten(start_dim=-2)).transpose(-2, -3)
+        # chunk over i, the outer product tensor is the largest one here
+        out = chunk_apply(lambda x: self.final(torch.einsum('bmix,bmjy->bjixy', x, j).flatten(start_dim=-2)), i, self.chunk_size, dim=2)
+        out = out.transpose(-2, -3)
         out = out/(x1d.shape[1]+1e-3)
         return out
 
 
+TRIANGLE_MULTIPLICATION_LINEARS = ['l1i', 'l1j', 'l1i_sigm', 'l1j_sigm', 'l3_sigm']
+
+
+def fuse_linears_state_dict(names, fused_name, state_dict, prefix, *args):
+    """Load_state_dict pre-hook concatenating separate linear layers
+    from older checkpoints into the fused one"""
+    if prefix + names[0] + '.weight' not in state_dict:
+        return
+    for suffix in ['.weight', '.bias']:
+        state_dict[prefix + fused_name + suffix] = torch.cat([state_dict.pop(prefix + x + suffix) for x in names])
+
+
 class TriangleMultiplication(nn.Module):
     def __init__(self, config, global_config):
         super().__init__()
         in_c = global_config['model']['rep2d_feat']
         mid_c = config['mid_c']
         self.ingoing = config['ingoing']
-        self.norm1 = nn.LayerNorm(in_c)
-        self.norm2 = nn.LayerNorm(mid_c)
-        self.l1i = nn.Linear(in_c, mid_c)
-        self.l1j = nn.Linear(in_c, mid_c)
-        self.l1i_sigm = nn.Linear(in_c, mid_c)
-        self.l1j_sigm = nn.Linear(in_c, mid_c)
+        self.norm1 = LayerNorm(in_c)
+        self.norm2 = LayerNorm(mid_c)
+        # l1i, l1j, l1i_sigm, l1j_sigm and l3_sigm fused into one projection
+        self.proj = nn.Linear(in_c, 4 * mid_c + in_c)
         self.l2_proj = nn.Linear(mid_c, in_c)
-        self.l3_sigm = nn.Linear(in_c, in_c)
+        self.proj_sizes = [mid_c] * 4 + [in_c]
+        self.mid_c = mid_c
+        self._register_load_state_dict_pre_hook(partial(fuse_linears_state_dict, TRIANGLE_MULTIPLICATION_LINEARS, 'proj'))
+
+    def split_proj(self):
+        """Views of the fused projection parameters as {name: (weight, bias)} of the original linear layers"""
+        return dict(zip(
+            TRIANGLE_MULTIPLICATION_LINEARS,
+            zip(self.proj.weight.data.split(self.proj_sizes), self.proj.bias.data.split(self.proj_sizes))
+        ))
 
     def forward(self, x2d):
         x2d = self.norm1(x2d)
-        i = self.l1i(x2d) * torch.sigmoid(self.l1i_sigm(x2d))
-        j = self.l1j(x2d) * torch.sigmoid(self.l1j_sigm(x2d))
+        x = self.proj(x2d)
+        # single sigmoid for all three gates
+        gates = torch.sigmoid(x[..., 2 * self.mid_c:])
+        i, j = (x[..., :2 * self.mid_c] * gates[..., :2 * self.mid_c]).split(self.mid_c, dim=-1)
         if self.ingoing:
             out = torch.einsum('bkjc,bkic->bijc', i, j)
         else:
             out = torch.einsum('bikc,bjkc->bijc', i, j)
         out = self.norm2(out)
         out = self.l2_proj(out)
-        out = out * torch.sigmoid(self.l3_sigm(x2d))
+        out = out * gates[..., 2 * self.mid_c:]
         return out
 
 
@@ -208,73 +390,84 @@ class TriangleAttention(nn.Module):
         self.attention_num_c = attention_num_c
         self.num_heads = num_heads
 
-        self.norm = nn.LayerNorm(num_in_c)
-        self.q = nn.Linear(num_in_c, attention_num_c*num_heads, bias=False)
-        self.k = nn.Linear(num_in_c, attention_num_c*num_heads, bias=False)
-        self.v = nn.Linear(num_in_c, attention_num_c*num_heads, bias=False)
+        self.norm = LayerNorm(num_in_c)
+        self.qkvg = make_qkvg(num_in_c, attention_num_c, num_heads)
+        self.gate_bias = make_gate_bias(num_in_c, attention_num_c, num_heads)
         self.bias = nn.Linear(num_in_c, num_heads, bias=False)
-        self.gate = nn.Linear(num_in_c, attention_num_c * num_heads)
         self.out = nn.Linear(attention_num_c * num_heads, num_in_c)
+        self.chunk_size = global_config['model']['chunk_size']
+        self.attention_backend = global_config['model']['attention_backend']
+        self.attention_key_chunk_size = global_config['model']['attention_key_chunk_size']
+        self._register_load_state_dict_pre_hook(fuse_qkvg_state_dict)
 
     def forward(self, x2d):
         if self.ending_node:
             x2d = x2d.transpose(-2, -3)
         x2d = self.norm(x2d)
-
-        q = self.q(x2d).view(*x2d.shape[:-1], self.num_heads, self.attention_num_c)
-        k = self.k(x2d).view(*x2d.shape[:-1], self.num_heads, self.attention_num_c)
-        v = self.v(x2d).view(*x2d.shape[:-1], self.num_heads, self.attention_num_c)
-        factor = 1 / math.sqrt(self.attention_num_c)
-        aff = torch.einsum('bmihc,bmjhc->bmhij', q*factor, k)
         b = self.bias(x2d)
         b = b.permute(0, 3, 1, 2)
-        weights = torch.softmax(aff + b, dim=-1)
-        g = torch.sigmoid(self.gate(x2d).view(*x2d.shape[:-1], self.num_heads, self.attention_num_c))
-        out = torch.einsum('bmhqk,bmkhc->bmqhc', weights, v)*g
 
-        out = self.out(out.flatten(start_dim=-2))
+        out = chunk_apply(lambda x: self._attention(x, b), x2d, self.chunk_size)
         if self.ending_node:
             out = out.transpose(-2,-3)
 
         return out
 
+    def _attention(self, x2d, b):
+        q, k, v, g = split_qkvg(self.qkvg, self.gate_bias, x2d, self.num_heads, self.attention_num_c)
+        # bias is shared by all rows
+        out = attention(q, k, v, b[:, None], self.attention_backend, self.attention_key_chunk_size)
+        out = out * torch.sigmoid(g)
+        return self.out(out.flatten(start_dim=-2))
+
 
 class EvoformerIteration(nn.Module):
     def __init__(self, config, global_config):
         super().__init__()
         self.RowAttentionWithPairBias = RowAttentionWithPairBias(config['RowAttentionWithPairBias'], global_config)
         self.MSAColumnAttention = MSAColumnAttention(config['MSAColumnAttention'], global_config)
-        self.MSATransition = Transition(global_config['model']['rep1d_feat'], config['MSATransition']['n'])
+        self.MSATransition = Transition(global_config['model']['rep1d_feat'], config['MSATransition']['n'], global_config)
         self.OuterProductMean = OuterProductMean(config['OuterProductMean'], global_config)
 
         self.TriangleMultiplicationOutgoing = TriangleMultiplication(config['TriangleMultiplicationOutgoing'], global_config)
         self.TriangleMultiplicationIngoing = TriangleMultiplication(config['TriangleMultiplicationIngoing'], global_config)
         self.TriangleAttentionStartingNode = TriangleAttention(config['TriangleAttentionStartingNode'], global_config)
         self.TriangleAttentionEndingNode = TriangleAttention(config['TriangleAttentionEndingNode'], global_config)
-        self.PairTransition = Transition(global_config['model']['rep2d_feat'], config['PairTransition']['n'])
+        self.PairTransition = Transition(global_config['model']['rep2d_feat'], config['PairTransition']['n'], global_config)
 
         self.dropout1d_15 = nn.Dropout(0.15)
         self.dropout2d_15 = nn.Dropout2d(0.15)
         self.dropout2d_25 = nn.Dropout2d(0.25)
         # TODO: fix dropout everywhere
 
+        self.checkpoint_policy = 'none'  # see set_checkpoint_policy
+
     def forward(self, r1d, pair):
+        return maybe_checkpoint(self._forward, r1d, pair, enabled=self.checkpoint_policy == 'block')
+
+    def _forward(self, r1d, pair):
+        attention_ckpt = self.checkpoint_policy == 'attention'
         r1d = r1d.clone()
         pair = pair.clone()
-        a = self.RowAttentionWithPairBias(r1d.clone(), pair.clone())
+        a = maybe_checkpoint(self.RowAttentionWithPairBias, r1d.clone(), pair.clone(), enabled=attention_ckpt)
         # r1d += self.dropout1d_15(a)
         r1d += a #self.dropout2d_15(b)
-        r1d += self.MSAColumnAttention(r1d.clone())
+        r1d += maybe_checkpoint(self.MSAColumnAttention, r1d.clone(), enabled=attention_ckpt)
         r1d += self.MSATransition(r1d.clone())
         pair += self.OuterProductMean(r1d.clone())
+        pair = maybe_checkpoint(self._pair_stack, pair, enabled=self.checkpoint_policy == 'pair_stack')
+        return r1d.clone(), pair.clone()
 
+    def _pair_stack(self, pair):
+        attention_ckpt = self.checkpoint_policy == 'attention'
+        pair = pair.clone()
         pair += self.TriangleMultiplicationOutgoing(pair.clone())
         # pair += self.dropout2d_25(self.TriangleMultiplicationIngoing(pair.clone()))
         pair += self.TriangleMultiplicationIngoing(pair.clone())
-        pair += self.TriangleAttentionStartingNode(pair.clone())
-        pair += self.TriangleAttentionEndingNode(pair.clone())
+        pair += maybe_checkpoint(self.TriangleAttentionStartingNode, pair.clone(), enabled=attention_ckpt)
+        pair += maybe_checkpoint(self.TriangleAttentionEndingNode, pair.clone(), enabled=attention_ckpt)
         pair += self.PairTransition(pair.clone())
-        return r1d.clone(), pair.clone()
+        return pair
 
 
 class ExtraMsaStackIteration(torch.nn.Module):
@@ -282,35 +475,47 @@ class ExtraMsaStackIteration(torch.nn.Module):
         super().__init__()
         self.RowAttentionWithPairBias = RowAttentionWithPairBias(config['RowAttentionWithPairBias'], global_config)
         self.MSAColumnGlobalAttention = MSAColumnGlobalAttention(config['MSAColumnGlobalAttention'], global_config)
-        self.MSATransition = Transition(global_config['model']['rep1d_extra_feat'], config['MSATransition']['n'])
+        self.MSATransition = Transition(global_config['model']['rep1d_extra_feat'], config['MSATransition']['n'], global_config)
         self.OuterProductMean = OuterProductMean(config['OuterProductMean'], global_config)
         self.TriangleMultiplicationOutgoing = TriangleMultiplication(config['TriangleMultiplicationOutgoing'], global_config)
         self.TriangleMultiplicationIngoing = TriangleMultiplication(config['TriangleMultiplicationIngoing'], global_config)
         self.TriangleAttentionStartingNode = TriangleAttention(config['TriangleAttentionStartingNode'], global_config)
         self.TriangleAttentionEndingNode = TriangleAttention(config['TriangleAttentionEndingNode'], global_config)
-        self.PairTransition = Transition(global_config['model']['rep2d_feat'], config['PairTransition']['n'])
+        self.PairTransition = Transition(global_config['model']['rep2d_feat'], config['PairTransition']['n'], global_config)
 
         self.dropout1d_15 = nn.Dropout(0.15)
         self.dropout2d_15 = nn.Dropout2d(0.15)
         self.dropout2d_25 = nn.Dropout2d(0.25)
 
+        self.checkpoint_policy = 'none'  # see set_checkpoint_policy
+
     def forward(self, extra, pair):
+        return maybe_checkpoint(self._forward, extra, pair, enabled=self.checkpoint_policy == 'block')
+
+    def _forward(self, extra, pair):
+        attention_ckpt = self.checkpoint_policy == 'attention'
         pair = pair.clone()
         extra = extra.clone()
-        a = self.RowAttentionWithPairBias(extra.clone(), pair.clone())
+        a = maybe_checkpoint(self.RowAttentionWithPairBias, extra.clone(), pair.clone(), enabled=attention_ckpt)
         # extra += self.dropout1d_15(a)
         extra += a #self.dropout2d_15(b)
-        extra += self.MSAColumnGlobalAttention(extra.clone())
+        extra += maybe_checkpoint(self.MSAColumnGlobalAttention, extra.clone(), enabled=attention_ckpt)
         extra += self.MSATransition(extra.clone())
         pair += self.OuterProductMean(extra.clone())
+        pair = maybe_checkpoint(self._pair_stack, pair, enabled=self.checkpoint_policy == 'pair_stack')
+        return extra.clone(), pair.clone()
+
+    def _pair_stack(self, pair):
+        attention_ckpt = self.checkpoint_policy == 'attention'
+        pair = pair.clone()
         # pair += self.dropout2d_25(self.TriangleMultiplicationOutgoing(pair.clone()))
         pair += self.TriangleMultiplicationOutgoing(pair.clone())
         # pair += self.dropout2d_25(self.TriangleMultiplicationIngoing(pair.clone()))
         pair += self.TriangleMultiplicationIngoing(pair.clone())
-        pair += self.TriangleAttentionStartingNode(pair.clone())
-        pair += self.TriangleAttentionEndingNode(pair.clone())
+        pair += maybe_checkpoint(self.TriangleAttentionStartingNode, pair.clone(), enabled=attention_ckpt)
+        pair += maybe_checkpoint(self.TriangleAttentionEndingNode, pair.clone(), enabled=attention_ckpt)
         pair += self.PairTransition(pair.clone())
-        return extra.clone(), pair.clone()
+        return pair
 
 
 class ExtraMsaStack(nn.Module):
@@ -323,10 +528,7 @@ class ExtraMsaStack(nn.Module):
     def forward(self, extra, pair):
         extra = self.project(extra)
         for l in self.layers:
-            if self.config['ExtraMsaStackIteration']['checkpoint']:
-                extra, pair = checkpoint(l, extra, pair)
-            else:
-                extra, pair = l(extra, pair)
+            extra, pair = l(extra, pair)
         return pair
 
 
@@ -358,8 +560,8 @@ class InitPairRepresentation(torch.nn.Module):
 class RecyclingEmbedder(torch.nn.Module):
     def __init__(self, config, global_config):
         super().__init__()
-        self.rec_norm = nn.LayerNorm(global_config['model']['rep1d_feat'])
-        self.x2d_norm = nn.LayerNorm(global_config['model']['rep2d_feat'])
+        self.rec_norm = LayerNorm(global_config['model']['rep1d_feat'])
+        self.x2d_norm = LayerNorm(global_config['model']['rep2d_feat'])
         self.rr_proj = nn.Linear(config['rec_num_bins'], global_config['model']['rep2d_feat'])
         self.config = config
 
@@ -367,12 +569,14 @@ class RecyclingEmbedder(torch.nn.Module):
         rec_1d = self.rec_norm(inputs['rec_1d_prev'])
         rep_2d = self.x2d_norm(inputs['rep_2d_prev'])
 
-        rec_crd = inputs['rec_cbeta_prev'][0]
-        rec_mask = inputs['rec_mask_prev'][0]
+        # distances are always computed in float32
+        rec_crd = inputs['rec_cbeta_prev'][0].float()
+        rec_mask = inputs['rec_mask_prev'][0].float()
         assert len(rec_crd.shape) == 2 and rec_crd.shape[-1] == 3, rec_crd.shape
         dmat = torch.sqrt(torch.square(rec_crd[:, None, :] - rec_crd[None, :, :]).sum(-1) + 10e-10)
         dgram = utils.dmat_to_dgram(dmat, self.config['rec_min_dist'], self.config['rec_max_dist'], self.config['rec_num_bins'])[1]
-        rep_2d[0] += self.rr_proj(dgram * rec_mask[:, None, None] * rec_mask[None, :, None])
+        dgram = dgram * rec_mask[:, None, None] * rec_mask[None, :, None]
+        rep_2d[0] += self.rr_proj(dgram.to(self.rr_proj.weight.dtype))
         return {'pair_update': rep_2d, 'rec_1d_update': rec_1d}
 
 
@@ -397,10 +601,10 @@ class InputEmbedder(torch.nn.Module):
     def _zero_init_recycling(pair, rec_1d):
         num_batch, seq_len, rec_2d_c = pair.shape[0], pair.shape[1], pair.shape[-1]
         return {
-            'rec_1d_prev': torch.zeros(num_batch, seq_len, rec_1d.shape[-1]),
-            'rep_2d_prev': torch.zeros(num_batch, seq_len, seq_len, rec_2d_c),
-            'rec_cbeta_prev': torch.zeros(num_batch, seq_len, 3),
-            'rec_mask_prev': torch.zeros(num_batch, seq_len)
+            'rec_1d_prev': torch.zeros(num_batch, seq_len, rec_1d.shape[-1], device=pair.device, dtype=rec_1d.dtype),
+            'rep_2d_prev': torch.zeros(num_batch, seq_len, seq_len, rec_2d_c, device=pair.device, dtype=pair.dtype),
+            'rec_cbeta_prev': torch.zeros(num_batch, seq_len, 3, device=pair.device),
+            'rec_mask_prev': torch.zeros(num_batch, seq_len, device=pair.device)
         }
 
     def modules_to_devices(self):
@@ -410,14 +614,36 @@ class InputEmbedder(torch.nn.Module):
         self.ExtraMsaStack.to(self.config['ExtraMsaStack']['device'])
         self.RecyclingEmbedder.to(self.config['device'])
 
-    def forward(self, inputs, recycling=None):
+    def embed_invariant(self, inputs):
+        """Part of the embedding which doesn't depend on recycling. It can be computed
+        once per sample and passed to forward() for all recycling iterations."""
         # create pair representation
-        pair = self.InitPairRepresentation({k: v.to(self.config['device']) for k, v in inputs['target'].items()})
+        target = {k: self._to_input(v, self.config['device']) for k, v in inputs['target'].items()}
+        pair = self.InitPairRepresentation(target)
 
         # make lig 1d rep
-        rec_1d = self.rec_1d_project(inputs['target']['rec_1d'].to(self.config['device'])).unsqueeze(1)
+        rec_1d = self.rec_1d_project(target['rec_1d']).unsqueeze(1)
         if 'msa' in inputs:
-            rec_1d = self.main_msa_project(inputs['msa']['main'].to(self.config['device'])) + rec_1d.clone()
+            rec_1d = self.main_msa_project(self._to_input(inputs['msa']['main'], self.config['device'])) + rec_1d.clone()
+
+        out = {'r1d': rec_1d, 'pair': pair}
+        if 'msa' in inputs and 'extra' in inputs['msa']:
+            out['extra'] = self._to_input(inputs['msa']['extra'], self.config['ExtraMsaStack']['device'])
+        return out
+
+    def _to_input(self, x, device):
+        # float features are cast to the dtype of the embedder weights
+        if x.is_floating_point():
+            return x.to(device=device, dtype=self.rec_1d_project.weight.dtype)
+        return x.to(device)
+
+    def forward(self, inputs, recycling=None, embedded=None):
+        if embedded is None:
+            embedded = self.embed_invariant(inputs)
+
+        # embedded can be reused, so it must not be modified in place
+        pair = embedded['pair'].clone()
+        rec_1d = embedded['r1d'].clone()
 
         # initiaze recycling if firt iteration
         if self.global_config['model']['recycling_on'] and recycling is None:
@@ -430,9 +656,9 @@ class InputEmbedder(torch.nn.Module):
             rec_1d[:, 0] += recyc_out['rec_1d_update']
 
         # embed extra stack
-        if 'msa' in inputs and 'extra' in inputs['msa']:
+        if 'extra' in embedded:
             pair = self.ExtraMsaStack(
-                inputs['msa']['extra'].to(self.config['ExtraMsaStack']['device']),
+                embedded['extra'],
                 pair.to(self.config['ExtraMsaStack']['device'])
             )
 
@@ -0,0 +1,68 @@
+import torch
+
+from alphadock import modules
+from alphadock import config
+
+
+def test_load_unfused_qkvg():
+    torch.manual_seed(0)
+    attn = modules.TriangleAttention(config.config['model']['Evoformer']['EvoformerIteration']['TriangleAttentionStartingNode'], config.config).eval()
+    h, c = attn.num_heads, attn.attention_num_c
+    state = {k: v for k, v in attn.state_dict().items() if not k.startswith('qkvg.')}
+    for name in ['q', 'k', 'v', 'gate']:
+        state[name + '.weight'] = torch.randn(h * c, attn.qkvg.in_features)
+    state['gate.bias'] = torch.randn(h * c)
+    unfused = dict(state)
+    attn.load_state_dict(state)
+    assert attn.qkvg.bias is None
+
+    x = torch.randn(1, 5, 5, attn.qkvg.in_features)
+    q, k, v, g = modules.split_qkvg(attn.qkvg, attn.gate_bias, x, h, c)
+    assert torch.allclose(q, (x @ unfused['q.weight'].T).view(1, 5, 5, h, c), atol=1e-5)
+    assert torch.allclose(g, (x @ unfused['gate.weight'].T + unfused['gate.bias']).view(1, 5, 5, h, c), atol=1e-5)
+
+    # fused projection with a bias over q, k, v and gate
+    state = {k: v for k, v in attn.state_dict().items() if k != 'gate_bias'}
+    state['qkvg.bias'] = torch.cat([torch.randn(3 * h * c), unfused['gate.bias']])
+    attn.load_state_dict(state)
+    assert torch.equal(attn.gate_bias, unfused['gate.bias'])
+
+
+def test_load_unfused_triangle_multiplication():
+    torch.manual_seed(0)
+    tri_mul = modules.TriangleMultiplication(config.config['model']['Evoformer']['EvoformerIteration']['TriangleMultiplicationIngoing'], config.config).eval()
+    state = {k: v for k, v in tri_mul.state_dict().items() if not k.startswith('proj.')}
+    for name, size in zip(modules.TRIANGLE_MULTIPLICATION_LINEARS, tri_mul.proj_sizes):
+        state[name + '.weight'] = torch.randn(size, tri_mul.proj.in_features)
+        state[name + '.bias'] = torch.randn(size)
+    tri_mul.load_state_dict(state)
+
+    x2d = torch.randn(1, 5, 5, tri_mul.proj.in_features)
+    with torch.no_grad():
+        x = tri_mul.norm1(x2d)
+        lin = lambda name: x @ state[name + '.weight'].T + state[name + '.bias']
+        i = lin('l1i') * torch.sigmoid(lin('l1i_sigm'))
+        j = lin('l1j') * torch.sigmoid(lin('l1j_sigm'))
+        ref = tri_mul.l2_proj(tri_mul.norm2(torch.einsum('bkjc,bkic->bijc', i, j))) * torch.sigmoid(lin('l3_sigm'))
+        assert torch.allclose(tri_mul(x2d), ref, atol=1e-5)
+
+
+def test_attention_backends():
+    torch.manual_seed(0)
+    q, k, v = torch.randn(3, 2, 4, 11, 8, 16).unbind(0)
+    bias = torch.randn(2, 1, 8, 11, 11)
+    ref = modules.attention(q, k, v, bias, 'einsum')
+    for backend in ['sdpa', 'chunked', 'auto']:
+        out = modules.attention(q, k, v, bias, backend, key_chunk_size=3)
+        assert out.shape == ref.shape
+        assert torch.allclose(out, ref, atol=1e-5)
+
+
+def test_chunked_global_attention():
+    torch.manual_seed(0)
+    attn = modules.MSAColumnGlobalAttention(config.config['model']['InputEmbedder']['ExtraMsaStack']['ExtraMsaStackIteration']['MSAColumnGlobalAttention'], config.config)
+    x1d = torch.randn(1, 10, 7, config.config['model']['rep1d_extra_feat'])
+    with torch.no_grad():
+        ref = attn(x1d)
+        attn.chunk_size = 3
+        assert torch.allclose(attn(x1d), ref, atol=1e-6)
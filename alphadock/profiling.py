@@ -0,0 +1,334 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import re
+import time
+import weakref
+import contextlib
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from path import Path
+
+from alphadock import modules
+from alphadock import structure
+from alphadock import utils
+
+
+# modules which are timed when a Profiler is attached to the model,
+# all-atom and loss are timed by section() in DockerIteration.forward
+PROFILED_MODULES = (
+    modules.InputEmbedder,
+    modules.InitPairRepresentation,
+    modules.RecyclingEmbedder,
+    modules.ExtraMsaStack,
+    modules.ExtraMsaStackIteration,
+    modules.EvoformerIteration,
+    modules.RowAttentionWithPairBias,
+    modules.MSAColumnAttention,
+    modules.MSAColumnGlobalAttention,
+    modules.Transition,
+    modules.OuterProductMean,
+    modules.TriangleMultiplication,
+    modules.TriangleAttention,
+    structure.StructureModule,
+    structure.StructureModuleIteration,
+    structure.InvariantPointAttention,
+    structure.PredictSidechains,
+    structure.PredictLDDT,
+    structure.PredictDistogram,
+)
+
+# stats recorded outside of Profiler.sample() are aggregated under this name
+OTHER = 'other'
+
+# the profiler which section() reports to, see Profiler.activate
+_ACTIVE = None
+
+
+class CudaMemory:
+    """Allocated memory of a CUDA device in bytes"""
+
+    def __init__(self, device):
+        self.device = device
+
+    def synchronize(self):
+        torch.cuda.synchronize(self.device)
+
+    def current(self):
+        return torch.cuda.memory_allocated(self.device)
+
+    def peak(self):
+        return torch.cuda.max_memory_allocated(self.device)
+
+    def reset_peak(self):
+        torch.cuda.reset_peak_memory_stats(self.device)
+
+
+class HostMemory:
+    """Resident set size of the process in bytes. The peak is read from
+    /proc/self/status and reset through /proc/self/clear_refs, so it's
+    only available on Linux, elsewhere all values are 0."""
+
+    def __init__(self):
+        self.available = os.path.exists('/proc/self/clear_refs')
+
+    def synchronize(self):
+        pass
+
+    def _status(self, field):
+        if not self.available:
+            return 0
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def current(self):
+        return self._status('VmRSS:')
+
+    def peak(self):
+        return self._status('VmHWM:')
+
+    def reset_peak(self):
+        if self.available:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+
+
+class TensorMemory(TorchDispatchMode):
+    """Bytes of tensor storages allocated by torch operators inside this context
+    and still referenced. Unlike HostMemory it is exact and works on any device,
+    so it's used to validate the analytical estimates in memory.py on CPU.
+
+    Storages are released when the last tensor referencing them is garbage collected.
+    Tensors kept alive only by autograd are not seen, so use it under torch.no_grad().
+
+    > with TensorMemory() as tracker:
+    >     model(inputs)
+    > tracker.peak()
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.storages = {}
+        self.allocated = 0
+        self.max_allocated = 0
+
+    def synchronize(self):
+        pass
+
+    def current(self):
+        return self.allocated
+
+    def peak(self):
+        return self.max_allocated
+
+    def reset_peak(self):
+        self.max_allocated = self.allocated
+
+    def _release(self, ptr):
+        storage = self.storages[ptr]
+        storage[0] -= 1
+        if storage[0] == 0:
+            self.allocated -= storage[1]
+            del self.storages[ptr]
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        # outputs sharing storage with an input are views or in-place results
+        inputs = {x.untyped_storage().data_ptr() for x in tree_flatten((args, kwargs))[0] if isinstance(x, torch.Tensor)}
+        for x in tree_flatten(out)[0]:
+            if not isinstance(x, torch.Tensor):
+                continue
+            ptr = x.untyped_storage().data_ptr()
+            if ptr in self.storages:
+                self.storages[ptr][0] += 1
+            elif ptr != 0 and ptr not in inputs:
+                self.storages[ptr] = [1, x.untyped_storage().nbytes()]
+                self.allocated += self.storages[ptr][1]
+                self.max_allocated = max(self.max_allocated, self.allocated)
+            else:
+                continue
+            weakref.finalize(x, self._release, ptr)
+        return out
+
+
+def sample_sizes(inputs):
+    """Sizes of the input features which the cost of a sample depends on"""
+    sizes = {'num_res': inputs['target']['rec_aatype'].shape[-1]}
+    if 'msa' in inputs:
+        for key in ['main', 'extra']:
+            if key in inputs['msa']:
+                sizes[f'{key}_msa_depth'] = inputs['msa'][key].shape[1]
+    return sizes
+
+
+def block_name(name):
+    """Module name with block indices replaced by *, e.g. Evoformer.*.TriangleAttentionStartingNode"""
+    return re.sub(r'\.\d+(?=\.|$)', '.*', name)
+
+
+@contextlib.contextmanager
+def section(name):
+    """Records wall time and peak memory of the enclosed code if a Profiler is active"""
+    profiler = _ACTIVE
+    if profiler is not None:
+        depth = profiler.enter(name)
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.exit(depth)
+
+
+def sample(name, **sizes):
+    """Profiler.sample() of the active profiler, no-op if there is none"""
+    if _ACTIVE is None:
+        return contextlib.nullcontext()
+    return _ACTIVE.sample(name, **sizes)
+
+
+class Profiler:
+    """Records wall time and peak memory of the submodules in PROFILED_MODULES
+    and of the code in section() blocks.
+
+    Peak memory of a module is the peak over its whole call including submodules,
+    GPU memory if device is a CUDA device and process RSS otherwise. On GPU
+    every call is synchronized with the device, so the profiled run is slower.
+
+    > profiler = Profiler(device)
+    > profiler.attach(model)
+    > with profiler, sample('000000', **sample_sizes(inputs)):
+    >     model(inputs)
+    > profiler.save(out_dir)
+    """
+
+    def __init__(self, device='cpu'):
+        device = torch.device(device)
+        self.memory = CudaMemory(device) if device.type == 'cuda' else HostMemory()
+        self.device = str(device)
+        self.stack = []
+        self.samples = {}
+        self.events = []
+        self.current_sample = OTHER
+        self.handles = []
+        self.start_time = time.perf_counter()
+
+    def attach(self, model, prefix=''):
+        def pre_hook(module, input):
+            self.enter(names[module])
+
+        def hook(module, input, output):
+            self.exit()
+
+        names = {}
+        for name, module in model.named_modules(prefix=prefix):
+            if isinstance(module, PROFILED_MODULES):
+                names[module] = name
+                self.handles.append(module.register_forward_pre_hook(pre_hook))
+                self.handles.append(module.register_forward_hook(hook))
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def activate(self):
+        """Makes section() and sample() report to this profiler"""
+        global _ACTIVE
+        _ACTIVE = self
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, *args):
+        global _ACTIVE
+        _ACTIVE = None
+
+    def _update_peaks(self):
+        peak = self.memory.peak()
+        for frame in self.stack:
+            frame['peak'] = max(frame['peak'], peak)
+        self.memory.reset_peak()
+
+    def enter(self, name):
+        self.memory.synchronize()
+        self._update_peaks()
+        memory = self.memory.current()
+        self.stack.append({'name': name, 'start': time.perf_counter(), 'memory': memory, 'peak': memory})
+        return len(self.stack) - 1
+
+    def exit(self, depth=None):
+        """Records the innermost frame, or the frame at depth returned by enter(),
+        in which case the frames above it are dropped (modules which raised an exception
+        are never exited)"""
+        self.memory.synchronize()
+        end = time.perf_counter()
+        self._update_peaks()
+        if depth is not None:
+            del self.stack[depth + 1:]
+        frame = self.stack.pop()
+
+        stats = self.samples.setdefault(self.current_sample, {'sizes': {}, 'modules': {}})['modules']
+        stats = stats.setdefault(frame['name'], {'calls': 0, 'time': 0.0, 'peak_memory': 0, 'peak_increase': 0})
+        stats['calls'] += 1
+        stats['time'] += end - frame['start']
+        stats['peak_memory'] = max(stats['peak_memory'], frame['peak'])
+        stats['peak_increase'] = max(stats['peak_increase'], frame['peak'] - frame['memory'])
+
+        self.events.append({
+            'name': frame['name'],
+            'ph': 'X',
+            'ts': (frame['start'] - self.start_time) * 1e6,
+            'dur': (end - frame['start']) * 1e6,
+            'pid': os.getpid(),
+            'tid': 0,
+            'args': {'sample': self.current_sample, 'memory': frame['memory'], 'peak_memory': frame['peak']}
+        })
+
+    @contextlib.contextmanager
+    def sample(self, name, **sizes):
+        """Stats recorded inside this block are aggregated under the sample name,
+        sizes (e.g. from sample_sizes()) are saved with them"""
+        self.current_sample = name
+        self.samples.setdefault(name, {'sizes': {}, 'modules': {}})['sizes'].update(sizes)
+        try:
+            with section('sample'):
+                yield
+        finally:
+            self.current_sample = OTHER
+
+    def summary(self):
+        """Stats of all samples with the Evoformer and extra MSA blocks merged (see block_name)"""
+        summary = {}
+        for sample in self.samples.values():
+            for name, stats in sample['modules'].items():
+                total = summary.setdefault(block_name(name), {'calls': 0, 'time': 0.0, 'peak_memory': 0, 'peak_increase': 0})
+                total['calls'] += stats['calls']
+                total['time'] += stats['time']
+                total['peak_memory'] = max(total['peak_memory'], stats['peak_memory'])
+                total['peak_increase'] = max(total['peak_increase'], stats['peak_increase'])
+        return summary
+
+    def save(self, out_dir, prefix='profile'):
+        """Writes <prefix>.json with per sample and summary stats (times in seconds,
+        memory in bytes) and <prefix>_trace.json which can be opened in chrome://tracing or Perfetto"""
+        out_dir = Path(out_dir).mkdir_p()
+        utils.write_json({'device': self.device, 'samples': self.samples, 'summary': self.summary()}, out_dir / f'{prefix}.json')
+        utils.write_json({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, out_dir / f'{prefix}_trace.json')
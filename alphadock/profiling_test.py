@@ -0,0 +1,48 @@
+import json
+import torch
+
+from alphadock import config
+from alphadock import modules
+from alphadock import profiling
+
+
+def test_profiler(tmp_path):
+    model = torch.nn.ModuleDict({'blocks': torch.nn.ModuleList([modules.Transition(8, 2, config.config) for _ in range(2)])})
+    profiler = profiling.Profiler('cpu')
+    profiler.attach(model)
+
+    with profiling.section('unused'):
+        pass
+    with profiler:
+        for name in ['a', 'b']:
+            with profiling.sample(name, num_res=4):
+                x = torch.ones(4, 8)
+                for block in model['blocks']:
+                    x = block(x)
+                with profiling.section('loss'):
+                    x.sum()
+        with profiling.sample('c'):
+            # frames of the module which raised are dropped
+            try:
+                model['blocks'][0](torch.ones(4, 3))
+            except RuntimeError:
+                pass
+    assert profiling._ACTIVE is None and profiler.stack == []
+
+    assert set(profiler.samples) == {'a', 'b', 'c'}
+    assert profiler.samples['a']['sizes'] == {'num_res': 4}
+    assert set(profiler.samples['a']['modules']) == {'blocks.0', 'blocks.1', 'loss', 'sample'}
+    assert profiler.samples['a']['modules']['blocks.0']['calls'] == 1
+    summary = profiler.summary()
+    assert summary['blocks.*']['calls'] == 4 and summary['sample']['calls'] == 3
+    assert summary['sample']['time'] >= summary['blocks.*']['time']
+
+    profiler.save(tmp_path)
+    assert json.loads((tmp_path / 'profile.json').read_text())['summary']['loss']['calls'] == 2
+    events = json.loads((tmp_path / 'profile_trace.json').read_text())['traceEvents']
+    assert len(events) == 9 and all(x['ph'] == 'X' for x in events)
+
+    profiler.detach()
+    with profiler, profiling.sample('d'):
+        model['blocks'][0](torch.ones(4, 8))
+    assert set(profiler.samples['d']['modules']) == {'sample'}
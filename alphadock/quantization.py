@@ -0,0 +1,51 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import torch
+from torch import nn
+
+
+# submodules of DockerIteration whose linear layers are quantized
+QUANTIZED_PARTS = ['Evoformer', 'InputEmbedder.ExtraMsaStack']
+
+# projections producing attention logit biases are left in float32,
+# they are tiny and errors there are amplified by the softmax
+EXCLUDED_LINEARS = ['x2d_project', 'bias']
+
+
+def quantizable_linears(model, parts=QUANTIZED_PARTS, excluded=EXCLUDED_LINEARS):
+    names = []
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Linear):
+            continue
+        if not any(name.startswith(x + '.') for x in parts):
+            continue
+        if name.split('.')[-1] in excluded:
+            continue
+        names.append(name)
+    return names
+
+
+def quantize_trunk(model, parts=QUANTIZED_PARTS, excluded=EXCLUDED_LINEARS):
+    """Dynamic int8 quantization of the linear layers in Evoformer and extra MSA stack.
+
+    Weights are converted to int8 once, activations are quantized on the fly,
+    so no calibration is needed. Quantized layers run on CPU only and the trunk
+    must be in float32. Model is modified in place and returned.
+    """
+    assert model.trunk_dtype == torch.float32, 'Quantization requires float32 trunk'
+    assert all(p.device.type == 'cpu' for p in model.parameters()), 'Quantized model must be on CPU'
+    names = quantizable_linears(model, parts, excluded)
+    return torch.ao.quantization.quantize_dynamic(model, set(names), dtype=torch.qint8, inplace=True)
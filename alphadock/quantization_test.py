@@ -0,0 +1,27 @@
+import torch
+
+from alphadock import docker
+from alphadock import inference
+from alphadock import quantization
+from alphadock import utils
+
+
+def test_quantize_trunk():
+    config_dict = utils.merge_dicts(inference.make_config('cpu'), {'model': {
+        'Evoformer': {'num_iter': 1},
+        'InputEmbedder': {'ExtraMsaStack': {'num_iter': 1}}
+    }})
+    model = docker.DockerIteration(config_dict['model'], config_dict).eval()
+    names = quantization.quantizable_linears(model)
+    assert 'Evoformer.0.TriangleMultiplicationIngoing.proj' in names
+    assert 'Evoformer.0.TriangleAttentionStartingNode.bias' not in names
+    assert 'StructureModule.StructureModuleIteration.backbone_update' not in names
+
+    r1d, pair = torch.randn(1, 3, 8, 256), torch.randn(1, 8, 8, 128)
+    with torch.no_grad():
+        ref = model.Evoformer[0](r1d, pair)
+        model = quantization.quantize_trunk(model)
+        out = model.Evoformer[0](r1d, pair)
+    assert type(model.Evoformer[0].MSATransition.l1) is not torch.nn.Linear
+    assert type(model.Evoformer[0].RowAttentionWithPairBias.x2d_project) is torch.nn.Linear
+    assert (out[1] - ref[1]).abs().mean() < 0.1 * ref[1].abs().mean()
@@ -223,7 +223,7 @@ class QuatAffine(object):
             translation = torch.movedim(translation, -1, 0)  # Unstack.
 
         if normalize and quaternion is not None:
-            quaternion = quaternion / torch.linalg.norm(quaternion, axis=-1, keepdims=True)
+            quaternion = quaternion / torch.linalg.norm(quaternion.float(), axis=-1, keepdims=True).clamp_min(1e-12).to(quaternion.dtype)
 
         if rotation is None:
             rotation = quat_to_rot(quaternion)
@@ -0,0 +1,62 @@
+# Copyright © 2022 Applied BioComputation Group, Stony Brook University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import heapq
+from path import Path
+
+
+def count_a3m_sequences(a3m_file):
+    with open(a3m_file, 'r') as f:
+        return sum(1 for line in f if line.startswith('>'))
+
+
+def estimate_cost(num_res, msa_depth):
+    """Relative cost of running the model on a target.
+
+    Pair stack (triangle updates and attention) scales as N_res^3, MSA stack
+    (row attention, outer product mean) as N_res^2 * MSA depth.
+    """
+    return num_res ** 2 * (num_res + msa_depth)
+
+
+def estimate_item_cost(item, config_data, dataset_dir='.'):
+    """Cost of a batch_json item, MSA depth is capped by the featurization limits"""
+    num_res = len(item['entity_info']['pdbx_seq_one_letter_code_can'])
+    if config_data['crop_size'] is not None:
+        num_res = min(num_res, config_data['crop_size'])
+    msa_depth = sum(count_a3m_sequences(Path(dataset_dir) / x) for x in item['a3m_files'])
+    msa_depth = min(msa_depth, config_data['msa_max_clusters'] + config_data['msa_max_extra'])
+    return estimate_cost(num_res, msa_depth)
+
+
+def lpt_schedule(costs, num_ranks):
+    """Longest-processing-time-first assignment of jobs to ranks.
+
+    Jobs are taken in the order of decreasing cost, each one goes to the
+    currently least loaded rank. Returns a list of job indices for every rank,
+    the most expensive ones first, so that OOM failures surface early.
+    """
+    order = sorted(range(len(costs)), key=lambda x: costs[x], reverse=True)
+    loads = [(0, rank) for rank in range(num_ranks)]
+    schedule = [[] for _ in range(num_ranks)]
+    for job in order:
+        load, rank = heapq.heappop(loads)
+        schedule[rank].append(job)
+        heapq.heappush(loads, (load + costs[job], rank))
+    return schedule
+
+
+def is_oom_error(error):
+    return isinstance(error, RuntimeError) and 'out of memory' in str(error)
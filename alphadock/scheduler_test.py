@@ -0,0 +1,21 @@
+from alphadock import scheduler
+
+
+def test_lpt_schedule():
+    costs = [1, 10, 3, 7, 2, 5]
+    schedule = scheduler.lpt_schedule(costs, 2)
+    assert sorted(sum(schedule, [])) == list(range(len(costs)))
+    assert [sum(costs[x] for x in rank) for rank in schedule] == [14, 14]
+    assert schedule[0][0] == 1
+
+    schedule = scheduler.lpt_schedule(costs, 8)
+    assert sum(len(x) > 0 for x in schedule) == len(costs)
+
+
+def test_estimate_item_cost(tmp_path):
+    (tmp_path / 'a.a3m').write_text('>q\nMKV\n>1\nMKI\n>2\nMRV\n')
+    item = {'entity_info': {'pdbx_seq_one_letter_code_can': 'MKV'}, 'a3m_files': ['a.a3m', 'a.a3m']}
+    config_data = {'crop_size': None, 'msa_max_clusters': 2, 'msa_max_extra': 8}
+    assert scheduler.estimate_item_cost(item, config_data, tmp_path) == scheduler.estimate_cost(3, 6)
+    config_data['msa_max_extra'] = 1
+    assert scheduler.estimate_item_cost(item, config_data, tmp_path) == scheduler.estimate_cost(3, 3)
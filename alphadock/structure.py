@@ -100,8 +100,10 @@ class InvariantPointAttention(torch.nn.Module):
         attn_2d = math.sqrt(1.0/num_logit_terms) * attn_2d
         attn_logits = attn_logits + attn_2d
         attn = torch.softmax(attn_logits, dim=-1)
-        result_scalar = torch.matmul(attn, v)
-        result_point_global = [torch.sum(attn[..., None] * vx[...,None,:,:], dim=-2) for vx in v_point_final]
+        # attention weights are needed explicitly for the pair output below,
+        # so scalar and point values are aggregated with a single matmul
+        result = torch.matmul(attn, torch.cat([v, *v_point_final], dim=-1))
+        result_scalar, *result_point_global = torch.split(result, [self.num_scalar_v] + [self.num_point_v] * 3, dim=-1)
 
         result_scalar = result_scalar.transpose(-2, -3)
         result_point_global = [x.transpose(-2, -3) for x in result_point_global]
@@ -202,7 +204,7 @@ class StructureModuleIteration(torch.nn.Module):
         self.PredictSidechains = PredictSidechains(config['PredictSidechains'], global_config)
         self.PredictRecLDDT = PredictLDDT(config['PredictRecLDDT'], global_config)
 
-    def forward(self, rec_1d_init, rec_1d, rep_2d, rec_T, rec_torsions):
+    def forward(self, rec_1d_init, rec_1d, rep_2d, rec_T, rec_torsions, compute_heads=True):
         #rec_1d_init, rec_1d, rep_2d, rec_T = inputs['rec_1d_init'], inputs['rec_1d'], inputs['rep_2d'], inputs['rec_T']
 
         # IPA
@@ -217,6 +219,10 @@ class StructureModuleIteration(torch.nn.Module):
         rec_T = quat_affine.QuatAffine.from_tensor(rec_T)
         rec_T = rec_T.pre_compose(self.backbone_update(rec_1d.clone()))
 
+        # backbone is all that's needed for the next recycling iteration
+        if not compute_heads:
+            return rec_1d, rec_T.to_tensor(), rec_torsions, None
+
         # sidechains
         rec_torsions = rec_torsions + self.PredictSidechains(rec_1d, rec_1d_init)
 
@@ -255,7 +261,9 @@ class StructureModule(torch.nn.Module):
         self.config = config
         self.global_config = global_config
 
-    def forward(self, inputs):
+    def forward(self, inputs, compute_heads=True):
+        """If compute_heads is False, only the backbone trajectory is computed:
+        torsions stay at their initial values, LDDT and distogram are not predicted"""
         # batch size must be one
         assert inputs['r1d'].shape[0] == 1
 
@@ -294,7 +302,7 @@ class StructureModule(torch.nn.Module):
                 struct_traj[-1]['rec_T'],
                 struct_traj[-1]['rec_torsions']
             ]
-            update = l(*args)
+            update = l(*args, compute_heads=compute_heads)
             struct_traj.append(
                 {
                     'rec_1d_init': rec_1d_init,
@@ -306,13 +314,15 @@ class StructureModule(torch.nn.Module):
                 }
             )
 
-        return {
+        out = {
             'rec_T': torch.stack([x['rec_T'] for x in struct_traj[1:]], dim=1),
             'rec_torsions': torch.stack([x['rec_torsions'] for x in struct_traj[1:]], dim=1),
-            'rec_1d': struct_traj[-1]['rec_1d'],
-            'rec_lddt': torch.stack([x['rec_lddt'] for x in struct_traj[1:]], dim=1),
-            'distogram': self.pred_distogram(pair, rec_1d.shape[1])
+            'rec_1d': struct_traj[-1]['rec_1d']
         }
+        if compute_heads:
+            out['rec_lddt'] = torch.stack([x['rec_lddt'] for x in struct_traj[1:]], dim=1)
+            out['distogram'] = self.pred_distogram(pair, rec_1d.shape[1])
+        return out
 
 
 if __name__ == '__main__':
@@ -18,6 +18,7 @@ import torch.optim as optim
 import torch.nn.functional as F
 import logging
 import sys
+import contextlib
 from copy import deepcopy
 from path import Path
 import math
@@ -32,6 +33,13 @@ from alphadock import config
 from alphadock import dataset
 from alphadock import all_atom
 from alphadock import utils
+from alphadock import async_writer
+from alphadock import distributed
+from alphadock import metrics
+from alphadock import checkpoint
+from alphadock import profiling
+from alphadock import memory
+from alphadock import modules
 
 #import warnings
 #warnings.filterwarnings("error")
@@ -48,21 +56,29 @@ DATALOADER_KWARGS = {'num_workers': 0, 'pin_memory': True}
 CONFIG_DICT = deepcopy(config.config)
 TB_WRITE_STEP = False
 SAVE_MODEL_EVERY_NEPOCHS = 1
+SAVE_MODEL_EVERY_NSTEPS = None
 
 MAX_NAN_ITER_FRAC = 0.05
 CLIP_GRADIENT = True
 CLIP_GRADIENT_VALUE = 0.1
 USE_AMP = False
 USE_AMP_SCALER = False
+ACCUMULATE_STEPS = 1
+SYNC_STATS_EVERY = 10
 
 model = None
 scheduler = None
 optimizer = None
 amp_scaler = None
 tb_writer = None
+output_writer = None
+checkpoint_writer = None
+profiler = None
 
-HOROVOD_RANK = 0
-HOROVOD = False
+# multi-process training backend, see distributed.py
+DIST = distributed.SingleProcess()
+DISTRIBUTED = False
+RANK = 0
 
 
 def pred_to_pdb(out_pdb, input_dict, out_dict):
@@ -91,81 +107,91 @@ def pred_to_pdb(out_pdb, input_dict, out_dict):
             )
 
 
-def add_loss_to_stats(stats, output):
-    stats['Loss_Total'] = output['loss']['loss_total'].item()
+def add_loss_to_stats(stats, output, input):
+    # values are kept on device, see metrics.StepMetrics
+    stats['Loss_Total'] = output['loss']['loss_total'].detach()
     if 'lddt_values' in output['loss']:
-        stats['LDDT_Rec_Final'] = output['loss']['lddt_values']['rec_rec_lddt_true_total'][-1].item()
-        stats['LDDT_Rec_MeanTraj'] = output['loss']['lddt_values']['rec_rec_lddt_true_total'].mean().item()
-        stats['Loss_LDDT_Rec'] = output['loss']['lddt_loss_rec_rec'].item()
-        stats['Loss_Torsions'] = output['loss']['loss_torsions']['chi_loss'].mean().item()
-        stats['Loss_Norm'] = output['loss']['loss_torsions']['norm_loss'].mean().item()
-        stats['Loss_FAPE_BB_Rec_Rec_Final'] = output['loss']['loss_fape']['loss_bb_rec_rec'][-1].item()
-        stats['Loss_FAPE_AA_Rec_Rec_Final'] = output['loss']['loss_fape']['loss_aa_rec_rec'].item()
-        stats['Loss_FAPE_BB_Rec_Rec_MeanTraj'] = output['loss']['loss_fape']['loss_bb_rec_rec'].mean().item()
-        stats['Loss_PredDmat_RecRec'] = output['loss']['loss_pred_dmat'].item()
-        stats['Loss_MSA_BERT'] = output['loss']['loss_msa_bert'].item()
+        stats['LDDT_Rec_Final'] = output['loss']['lddt_values']['rec_rec_lddt_true_total'][-1].detach()
+        stats['LDDT_Rec_MeanTraj'] = output['loss']['lddt_values']['rec_rec_lddt_true_total'].mean().detach()
+        stats['Loss_LDDT_Rec'] = output['loss']['lddt_loss_rec_rec'].detach()
+        stats['Loss_Torsions'] = output['loss']['loss_torsions']['chi_loss'].mean().detach()
+        stats['Loss_Norm'] = output['loss']['loss_torsions']['norm_loss'].mean().detach()
+        stats['Loss_FAPE_BB_Rec_Rec_Final'] = output['loss']['loss_fape']['loss_bb_rec_rec'][-1].detach()
+        stats['Loss_FAPE_AA_Rec_Rec_Final'] = output['loss']['loss_fape']['loss_aa_rec_rec'].detach()
+        stats['Loss_FAPE_BB_Rec_Rec_MeanTraj'] = output['loss']['loss_fape']['loss_bb_rec_rec'].mean().detach()
+        stats['Loss_PredDmat_RecRec'] = output['loss']['loss_pred_dmat'].detach()
+        stats['Loss_MSA_BERT'] = output['loss']['loss_msa_bert'].detach()
 
     if 'violations' in output['loss']:
         viol = output['loss']['violations']
-        stats['Violations/Loss'] = viol['loss'].item()
-        stats['Violations/Extreme_CA_CA'] = viol['between_residues']['violations_extreme_ca_ca'].item()
-
-        stats['Violations/Inter_ResRes_Bonds'] = viol['between_residues']['connections_per_residue_violation_mask'].mean().item()
-        stats['Violations/Inter_ResRes_Clash'] = viol['between_residues']['clashes_per_atom_clash_mask'].max(-1).values.mean().item()
-        stats['Violations/Intra_Residue_Violations'] = viol['within_residues']['per_atom_violations'].max(-1).values.mean().item()
-        stats['Violations/Total_Residue_Violations'] = viol['total_per_residue_violations_mask'].mean().item()
-
-        num_rec_atoms = torch.sum(input['target']['rec_atom14_atom_exists'][0]).item()
-        stats['Violations/between_bonds_c_n_mean_loss'] = viol['between_residues']['bonds_c_n_loss_mean'].item()
-        stats['Violations/between_angles_ca_c_n_mean_loss'] = viol['between_residues']['angles_ca_c_n_loss_mean'].item()
-        stats['Violations/between_angles_c_n_ca_mean_loss'] = viol['between_residues']['angles_c_n_ca_loss_mean'].item()
-        stats['Violations/between_clashes_mean_loss'] = viol['between_residues']['clashes_per_atom_loss_sum'].sum().item() / (1e-6 + num_rec_atoms)
-        stats['Violations/within_mean_loss'] = viol['within_residues']['per_atom_loss_sum'].sum().item() / (1e-6 + num_rec_atoms)
+        stats['Violations/Loss'] = viol['loss'].detach()
+        stats['Violations/Extreme_CA_CA'] = viol['between_residues']['violations_extreme_ca_ca'].detach()
+
+        stats['Violations/Inter_ResRes_Bonds'] = viol['between_residues']['connections_per_residue_violation_mask'].mean().detach()
+        stats['Violations/Inter_ResRes_Clash'] = viol['between_residues']['clashes_per_atom_clash_mask'].max(-1).values.mean().detach()
+        stats['Violations/Intra_Residue_Violations'] = viol['within_residues']['per_atom_violations'].max(-1).values.mean().detach()
+        stats['Violations/Total_Residue_Violations'] = viol['total_per_residue_violations_mask'].mean().detach()
+
+        num_rec_atoms = torch.sum(input['target']['rec_atom14_atom_exists'][0])
+        stats['Violations/between_bonds_c_n_mean_loss'] = viol['between_residues']['bonds_c_n_loss_mean'].detach()
+        stats['Violations/between_angles_ca_c_n_mean_loss'] = viol['between_residues']['angles_ca_c_n_loss_mean'].detach()
+        stats['Violations/between_angles_c_n_ca_mean_loss'] = viol['between_residues']['angles_c_n_ca_loss_mean'].detach()
+        stats['Violations/between_clashes_mean_loss'] = viol['between_residues']['clashes_per_atom_loss_sum'].sum().detach() / (1e-6 + num_rec_atoms.to(viol['loss'].device))
+        stats['Violations/within_mean_loss'] = viol['within_residues']['per_atom_loss_sum'].sum().detach() / (1e-6 + num_rec_atoms.to(viol['loss'].device))
     return stats
 
 
-def report_step(input, output, epoch, dataset, global_stats, train=True):
-    stage = 'Train' if train else 'Valid'
+def report_step(input, output, epoch, dataset, train=True):
     stats = {'Generated_NaN': output.get('Generated_NaN', 0)}
 
     if 'loss' in output:
-        add_loss_to_stats(stats, output)
+        add_loss_to_stats(stats, output, input)
 
-        if (not train) or (LOG_PDB_EVERY_NSTEPS is not None and ((GLOBAL_STEP + HOROVOD_RANK) % LOG_PDB_EVERY_NSTEPS == 0)):
+        if (not train) or (LOG_PDB_EVERY_NSTEPS is not None and ((GLOBAL_STEP + RANK) % LOG_PDB_EVERY_NSTEPS == 0)):
             ix = input['target']['ix'][0].item()
             case_name = dataset.data[ix]['pdb_id'] + '_' + dataset.data[ix]['entity_id']
             if train:
-                file_name = f'train_epoch_{epoch}_step_{GLOBAL_STEP + HOROVOD_RANK:07d}_{case_name}_{stats["Loss_Total"]:.3f}.pdb'
+                file_name = f'train_epoch_{epoch}_step_{GLOBAL_STEP + RANK:07d}_{case_name}_{stats["Loss_Total"].item():.3f}.pdb'
             else:
-                file_name = f'valid_epoch_{epoch}_step_{GLOBAL_STEP + HOROVOD_RANK:07d}_{case_name}_{stats["Loss_Total"]:.3f}.pdb'
-            pred_to_pdb((OUT_DIR / 'models').mkdir_p() / file_name, input, output)
-            stats_dump = stats.copy()
+                file_name = f'valid_epoch_{epoch}_step_{GLOBAL_STEP + RANK:07d}_{case_name}_{stats["Loss_Total"].item():.3f}.pdb'
+            stats_dump = metrics.stats_to_host([stats])[0]
             #stats_dump['Used_HH_templates'] = 'hhpred' in input
             #stats_dump['Used_frag_templates'] = 'fragments' in input
-            utils.write_json(stats_dump, (OUT_DIR / 'models' / file_name).stripext() + '.json')
+            if output_writer is not None:
+                output_writer.submit(pred_to_pdb, (OUT_DIR / 'models').mkdir_p() / file_name, *async_writer.pred_inputs_to_cpu(input, output))
+                output_writer.submit(utils.write_json, stats_dump, (OUT_DIR / 'models' / file_name).stripext() + '.json')
+            else:
+                pred_to_pdb((OUT_DIR / 'models').mkdir_p() / file_name, input, output)
+                utils.write_json(stats_dump, (OUT_DIR / 'models' / file_name).stripext() + '.json')
 
-    if HOROVOD:
-        all_stats = hvd.allgather_object(stats)
-    else:
-        all_stats = [stats]
+    return stats
+
+
+def collect_stats(synced_stats, global_stats, train=True):
+    """Adds stats synced by metrics.StepMetrics to global_stats and prints them"""
+    stage = 'Train' if train else 'Valid'
+    if RANK != 0:
+        return
 
-    if HOROVOD_RANK == 0:
-        for idx, case_stats in enumerate(all_stats):
-            for key, val in case_stats.items():
-                if key not in global_stats:
-                    global_stats[key] = []
-                global_stats[key].append(val)
+    for step, rank, case_stats in synced_stats:
+        for key, val in case_stats.items():
+            if key not in global_stats:
+                global_stats[key] = []
+            global_stats[key].append(val)
 
-                if train and TB_WRITE_STEP:
-                    tb_writer.add_scalar(key + '/Step/' + stage, case_stats[key], GLOBAL_STEP + idx)
+            if train and TB_WRITE_STEP:
+                tb_writer.add_scalar(key + '/Step/' + stage, val, step + rank)
 
-    return all_stats
+        if train and rank == 0:
+            for k, v in case_stats.items():
+                print(RANK, ':', f'step {step} stats[{k}] = {v}')
+    sys.stdout.flush()
 
 
 def report_epoch_end(epoch, global_stats, stage='Train', save_model=True):
     global GLOBAL_STEP
 
-    if HOROVOD_RANK == 0:
+    if RANK == 0:
         tb_writer.add_scalar('HasNans/Epoch/' + stage, math.isnan(sum(global_stats['Loss_Total'])), epoch)
         for key in global_stats.keys():
             vals = [x for x in global_stats[key] if not math.isnan(x)]
@@ -174,29 +200,50 @@ def report_epoch_end(epoch, global_stats, stage='Train', save_model=True):
         tb_writer.add_scalar('LearningRate/Epoch/' + stage, optimizer.param_groups[0]['lr'], epoch)
         print('Epoch_stats', global_stats)
 
-    if HOROVOD:
-        global_stats = hvd.broadcast_object(global_stats, root_rank=0)
+    if DISTRIBUTED:
+        global_stats = DIST.broadcast_object(global_stats, root_rank=0)
 
     scheduler.step(global_stats['Loss_Total'])
 
-    if HOROVOD_RANK == 0 and save_model and (epoch % SAVE_MODEL_EVERY_NEPOCHS == 0):
-        torch.save({
-            'epoch': epoch,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'scheduler_state_dict': scheduler.state_dict(),
-            'loss': global_stats,
-            'global_step': GLOBAL_STEP,
-            'hvd_size': 1 if not HOROVOD else hvd.size()
-        }, OUT_DIR / f'epoch_{epoch}_loss_{global_stats["Loss_Total"]:.3f}.pth')
-
-
-def check_grads(inputs):
-    grads_are_nan = [name for name, x in model.named_parameters() if x.grad is not None and torch.isnan(x.grad).any().item()]
-    if len(grads_are_nan) > 0:
-        for x in sorted(grads_are_nan):
-            print(x)
-        raise utils.GeneratedNans(f'Process {HOROVOD_RANK}: gradients are nan')
+    if RANK == 0 and save_model and (epoch % SAVE_MODEL_EVERY_NEPOCHS == 0):
+        checkpoint_writer.save(training_state(epoch, loss=global_stats), f'epoch_{epoch}_loss_{global_stats["Loss_Total"]:.3f}.pth')
+
+
+def training_state(epoch, **kwargs):
+    return {
+        'epoch': epoch,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scheduler_state_dict': scheduler.state_dict(),
+        'global_step': GLOBAL_STEP,
+        'hvd_size': DIST.size,
+        'accumulate_steps': ACCUMULATE_STEPS,
+        **kwargs
+    }
+
+
+def take_grads():
+    """Moves the gradients accumulated so far out of the parameters (None where there are none yet),
+    so that backward() of the next sample writes its gradients apart from them"""
+    saved_grads = [x.grad for x in model.parameters()]
+    for x in model.parameters():
+        x.grad = None
+    return saved_grads
+
+
+def restore_grads(saved_grads):
+    """Drops the gradients of the current sample, see take_grads"""
+    for x, y in zip(model.parameters(), saved_grads):
+        x.grad = y
+
+
+def check_grads(inputs, saved_grads):
+    """Drops the gradients of this sample if any of them is nan (or inf without the AMP scaler, which skips such steps itself)
+    and adds them to saved_grads from take_grads, returns 0-d tensor which is 1 if the sample was dropped.
+    Doesn't synchronize with the device."""
+    grads = [x.grad for x in model.parameters() if x.grad is not None]
+    generated_nan = metrics.nonfinite_grads(grads, nan_only=USE_AMP and USE_AMP_SCALER)
+    metrics.zero_grads_where(grads, generated_nan)
 
     modules = list(model.StructureModule.named_parameters()) + list(model.Evoformer.named_parameters())
     if 'msa' in inputs and 'extra' in inputs['msa']:
@@ -205,14 +252,29 @@ def check_grads(inputs):
     if len(grads_are_none) > 0:
         for x in sorted(grads_are_none):
             print(x)
-        assert len(grads_are_none) == 0, f'Process {HOROVOD_RANK}: gradients are None'
+        assert len(grads_are_none) == 0, f'Process {RANK}: gradients are None'
+
+    for x, y in zip(model.parameters(), saved_grads):
+        if y is not None:
+            if x.grad is not None:
+                y.add_(x.grad)
+            x.grad = y
+    return generated_nan.float()
 
 
 def print_input_shapes(inputs):
     for k1, v1 in inputs.items():
-        print(HOROVOD_RANK, ':', k1)
+        print(RANK, ':', k1)
         for k2, v2 in v1.items():
-            print(HOROVOD_RANK, ':', '    ', k2, v1[k2].shape, v1[k2].dtype)
+            print(RANK, ':', '    ', k2, v1[k2].shape, v1[k2].dtype)
+    sys.stdout.flush()
+
+
+def print_memory_estimate(inputs):
+    """Estimated peak memory of a training step on this sample, see memory.training_peak_memory"""
+    sizes = profiling.sample_sizes(inputs)
+    peak = memory.training_peak_memory(sizes['num_res'], sizes.get('main_msa_depth', 1), sizes.get('extra_msa_depth', 0), CONFIG_DICT)['peak']
+    print(RANK, ':', f'Estimated peak memory {(peak + 4 * memory.parameter_bytes(model)) / 1024 ** 3:.2f} GB')
     sys.stdout.flush()
 
 
@@ -230,38 +292,48 @@ def validate(epoch, set_json, data_dir, seed):
         shuffle=False
     )
 
-    if HOROVOD:
-        sampler = torch.utils.data.distributed.DistributedSampler(dset, num_replicas=hvd.size(), rank=HOROVOD_RANK, shuffle=False)
-        loader = torch.utils.data.DataLoader(dset, batch_size=1, sampler=sampler, shuffle=False, **DATALOADER_KWARGS)
+    sampler = DIST.sampler(dset)
+    loader = torch.utils.data.DataLoader(dset, batch_size=1, sampler=sampler, shuffle=False, **DATALOADER_KWARGS)
+    if sampler is not None:
         sampler.set_epoch(epoch)
-    else:
-        loader = torch.utils.data.DataLoader(dset, batch_size=1, shuffle=False, **DATALOADER_KWARGS)
 
     global_stats = {}
     local_step = 0
     num_recycles = CONFIG_DICT['model']['recycling_num_iter'] if CONFIG_DICT['model']['recycling_on'] else 1
+    step_metrics = metrics.StepMetrics(DIST, sync_every=SYNC_STATS_EVERY)
 
-    for inputs in (tqdm(loader, desc=f'Epoch {epoch} (valid)') if HOROVOD_RANK == 0 else loader):
+    for inputs in (tqdm(loader, desc=f'Epoch {epoch} (valid)') if RANK == 0 else loader):
         try:
-            with torch.no_grad():
+            with torch.no_grad(), profiling.sample(f'{epoch}_valid_{inputs["target"]["ix"].item():06d}', **profiling.sample_sizes(inputs)):
                 with torch.cuda.amp.autocast(USE_AMP):
+                    context = model.prepare_inputs(inputs)
                     for recycle_iter in range(num_recycles):
-                        output = model(inputs, recycling=output['recycling_input'] if recycle_iter > 0 else None)
+                        output = model(
+                            inputs,
+                            recycling=output['recycling_input'] if recycle_iter > 0 else None,
+                            intermediate=recycle_iter < num_recycles - 1,
+                            context=context
+                        )
         except:
-            print(HOROVOD_RANK, ':', 'Exception in validation', 'sample id:', inputs['target']['ix'])
+            print(RANK, ':', 'Exception in validation', 'sample id:', inputs['target']['ix'])
             traceback.print_exc(); sys.stdout.flush(); sys.stderr.flush()
             output = {}
 
-        step_stats = report_step(inputs, output, epoch, dset, global_stats, train=False)
+        step_stats = report_step(inputs, output, epoch, dset, train=False)
+        collect_stats(step_metrics.add(local_step * DIST.size, step_stats), global_stats, train=False)
         local_step += 1
         sys.stdout.flush()
         torch.cuda.empty_cache()
 
+    collect_stats(step_metrics.sync(), global_stats, train=False)
     report_epoch_end(epoch, global_stats, stage='Valid', save_model=False)
 
 
-def train(epoch, set_json, data_dir, seed):
+def train(epoch, set_json, data_dir, seed, resume=None):
+    """Trains for one epoch. resume is the state saved by a mid-epoch checkpoint
+    (epoch_step, epoch_stats, recycling_rng_state, rng_states), the epoch then continues from sample epoch_step."""
     model.train()
+    start = resume['epoch_step'] if resume else 0
 
     dset = dataset.DockingDataset(
         utils.read_json(set_json),
@@ -271,122 +343,170 @@ def train(epoch, set_json, data_dir, seed):
         shuffle=True
     )
 
-    if HOROVOD:
-        sampler = torch.utils.data.distributed.DistributedSampler(dset, num_replicas=hvd.size(), rank=HOROVOD_RANK, shuffle=False)
-        loader = torch.utils.data.DataLoader(dset, batch_size=1, sampler=sampler, shuffle=False, **DATALOADER_KWARGS)
+    sampler = DIST.sampler(dset, start=start)
+    loader = torch.utils.data.DataLoader(dset, batch_size=1, sampler=sampler, shuffle=False, **DATALOADER_KWARGS)
+    if sampler is not None:
         sampler.set_epoch(epoch)
-    else:
-        loader = torch.utils.data.DataLoader(dset, batch_size=1, shuffle=False, **DATALOADER_KWARGS)
+    num_samples = start + len(loader)
+    if resume:
+        restore_rng_states(dset, resume['rng_states'])
 
-    global_stats = {}
+    global_stats = resume['epoch_stats'] if resume else {}
     local_step = 0
     global GLOBAL_STEP
-    global_step_start = GLOBAL_STEP
+    global_step_start = GLOBAL_STEP - start * DIST.size
+    last_saved = start
 
     # number of recycling iterations
     recycling_on = CONFIG_DICT['model']['recycling_on']
     num_recycles = CONFIG_DICT['model']['recycling_num_iter'] if recycling_on else 1
     recycling_rng = torch.Generator()
     recycling_rng = recycling_rng.manual_seed(seed + epoch * 100)
+    if resume:
+        recycling_rng.set_state(resume['recycling_rng_state'])
+    step_metrics = metrics.StepMetrics(DIST, sync_every=SYNC_STATS_EVERY)
 
     t0 = time.time()
-    for inputs in (tqdm(loader, desc=f'Epoch {epoch} (train)') if HOROVOD_RANK == 0 else loader):
-        print(HOROVOD_RANK, ': time retrieving', inputs['target']['ix'].item(), ':', time.time() - t0, '(s)'); sys.stdout.flush()
-        optimizer.zero_grad()
+    for sample_i, inputs in enumerate(tqdm(loader, desc=f'Epoch {epoch} (train)') if RANK == 0 else loader, start=start):
+        print(RANK, ': time retrieving', inputs['target']['ix'].item(), ':', time.time() - t0, '(s)'); sys.stdout.flush()
+        # gradients are accumulated over ACCUMULATE_STEPS samples, the last step of the epoch may be shorter
+        window_start = sample_i - sample_i % ACCUMULATE_STEPS
+        window_size = min(ACCUMULATE_STEPS, num_samples - window_start)
+        if sample_i == window_start:
+            optimizer.zero_grad()
+        optimizer_step = sample_i + 1 == window_start + window_size
         generated_nan = 0
+        # gradients of the previous samples in the window, this sample's are added to them only if it succeeds
+        saved_grads = take_grads()
 
-        if True and HOROVOD_RANK == 0:
+        if True and RANK == 0:
             print_input_shapes(inputs)
 
         # sync recycling iteration for which the grad will be computed
-        recycle_iter_grad_on = torch.randint(0, num_recycles, [1], generator=recycling_rng)[0].item() if HOROVOD_RANK == 0 and recycling_on else 0
-        if HOROVOD:
-            recycle_iter_grad_on = hvd.broadcast_object(recycle_iter_grad_on, root_rank=0)
+        recycle_iter_grad_on = torch.randint(0, num_recycles, [1], generator=recycling_rng)[0].item() if RANK == 0 and recycling_on else 0
+        if DISTRIBUTED:
+            recycle_iter_grad_on = DIST.broadcast_object(recycle_iter_grad_on, root_rank=0)
 
         try:
-            print(HOROVOD_RANK, ": sample id - ", inputs['target']['ix'])
-            losses = []
-
-            with torch.cuda.amp.autocast(USE_AMP):
-                for recycle_iter in range(num_recycles):
-                    with torch.set_grad_enabled((recycle_iter == recycle_iter_grad_on) or not recycling_on):
-                        output = model(inputs, recycling=output['recycling_input'] if recycle_iter > 0 else None)
-                    losses.append(output['loss']['loss_total'])
-
-                    if HOROVOD_RANK == 0:
-                        print(HOROVOD_RANK, ':', f'loss[{recycle_iter}]', losses[-1].item()); sys.stdout.flush()
-
-            # calculate grads for selected recycling iteration
-            if USE_AMP and USE_AMP_SCALER:
-                amp_scaler.scale(losses[recycle_iter_grad_on]).backward()
-            else:
-                losses[recycle_iter_grad_on].backward()
+            with profiling.sample(f'{epoch}_{inputs["target"]["ix"].item():06d}', **profiling.sample_sizes(inputs)):
+                print(RANK, ": sample id - ", inputs['target']['ix'])
+                losses = {}
 
-            # check that grads are not nan, throw GeneratedNans if yes
-            check_grads(inputs)
+                with torch.cuda.amp.autocast(USE_AMP):
+                    for recycle_iter in range(num_recycles):
+                        # loss is needed only for the iteration with grad and the final one (for stats)
+                        intermediate = recycle_iter not in [recycle_iter_grad_on, num_recycles - 1]
+                        with torch.set_grad_enabled((recycle_iter == recycle_iter_grad_on) or not recycling_on):
+                            output = model(inputs, recycling=output['recycling_input'] if recycle_iter > 0 else None, intermediate=intermediate)
+                        if intermediate:
+                            continue
+                        losses[recycle_iter] = output['loss']['loss_total']
+
+                # calculate grads for selected recycling iteration
+                loss = losses[recycle_iter_grad_on] / window_size
+                with profiling.section('backward'):
+                    if USE_AMP and USE_AMP_SCALER:
+                        amp_scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
+
+                # drop the gradients of this sample if they are nan,
+                # so that nans don't spill into the rest of the step
+                generated_nan = check_grads(inputs, saved_grads)
 
         except RuntimeError:
             # this is for CUDA out of memory error, if encountered we will just move to the next sample
             traceback.print_exc(); sys.stdout.flush(); sys.stderr.flush()
             print_input_shapes(inputs)
+            print_memory_estimate(inputs)
             output = {}
+            # backward may have failed midway
+            restore_grads(saved_grads)
+            torch.cuda.empty_cache()
 
         except utils.GeneratedNans:
             traceback.print_exc(); sys.stdout.flush(); sys.stderr.flush()
             print_input_shapes(inputs)
             generated_nan = 1
             output = {}
+            # drop the gradients of this sample, so that nans don't spill into the rest of the step
+            restore_grads(saved_grads)
 
-        if HOROVOD:
-            # following pytorch example from horovod docs
-            optimizer.synchronize()
+        if optimizer_step:
+            # average gradients across processes before clipping, only after the gradients
+            # of every sample in the window were checked (and dropped if non-finite)
+            DIST.synchronize(optimizer)
 
-        if USE_AMP and USE_AMP_SCALER and CLIP_GRADIENT:
-            amp_scaler.unscale_(optimizer)
-        if CLIP_GRADIENT:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), CLIP_GRADIENT_VALUE)
+            if USE_AMP and USE_AMP_SCALER and CLIP_GRADIENT:
+                amp_scaler.unscale_(optimizer)
+            if CLIP_GRADIENT:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), CLIP_GRADIENT_VALUE)
 
-        if HOROVOD:
-            with optimizer.skip_synchronize():
+            with DIST.skip_synchronize(optimizer), profiling.section('optimizer_step'):
                 if USE_AMP and USE_AMP_SCALER:
                     amp_scaler.step(optimizer)
                 else:
                     optimizer.step()
-        else:
-            if USE_AMP and USE_AMP_SCALER:
-                amp_scaler.step(optimizer)
-            else:
-                optimizer.step()
 
-        if USE_AMP and USE_AMP_SCALER:
-            amp_scaler.update()
+            if USE_AMP and USE_AMP_SCALER:
+                amp_scaler.update()
 
         output['Generated_NaN'] = generated_nan
 
-        step_stats = report_step(inputs, output, epoch, dset, global_stats, train=True)
-        GLOBAL_STEP += len(step_stats)
+        step_stats = report_step(inputs, output, epoch, dset, train=True)
+        collect_stats(step_metrics.add(GLOBAL_STEP, step_stats), global_stats, train=True)
+        GLOBAL_STEP += DIST.size
         local_step += 1
         sys.stdout.flush()
 
-        if HOROVOD_RANK == 0:
-            for k, v in step_stats[0].items():
-                print(HOROVOD_RANK, ':', f'stats[{k}] = {v}')
-            sys.stdout.flush()
+        if RANK == 0 and 'Generated_NaN' in global_stats:
             if (GLOBAL_STEP - global_step_start) / len(dset) > 0.05:
                 nan_frac = sum(global_stats['Generated_NaN']) / len(global_stats['Generated_NaN'])
                 assert nan_frac < MAX_NAN_ITER_FRAC, (nan_frac, MAX_NAN_ITER_FRAC)
 
-        torch.cuda.empty_cache()
+        # mid-epoch checkpoints are saved only after the optimizer step, so that resumed accumulation is aligned
+        if SAVE_MODEL_EVERY_NSTEPS and optimizer_step and sample_i + 1 - last_saved >= SAVE_MODEL_EVERY_NSTEPS and sample_i + 1 < num_samples:
+            collect_stats(step_metrics.sync(), global_stats, train=True)
+            rng_states = DIST.allgather_object(get_rng_states(dset))
+            if RANK == 0:
+                checkpoint_writer.save(
+                    training_state(epoch, epoch_step=sample_i + 1, epoch_stats=global_stats,
+                                   recycling_rng_state=recycling_rng.get_state(), rng_states=rng_states),
+                    f'epoch_{epoch}_step_{GLOBAL_STEP:07d}.pth'
+                )
+            last_saved = sample_i + 1
+
         t0 = time.time()
 
+    collect_stats(step_metrics.sync(), global_stats, train=True)
     report_epoch_end(epoch, global_stats, stage='Train', save_model=True)
 
 
+def get_rng_states(dset):
+    """RNG states of this process needed to resume an epoch"""
+    return {
+        'data': dset.rng.bit_generator.state,
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state() if torch.cuda.is_available() else None
+    }
+
+
+def restore_rng_states(dset, rng_states):
+    if len(rng_states) != DIST.size:
+        print(RANK, ':', f'Checkpoint was saved by {len(rng_states)} processes, not restoring RNG states')
+        return
+    states = rng_states[RANK]
+    dset.rng.bit_generator.state = states['data']
+    torch.set_rng_state(states['torch'])
+    if states['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state(states['cuda'])
+
+
 def find_last_pth(dir):
-    pths = Path(dir).glob('epoch_*.pth')
+    pths = checkpoint.list_checkpoints(dir)
     if len(pths) == 0:
         return None
-    return sorted(pths, key=lambda x: -int(x.basename().split('_')[1]))[0]
+    return pths[-1]
 
 
 def main(
@@ -394,6 +514,7 @@ def main(
         valid_json=None,
         data_dir=None,
         horovod=False,
+        torch_distributed=False,
         gpu=True,
         seed=123456,
         model_pth=None,
@@ -402,6 +523,8 @@ def main(
         max_epoch=None,
         tb_write_step=False,
         save_model_every_nepoch=1,
+        save_model_every_nsteps=None,
+        keep_last_checkpoints=None,
         log_pdb_every_nsteps=500,
         lr=0.001 / 128,
         lr_reset=False,
@@ -412,22 +535,28 @@ def main(
         scheduler_reset=False,
         clip_gradient=True,
         clip_gradient_value=0.1,
+        accumulate_steps=1,
+        sync_stats_every=10,
         amp=False,
         amp_scale=False,
-        gradient_compression=False
+        gradient_compression=False,
+        async_write=False,
+        profile_dir=None,
+        memory_budget=None
 ):
-    global HOROVOD, HOROVOD_RANK, hvd, \
+    global DIST, DISTRIBUTED, RANK, \
         OUT_DIR, TB_WRITE_STEP, LOG_PDB_EVERY_NSTEPS, \
         SAVE_MODEL_EVERY_NEPOCHS, GLOBAL_STEP, \
         CONFIG_DICT, CLIP_GRADIENT, CLIP_GRADIENT_VALUE, \
-        USE_AMP, USE_AMP_SCALER, model, optimizer, \
-        scheduler, amp_scaler, tb_writer
+        USE_AMP, USE_AMP_SCALER, ACCUMULATE_STEPS, SYNC_STATS_EVERY, model, optimizer, \
+        scheduler, amp_scaler, tb_writer, output_writer, \
+        SAVE_MODEL_EVERY_NSTEPS, checkpoint_writer, profiler
 
-    if horovod:
-        HOROVOD = True
-        import horovod.torch as hvd
-        hvd.init()
-        HOROVOD_RANK = hvd.rank()
+    assert not (horovod and torch_distributed), 'Use either Horovod or torch.distributed'
+    if horovod or torch_distributed:
+        DISTRIBUTED = True
+        DIST = distributed.make_backend('horovod' if horovod else 'torch', gpu=gpu)
+        RANK = DIST.rank
 
     torch.set_num_threads(1)
     torch.manual_seed(seed)
@@ -437,20 +566,24 @@ def main(
     TB_WRITE_STEP = tb_write_step
     LOG_PDB_EVERY_NSTEPS = log_pdb_every_nsteps
     SAVE_MODEL_EVERY_NEPOCHS = save_model_every_nepoch
+    SAVE_MODEL_EVERY_NSTEPS = save_model_every_nsteps
     CLIP_GRADIENT = clip_gradient
     CLIP_GRADIENT_VALUE = clip_gradient_value
     USE_AMP = amp
     USE_AMP_SCALER = amp_scale
+    assert accumulate_steps >= 1, accumulate_steps
+    ACCUMULATE_STEPS = accumulate_steps
+    SYNC_STATS_EVERY = sync_stats_every
 
     if gpu:
         assert torch.cuda.is_available(), 'CUDA is not available'
         device = 'cuda:0'
-        if horovod:
-            device = f'cuda:{hvd.local_rank()}'
+        if DISTRIBUTED:
+            device = f'cuda:{DIST.local_rank}'
     else:
         device = 'cpu'
 
-    print(HOROVOD_RANK, ':', 'Using device', device)
+    print(RANK, ':', 'Using device', device)
 
     # remove checkpointing to get rid of the grad is none warning
     config_dict = deepcopy(config.config)
@@ -464,7 +597,7 @@ def main(
     })
 
     if config_update_json:
-        if HOROVOD_RANK == 0:
+        if RANK == 0:
             print('Updating configuration using', config_update_json)
         config_dict = utils.merge_dicts(config_dict, utils.read_json(config_update_json))
 
@@ -473,21 +606,35 @@ def main(
     model = docker.DockerIteration(config_dict['model'], config_dict)
     model.modules_to_devices()
 
-    if HOROVOD_RANK == 0:
+    if RANK == 0:
         print('Num params:', sum(p.numel() for p in model.parameters() if p.requires_grad))
         print('Num param sets:', len([p for p in model.parameters() if p.requires_grad]))
 
-    lr_scaler = 1 if not HOROVOD or not lr_scale else hvd.size()
-    if HOROVOD_RANK == 0:
+    if memory_budget is not None:
+        # parameters, gradients and Adam moments
+        activation_budget = memory_budget * 1024 ** 3 - 4 * memory.parameter_bytes(model)
+        chunk_size, num_extra, peak = memory.choose_memory_settings(config_dict, activation_budget, config_dict['data']['crop_size'], training=True)
+        if RANK == 0:
+            print(f'Extra MSA size {num_extra}, chunk size {chunk_size}, estimated peak memory {peak / 1024 ** 3:.2f} GB without parameters')
+            if peak > activation_budget:
+                print('Estimated peak memory exceeds the budget even with the smallest chunk size')
+        config_dict['data']['msa_max_extra'] = num_extra
+        config_dict['model']['chunk_size'] = chunk_size
+        modules.set_chunk_size(model, chunk_size)
+
+    # effective batch size is the number of processes times the number of accumulated samples
+    lr_scaler = 1 if not lr_scale else DIST.size * ACCUMULATE_STEPS
+    if RANK == 0:
         print('Scaling learning rate by', lr_scaler)
         print('Resulting learning rate', lr * lr_scaler)
     optimizer = optim.Adam(model.parameters(), lr=lr * lr_scaler) #, momentum=args.momentum)
     scheduler = ReduceLROnPlateau(optimizer, factor=scheduler_factor, patience=scheduler_patience, min_lr=scheduler_min_lr * lr_scaler)
 
     start_epoch = 1
+    resume = None
     scheduler_state = scheduler.state_dict()
 
-    if model_pth is None and HOROVOD_RANK == 0:
+    if model_pth is None and RANK == 0:
         print('model_pth is not set, looking for pth in the current directory')
         model_pth = find_last_pth(OUT_DIR)
         if model_pth is not None:
@@ -495,66 +642,89 @@ def main(
         else:
             print('Did not find any saved state, starting from scratch')
 
-    if model_pth is not None and HOROVOD_RANK == 0:
+    if model_pth is not None and RANK == 0:
         print('Loading saved model from', model_pth)
-        dict_pth = torch.load(model_pth)
+        dict_pth = checkpoint.load(model_pth)
         model.load_state_dict(dict_pth['model_state_dict'])
 
         if 'global_step' in dict_pth:
             print('Setting global step to', dict_pth['global_step'])
             GLOBAL_STEP = dict_pth['global_step']
 
-        if 'epoch' in dict_pth:
+        if 'epoch_step' in dict_pth:
+            print('Resuming epoch', dict_pth['epoch'], 'from sample', dict_pth['epoch_step'])
+            start_epoch = dict_pth['epoch']
+            resume = {k: dict_pth[k] for k in ['epoch_step', 'epoch_stats', 'recycling_rng_state', 'rng_states']}
+        elif 'epoch' in dict_pth:
             print('Setting starting epoch to', dict_pth['epoch'] + 1)
             start_epoch = dict_pth['epoch'] + 1
 
         if 'optimizer_state_dict' in dict_pth:
             print('Loading optimizer_state_dict')
-            optimizer.load_state_dict(dict_pth['optimizer_state_dict'])
+            try:
+                optimizer.load_state_dict(dict_pth['optimizer_state_dict'])
+            except ValueError as e:
+                # e.g. saved before q/k/v/gate projections were fused
+                print('Optimizer state does not match the model parameters, starting with fresh optimizer state:', e)
 
         if 'scheduler_state_dict' in dict_pth and not scheduler_reset:
             print('Loading scheduler_state_dict')
             scheduler_state = dict_pth['scheduler_state_dict']
 
         if 'hvd_size' in dict_pth and lr_scale:
-            _hvd_size = 1 if not HOROVOD else hvd.size()
-            if _hvd_size != dict_pth['hvd_size']:
-                print('Rescaling learning rate by ', _hvd_size / dict_pth['hvd_size'])
+            saved_batch_size = dict_pth['hvd_size'] * dict_pth.get('accumulate_steps', 1)
+            if lr_scaler != saved_batch_size:
+                print('Rescaling learning rate by ', lr_scaler / saved_batch_size)
                 for g in optimizer.param_groups:
-                    g['lr'] = g['lr'] * _hvd_size / dict_pth['hvd_size']
+                    g['lr'] = g['lr'] * lr_scaler / saved_batch_size
 
     if lr_reset:
         for g in optimizer.param_groups:
             g['lr'] = lr * lr_scaler
 
-    if HOROVOD:
-        GLOBAL_STEP = hvd.broadcast_object(GLOBAL_STEP, root_rank=0)
-        start_epoch = hvd.broadcast_object(start_epoch, root_rank=0)
-        hvd.broadcast_parameters(model.state_dict(), root_rank=0)
-        hvd.broadcast_optimizer_state(optimizer, root_rank=0)
-        scheduler_state = hvd.broadcast_object(scheduler_state, root_rank=0)
-        optimizer = hvd.DistributedOptimizer(optimizer, named_parameters=model.named_parameters(), op=hvd.Average,
-                                             compression=hvd.Compression.fp16 if gradient_compression else hvd.Compression.none)
+    if DISTRIBUTED:
+        GLOBAL_STEP = DIST.broadcast_object(GLOBAL_STEP, root_rank=0)
+        start_epoch = DIST.broadcast_object(start_epoch, root_rank=0)
+        resume = DIST.broadcast_object(resume, root_rank=0)
+        DIST.broadcast_parameters(model.state_dict(), root_rank=0)
+        DIST.broadcast_optimizer_state(optimizer, root_rank=0)
+        scheduler_state = DIST.broadcast_object(scheduler_state, root_rank=0)
+        optimizer = DIST.distributed_optimizer(optimizer, model, fp16_compression=gradient_compression)
 
     scheduler.load_state_dict(scheduler_state)
 
     if USE_AMP and USE_AMP_SCALER:
         amp_scaler = torch.cuda.amp.GradScaler()
 
-    if HOROVOD_RANK == 0:
+    if RANK == 0:
         tb_writer = SummaryWriter(OUT_DIR)
+        checkpoint_writer = checkpoint.CheckpointWriter(OUT_DIR, keep_last=keep_last_checkpoints)
+
+    if async_write:
+        output_writer = async_writer.AsyncWriter()
+
+    if profile_dir is not None:
+        profiler = profiling.Profiler(device)
+        profiler.attach(model)
+        profiler.activate()
 
     epoch = start_epoch
-    while True:
-        #with torch.autograd.set_detect_anomaly(True):
-        if max_epoch is not None and epoch > max_epoch:
-            if HOROVOD_RANK == 0:
-                print(f'Reached max epoch {max_epoch}')
-            break
-        train(epoch, train_json, data_dir, seed)
-        if valid_json:
-            validate(epoch, valid_json, data_dir, seed)
-        epoch += 1
+    # queued predictions and checkpoints are written and writer errors are raised even if training fails,
+    # unless they would replace the training error, then they are only printed
+    with (checkpoint_writer or contextlib.nullcontext()), (output_writer or contextlib.nullcontext()):
+        while True:
+            #with torch.autograd.set_detect_anomaly(True):
+            if max_epoch is not None and epoch > max_epoch:
+                if RANK == 0:
+                    print(f'Reached max epoch {max_epoch}')
+                break
+            train(epoch, train_json, data_dir, seed, resume=resume if epoch == start_epoch else None)
+            if valid_json:
+                validate(epoch, valid_json, data_dir, seed)
+            if profiler is not None:
+                # rewritten after every epoch, so that long runs can be inspected
+                profiler.save(profile_dir, prefix=f'profile_rank{RANK}' if DISTRIBUTED else 'profile')
+            epoch += 1
 
 
 @click.command()
@@ -577,12 +747,18 @@ def main(
               help='Output directory, must exist')
 @click.option('--horovod', is_flag=True,
               help='Use Horovod for multi-GPU batch training')
+@click.option('--torch_distributed', is_flag=True,
+              help='Use torch.distributed for multi-process training (NCCL on GPU, gloo on CPU), launch with torchrun')
 @click.option('--tb_write_step', is_flag=True,
               help='Write every step to tensorboard writer (not recommended as TB files can get very large)')
 @click.option('--max_epoch', default=None, type=click.INT,
               help='Stop training when MAX_EPOCH is reached')
 @click.option('--save_model_every_nepoch', default=1, show_default=True, type=click.INT,
               help='Save model to pth file every Nth epoch')
+@click.option('--save_model_every_nsteps', default=None, type=click.INT,
+              help='Also save a mid-epoch checkpoint every N samples per process, training resumes from it within the epoch')
+@click.option('--keep_last_checkpoints', default=None, type=click.INT,
+              help='Keep only the last K end of epoch checkpoints (mid-epoch checkpoints are removed once a newer one is saved)')
 @click.option('--log_pdb_every_nsteps', default=500, show_default=True, type=click.INT,
               help='Write predictions to OUT_DIR/pdb every N steps')
 @click.option('--lr', default=0.001 / 128, show_default=True, type=click.FLOAT,
@@ -590,7 +766,7 @@ def main(
 @click.option('--lr_reset', is_flag=True,
               help='Do not use LR from previous epoch')
 @click.option('--lr_scale/--no_lr_scale', default=True, show_default=True,
-              help='Multiply learning rate by Horovod batch size')
+              help='Multiply learning rate by the effective batch size (number of processes times --accumulate_steps)')
 @click.option('--scheduler_patience', default=50, show_default=True, type=click.INT,
               help='LR scheduler patience')
 @click.option('--scheduler_factor', default=1 / 3, show_default=True, type=click.FLOAT,
@@ -603,12 +779,26 @@ def main(
               help='Clip gradient')
 @click.option('--clip_gradient_value', default=0.1, show_default=True, type=click.FLOAT,
               help='Clip gradient value')
+@click.option('--accumulate_steps', default=1, show_default=True, type=click.INT,
+              help='Accumulate gradients over N samples per process before averaging them and doing the optimizer step. '
+                   'With N > 1 the gradients of each sample are kept apart until they are checked for nans, '
+                   'which takes memory for one more copy of the gradients')
+@click.option('--sync_stats_every', default=10, show_default=True, type=click.INT,
+              help='Copy step stats from device and gather them from all processes every N steps')
 @click.option('--amp/--no_amp', default=False, show_default=True,
               help='Use Automatic Mixed Precision')
 @click.option('--amp_scale/--no_amp_scale', default=False, show_default=True,
               help='Use Gradient Scaler with AMP')
 @click.option('--gradient_compression/--no_gradient_compression', default=False, show_default=True,
-              help='Use Horovod gradient compression (compression=hvd.Compression.fp16)')
+              help='Compress gradients to fp16 for averaging across processes')
+@click.option('--async_write', is_flag=True,
+              help='Write logged predictions in a background thread')
+@click.option('--profile_dir', type=click.Path(file_okay=False),
+              help='Record wall time and peak memory of the model submodules, backward pass and optimizer step for every sample, '
+                   'and write them to profile.json and profile_trace.json (chrome://tracing) in this directory after every epoch')
+@click.option('--memory_budget', type=click.FLOAT,
+              help='Device memory (GB) available for training. Extra MSA size and chunk size are chosen for the crop size, '
+                   'so that the estimated peak memory (see memory.training_peak_memory) fits into it')
 def cli(**kwargs):
     """Run model training
 
@@ -619,6 +809,12 @@ def cli(**kwargs):
     \b
     > horovodrun -np 4 python train.py --horovod train.json
 
+    or torch.distributed, which also works with multiple CPU processes:
+
+    \b
+    > torchrun --nproc_per_node 4 train.py --torch_distributed train.json
+    > torchrun --nproc_per_node 2 train.py --torch_distributed --no_gpu train.json
+
     """
     main(**kwargs)
 
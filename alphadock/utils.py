@@ -161,11 +161,13 @@ def squared_difference(x, y):
 
 def dmat_to_dgram(dmat, dmin, dmax, num_bins):
     shape = dmat.shape
-    dmat = dmat.flatten()
+    dtype = dmat.dtype
+    # binning in reduced precision can put distances into wrong bins
+    dmat = dmat.flatten().float()
     bin_size = (dmax - dmin) / num_bins
     bin_ids = torch.minimum(torch.div(F.relu(dmat - dmin), bin_size, rounding_mode='floor').to(int), torch.tensor(num_bins - 1, dtype=int, device=dmat.device))
 
-    dgram = torch.zeros((len(dmat), num_bins), dtype=dmat.dtype, device=dmat.device)
+    dgram = torch.zeros((len(dmat), num_bins), dtype=dtype, device=dmat.device)
     dgram[range(dgram.shape[0]), bin_ids] = 1.0
     dgram = dgram.reshape(*shape, num_bins)
     return bin_ids, dgram
@@ -90,8 +90,8 @@ def find_structural_violations(
 
     violations_extreme_ca_ca = extreme_ca_ca_distance_violations(
         pred_atom_positions=atom14_pred_positions,
-        pred_atom_mask=batch['target']['rec_atom14_has_coords'][0],
-        residue_index=batch['target']['rec_index'][0].to(dtype=batch['target']['rec_atom14_coords'].dtype)
+        pred_atom_mask=batch['target']['rec_atom14_atom_exists'][0],
+        residue_index=batch['target']['rec_index'][0].to(dtype=atom14_pred_positions.dtype)
     )
 
     return {
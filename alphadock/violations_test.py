@@ -0,0 +1,21 @@
+import torch
+
+from alphadock import benchmark
+from alphadock import violations
+
+
+def test_find_structural_violations(tmp_path):
+    config_dict = benchmark.make_config('cpu')
+    config_dict['data'].update({'msa_max_clusters': 4, 'msa_max_extra': 8})
+    _, _, batch = benchmark.make_sample(tmp_path, 12, config_dict)
+    gt_coords = batch['ground_truth']['gt_atom14_coords'][0]
+    noise = torch.randn(gt_coords.shape, generator=torch.Generator().manual_seed(0)) * 2
+
+    gt = violations.find_structural_violations(batch, gt_coords, config_dict)
+    noisy = violations.find_structural_violations(batch, gt_coords + noise, config_dict)
+    assert gt['between_residues']['clashes_per_atom_loss_sum'].shape == (12, 14)
+    assert gt['within_residues']['per_atom_violations'].shape == (12, 14)
+    assert gt['total_per_residue_violations_mask'].shape == (12,)
+    assert gt['between_residues']['violations_extreme_ca_ca'] == 0
+    assert noisy['between_residues']['violations_extreme_ca_ca'] > 0
+    assert noisy['within_residues']['per_atom_loss_sum'].sum() > gt['within_residues']['per_atom_loss_sum'].sum()
@@ -16,6 +16,11 @@
 from enum import Enum
 from dataclasses import dataclass
 from functools import partial
+import multiprocessing
+import zipfile
+import struct
+import time
+import click
 import numpy as np
 import torch
 from typing import Union, List
@@ -24,6 +29,7 @@ import os
 sys.path.insert(1, '../')
 from alphadock import docker
 from alphadock import config
+from alphadock import checkpoint
 
 
 _NPZ_KEY_PREFIX = "alphafold/alphafold_iteration/"
@@ -104,29 +110,80 @@ def stacked(param_dict_list, out=None):
     return out
 
 
-def assign(translation_dict, orig_weights):
+class NpyMember:
+    """Array stored uncompressed in an .npz file, read from disk one block (along the first axis) at a time"""
+
+    def __init__(self, path, offset, shape, dtype):
+        self.path = path
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        count = int(np.prod(self.shape[1:]))
+        offset = self.offset + i * count * self.dtype.itemsize
+        return np.fromfile(self.path, dtype=self.dtype, count=count, offset=offset).reshape(self.shape[1:])
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.fromfile(self.path, dtype=self.dtype, count=int(np.prod(self.shape)), offset=self.offset).reshape(self.shape)
+        return array if dtype is None else array.astype(dtype)
+
+
+def load_npz_lazy(path):
+    """Arrays of an .npz file. Arrays stored uncompressed (as in AF2 parameter files) are not
+    loaded into memory, blocks of stacked parameters are read only when they are converted."""
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as raw:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                return np.load(path)
+            # data starts after the local file header, whose extra field may differ from the central directory
+            raw.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', raw.read(30)[26:30])
+            raw.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(raw)
+            shape, fortran_order, dtype = np.lib.format._read_array_header(raw, version)
+            if fortran_order or dtype.hasobject:
+                return np.load(path)
+            arrays[info.filename[:-len('.npy')]] = NpyMember(path, raw.tell(), shape, dtype)
+    return arrays
+
+
+def assign(translation_dict, orig_weights, verify=False):
+    """Copies orig_weights into the parameters, one block of stacked parameters at a time.
+    If verify is True, only compares them and returns the keys which don't match."""
+    mismatched = []
     for k, param in translation_dict.items():
         with torch.no_grad():
-            weights = torch.as_tensor(orig_weights[k])
+            stacked_weights = orig_weights[k]
             ref, param_type = param.param, param.param_type
             if param.stacked:
-                weights = torch.unbind(weights, 0)
+                weights = (stacked_weights[i] for i in range(len(ref)))
             else:
-                weights = [weights]
+                weights = [stacked_weights]
                 ref = [ref]
 
-            try:
-                weights = list(map(param_type.transformation, weights))
-                for p, w in zip(ref, weights):
-                    p.copy_(w)
-            except:
-                print(k)
-                print(ref[0].shape)
-                print(weights[0].shape)
-                raise
-
-
-def import_jax_weights_(model, version="model_1"):
+            for p, w in zip(ref, weights):
+                w = param_type.transformation(torch.from_numpy(np.array(w)))
+                try:
+                    if verify:
+                        if not torch.equal(p, w.to(p.dtype)):
+                            mismatched.append(k)
+                            break
+                    else:
+                        p.copy_(w)
+                except:
+                    print(k)
+                    print(p.shape)
+                    print(w.shape)
+                    raise
+    return mismatched
+
+
+def import_jax_weights_(model, data, verify=False):
 
     LinearWeight = lambda l: (Param(l, param_type=ParamType.LinearWeight))
 
@@ -146,15 +203,17 @@ def import_jax_weights_(model, version="model_1"):
         "scale": Param(l.weight),
         "offset": Param(l.bias),
     }
+    # q, k, v and gate are fused into a single projection without bias, AF2 weights
+    # are written into the corresponding row blocks, the gate bias is a separate parameter
+    QKVGParams = lambda att: dict(zip(
+        ["query_w", "key_w", "value_w", "gating_w"],
+        map(LinearWeightMHA, att.qkvg.weight.data.chunk(4)),
+        ), gating_b=LinearBiasMHA(att.gate_bias))
     MSAAttParams = lambda matt: {
         "query_norm": LayerNormParams(matt.norm),
         "attention": 
         {
-            "query_w": LinearWeightMHA(matt.q.weight),
-            "key_w": LinearWeightMHA(matt.k.weight),
-            "value_w": LinearWeightMHA(matt.v.weight),
-            "gating_w": LinearWeightMHA(matt.gate.weight),
-            "gating_b": LinearBiasMHA(matt.gate.bias),
+            **QKVGParams(matt),
             "output_w": Param(
                 matt.final.weight,
                 param_type=ParamType.LinearMHAOutputWeight,
@@ -198,35 +257,36 @@ def import_jax_weights_(model, version="model_1"):
         "output_w": LinearWeightOPM(o.final.weight),
         "output_b": LinearBias(o.final.bias),
     }
+    # projections of triangle multiplication are fused, AF2 weights go into slices of tri_mul.proj
+    TriMulLinearParams = lambda tri_mul, name: {
+        "weights": LinearWeight(tri_mul.split_proj()[name][0]),
+        "bias": LinearBias(tri_mul.split_proj()[name][1]),
+    }
     TriMulOutParams = lambda tri_mul: {
         "layer_norm_input": LayerNormParams(tri_mul.norm1),
-        "left_projection": LinearParams(tri_mul.l1i),
-        "right_projection": LinearParams(tri_mul.l1j),
-        "left_gate": LinearParams(tri_mul.l1i_sigm),
-        "right_gate": LinearParams(tri_mul.l1j_sigm),
+        "left_projection": TriMulLinearParams(tri_mul, "l1i"),
+        "right_projection": TriMulLinearParams(tri_mul, "l1j"),
+        "left_gate": TriMulLinearParams(tri_mul, "l1i_sigm"),
+        "right_gate": TriMulLinearParams(tri_mul, "l1j_sigm"),
         "center_layer_norm": LayerNormParams(tri_mul.norm2),
         "output_projection": LinearParams(tri_mul.l2_proj),
-        "gating_linear": LinearParams(tri_mul.l3_sigm),
+        "gating_linear": TriMulLinearParams(tri_mul, "l3_sigm"),
     }
     TriMulInParams = lambda tri_mul: {
         "layer_norm_input": LayerNormParams(tri_mul.norm1),
-        "left_projection": LinearParams(tri_mul.l1i),
-        "right_projection": LinearParams(tri_mul.l1j),
-        "left_gate": LinearParams(tri_mul.l1i_sigm),
-        "right_gate": LinearParams(tri_mul.l1j_sigm),
+        "left_projection": TriMulLinearParams(tri_mul, "l1i"),
+        "right_projection": TriMulLinearParams(tri_mul, "l1j"),
+        "left_gate": TriMulLinearParams(tri_mul, "l1i_sigm"),
+        "right_gate": TriMulLinearParams(tri_mul, "l1j_sigm"),
         "center_layer_norm": LayerNormParams(tri_mul.norm2),
         "output_projection": LinearParams(tri_mul.l2_proj),
-        "gating_linear": LinearParams(tri_mul.l3_sigm),
+        "gating_linear": TriMulLinearParams(tri_mul, "l3_sigm"),
     }
     TriAttParams = lambda tri_att: {
         "query_norm": LayerNormParams(tri_att.norm),
         "feat_2d_weights": LinearWeight(tri_att.bias.weight),
         "attention": {
-            "query_w": LinearWeightMHA(tri_att.q.weight),
-            "key_w": LinearWeightMHA(tri_att.k.weight),
-            "value_w": LinearWeightMHA(tri_att.v.weight),
-            "gating_w": LinearWeightMHA(tri_att.gate.weight),
-            "gating_b": LinearBiasMHA(tri_att.gate.bias),
+            **QKVGParams(tri_att),
             "output_w": Param(
                 tri_att.out.weight,
                 param_type=ParamType.LinearMHAOutputWeight,
@@ -369,14 +429,54 @@ def import_jax_weights_(model, version="model_1"):
         },
     }
     flat = _process_translations_dict(translations)
-    assign(flat, data)
+    return assign(flat, data, verify=verify)
 
 
-if __name__ == '__main__':
-    param_path = sys.argv[1]
-    data = np.load(param_path)
+def convert(param_path, out_dir='.', verify=False):
+    """Converts AF2 parameters to a pth file, which can be loaded memory-mapped (see checkpoint.load).
+    If verify is True, the saved file is loaded back and compared with the AF2 parameters."""
+    t0 = time.time()
+    data = load_npz_lazy(param_path)
     model = docker.DockerIteration(config.config['model'], config.config)
-    import_jax_weights_(model)
-    
-    param_out_path = os.path.basename(param_path)[:-4] + ".pth"
-    torch.save({'model_state_dict': model.state_dict()}, param_out_path)
+    import_jax_weights_(model, data)
+
+    param_out_path = os.path.join(out_dir, os.path.basename(param_path)[:-4] + ".pth")
+    checkpoint.save_atomic({'model_state_dict': model.state_dict()}, param_out_path)
+
+    if verify:
+        with torch.no_grad():
+            for p in model.parameters():
+                p.zero_()
+        model.load_state_dict(checkpoint.load(param_out_path)['model_state_dict'])
+        mismatched = import_jax_weights_(model, data, verify=True)
+        assert len(mismatched) == 0, f'{param_out_path} does not match {param_path}: {mismatched}'
+    print(f'Converted {param_path} to {param_out_path} in {time.time() - t0:.1f} s' + (' (verified)' if verify else ''))
+    return param_out_path
+
+
+@click.command()
+@click.argument('npz_files', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--out_dir', default='.', show_default=True, type=click.Path(exists=True, file_okay=False),
+              help='Where to write pth files')
+@click.option('--num_workers', default=1, show_default=True, type=click.INT,
+              help='Convert files in parallel processes')
+@click.option('--verify', is_flag=True,
+              help='Load converted files back and compare them with AF2 parameters')
+def cli(npz_files, out_dir, num_workers, verify):
+    """Convert AF2 parameters (params_model_*.npz) to pth files
+
+    \b
+    > python af2_params_to_pth.py params_model_1.npz
+    > python af2_params_to_pth.py params_model_?.npz params_model_?_ptm.npz --num_workers 5 --verify
+    """
+    args = [(x, out_dir, verify) for x in npz_files]
+    if num_workers > 1 and len(npz_files) > 1:
+        with multiprocessing.Pool(min(num_workers, len(npz_files)), initializer=torch.set_num_threads, initargs=(1,)) as pool:
+            pool.starmap(convert, args)
+    else:
+        for x in args:
+            convert(*x)
+
+
+if __name__ == '__main__':
+    cli()
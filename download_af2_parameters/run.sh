@@ -2,10 +2,6 @@
 
 wget https://storage.googleapis.com/alphafold/alphafold_params_2022-03-02.tar
 tar xvf alphafold_params_2022-03-02.tar
-for i in {1..5}; do
-  echo Converting params_model_${i}.npz ..
-  python af2_params_to_pth.py params_model_${i}.npz
-  echo Converting params_model_${i}_ptm.npz ..
-  python af2_params_to_pth.py params_model_${i}_ptm.npz
-done
-rm -f alphafold_params_2022-03-02.tar
\ No newline at end of file
+echo Converting params_model_{1..5}.npz params_model_{1..5}_ptm.npz ..
+python af2_params_to_pth.py params_model_{1..5}.npz params_model_{1..5}_ptm.npz --num_workers 5 --verify
+rm -f alphafold_params_2022-03-02.tar